@@ -1,8 +1,13 @@
 import os
-from flask import Flask, request, render_template, redirect, url_for, flash, Response, send_file, jsonify
-import io
+import json
+import time
+import uuid
+import shutil
+from flask import Flask, request, render_template, redirect, url_for, flash, Response, jsonify, stream_with_context, send_file
+import itertools
 import zipfile
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from dotenv import load_dotenv
 import logging
 
@@ -11,12 +16,28 @@ try:
     import pdf_processor
     import gemini_client
     import openai_client # 新增：导入 openai_client
+    import page_analysis
+    import result_cache
+    import rate_limiter
+    import retry_policy
+    import job_queue
+    import result_store
+    import image_variants
+    import document_index
 except ImportError as e:
     logging.error(f"Error importing local modules: {e}")
     # 可以在这里决定是否退出或如何处理
     pdf_processor = None
     gemini_client = None
     openai_client = None # 新增：处理 openai_client 导入失败
+    page_analysis = None
+    result_cache = None
+    rate_limiter = None
+    retry_policy = None
+    job_queue = None
+    result_store = None
+    image_variants = None
+    document_index = None
 
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,11 +48,15 @@ load_dotenv()
 # Flask 应用初始化
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'a_default_secret_key_for_development')
-app.config['PROCESSED_DATA_CACHE'] = {} # 用于存储处理结果以供导出
 
 # 配置
 UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads/pdfs')
 ALLOWED_EXTENSIONS = {'pdf'}
+# 是否将页面图像写入磁盘供结果页面展示；LLM 分析始终直接使用内存中的图像
+SAVE_PAGE_IMAGES = os.getenv('PDF_SAVE_PAGE_IMAGES', 'true').lower() in ('1', 'true', 'yes')
+# 页面图像的浏览器缓存时间（秒），0 表示每次都向服务器重新验证（仍可通过 ETag 得到 304）
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', 86400))
+IMAGE_SIZE_TIERS = ('thumb', 'preview', 'full')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB 上传限制
 
@@ -65,7 +90,7 @@ def index():
          # Decide if this should block the whole app or just LLM features
 
     # If core modules are missing, render index with error message
-    if not pdf_processor or (not gemini_client and not openai_client):
+    if not pdf_processor or not page_analysis or (not gemini_client and not openai_client):
          flash('核心处理模块未能加载，请检查服务器日志。', 'danger')
          return render_template('index.html')
 
@@ -120,10 +145,43 @@ def index():
         
         final_system_prompt = custom_system_prompt if custom_system_prompt else default_system_prompt_from_env
         logging.info(f"使用的系统提示: {'自定义' if custom_system_prompt else '默认'} ({final_system_prompt[:100]}...)")
+
+        llm_options = {
+            'provider': ui_llm_provider,
+            'model_name': final_model_to_use,
+            'system_prompt': final_system_prompt,
+            'gemini_api_key': ui_gemini_api_key,
+            'openai_api_key': ui_openai_api_key,
+            'openai_base_url': ui_openai_base_url
+        }
+        # 单个文件内的页面分析并发度：表单值优先，否则使用 LLM_MAX_CONCURRENCY；服务端限制在 1..LLM_MAX_CONCURRENCY_LIMIT
+        analysis_concurrency = page_analysis.clamp_concurrency(request.form.get('max_concurrency', type=int))
+        # 文本层快速通道：带文本层的页面直接使用内嵌文本，不渲染、不调用 LLM
+        use_text_layer = request.form.get('use_text_layer') == 'on'
+        # 按提供商/模型的分辨率预算渲染，避免上传会被服务端缩小丢弃的像素
+        resolution_budget = page_analysis.resolve_resolution_budget(llm_options)
+        # 上传给 LLM 的图像编码，独立于磁盘预览格式
+        upload_format, upload_quality = page_analysis.resolve_upload_codec(llm_options)
         
-        all_files_results = []
-        processed_one_successfully = False
+        queue = _get_job_queue()
+        if not queue:
+            flash('后台任务队列未能初始化，请检查服务器日志。', 'danger')
+            return redirect(request.url)
 
+        # 处理在后台任务中进行，请求立即返回任务 ID；界面填写的 API Key 只保存在内存中
+        job_options = {key: value for key, value in llm_options.items() if key not in JOB_SECRET_OPTIONS}
+        job_options.update({
+            'analysis_concurrency': analysis_concurrency,
+            'use_text_layer': use_text_layer,
+            'resolution_budget': resolution_budget,
+            'upload_format': upload_format,
+            'upload_quality': upload_quality
+        })
+        # 整份文档索引：相同内容的 PDF 在相同分析配置下直接复用上次的结果
+        doc_index = document_index.get_document_index() if document_index else None
+        variant_key = _document_variant_key(llm_options, job_options) if doc_index else None
+
+        job_files = []
         for file in uploaded_files:
             if file.filename == '':
                 # Skip empty files (e.g., if user selected multiple but some were empty)
@@ -131,149 +189,404 @@ def index():
 
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
-                pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                # 各任务的上传文件互不覆盖：磁盘文件名带随机前缀，展示和导出仍使用原文件名
+                pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex[:8]}_{filename}")
                 try:
-                    file.save(pdf_path)
+                    if document_index:
+                        # 边写入边计算内容哈希，不需要再读一遍文件
+                        document_hash = document_index.save_and_hash_upload(file, pdf_path)
+                    else:
+                        file.save(pdf_path)
+                        document_hash = None
                     logging.info(f"文件 '{filename}' 已成功保存到 '{pdf_path}'")
-
-                    base_image_output_folder = os.path.join(os.path.dirname(app.config['UPLOAD_FOLDER']), 'pdf_images')
-                    image_paths = pdf_processor.convert_pdf_to_images(
-                        pdf_path=pdf_path,
-                        base_output_folder=base_image_output_folder,
-                        dpi=int(os.getenv('PDF_IMAGE_DPI', 300)),
-                        image_format=os.getenv('PDF_IMAGE_FORMAT', 'PNG')
-                    )
-                    logging.info(f"PDF '{filename}' 已转换为 {len(image_paths)} 张图像。")
-
-                    if not image_paths:
-                        flash(f"PDF '{filename}' 转换为图像失败。", 'danger')
-                        # Continue processing next file instead of redirecting immediately
-                        all_files_results.append({
-                            'original_filename': filename,
-                            'error': f"PDF '{filename}' 转换为图像失败。",
-                            'page_results': []
-                        })
-                        continue
-
-                    current_file_page_analyses = []
-                    # User prompt is now fixed as system prompt will handle instruction part
-                    user_prompt_for_image = "请分析这张图片。" # Or could be removed entirely if system prompt is sufficient
-
-                    for image_path in image_paths:
-                        try:
-                            logging.info(f"正在分析图像: {image_path} (来自 {filename}) 使用 LLM: {ui_llm_provider}, 模型: {final_model_to_use or '默认'}, 系统提示: {final_system_prompt[:50]}...")
-                            analysis = None
-                            if ui_llm_provider in ['openai', 'volcano', 'google']: # Use openai_client for openai, volcano and google
-                                # Use the UI provided base_url for openai, volcano, and google
-                                analysis = openai_client.analyze_image_openai(
-                                    image_path=image_path,
-                                    system_prompt_override=final_system_prompt,
-                                    api_key_override=ui_openai_api_key or None,
-                                    model_name_override=final_model_to_use or None,
-                                    base_url_override=ui_openai_base_url or None # Pass the UI provided base_url
-                                )
-                            elif ui_llm_provider == 'gemini':
-                                analysis = gemini_client.analyze_image(
-                                    image_path=image_path,
-                                    user_prompt=user_prompt_for_image,
-                                    system_prompt_override=final_system_prompt,
-                                    api_key_override=ui_gemini_api_key or None,
-                                    model_name_override=final_model_to_use or None # Pass the determined model name
-                                )
-                            else:
-                                # This case should ideally not be reached due to the provider check above
-                                logging.error(f"不应发生的错误: 未知的 LLM 提供商 '{ui_llm_provider}' 在分析循环中")
-                                analysis = f"错误: 未知的 LLM 提供商 '{ui_llm_provider}'"
-                                
-                            current_file_page_analyses.append({
-                                'image_path': image_path,
-                                'analysis': analysis if analysis else "未能分析此图像。"
-                            })
-                        except Exception as e:
-                            logging.error(f"分析图像 '{image_path}' (来自 {filename}) 时出错: {e}")
-                            current_file_page_analyses.append({
-                                'image_path': image_path,
-                                'analysis': f"分析图像时出错: {e}"
-                            })
-                        
-                        logging.info(f"文件 '{filename}' 的所有图像分析完成。共 {len(current_file_page_analyses)} 个结果。")
-                        
-                        web_accessible_page_results = []
-                        for res in current_file_page_analyses:
-                            relative_image_path = os.path.relpath(res['image_path'], os.getcwd()).replace('\\', '/')
-                        web_accessible_page_results.append({
-                            'image_web_path': relative_image_path,
-                            'analysis': res['analysis']
-                        })
-                        
-                        file_data_for_template = {
-                            'original_filename': filename,
-                            'page_results': web_accessible_page_results
-                        }
-                        all_files_results.append(file_data_for_template)
-                        # Store results for export (not including web accessible paths, but original analysis)
-                        app.config['PROCESSED_DATA_CACHE'][filename] = {
-                            'original_filename': filename,
-                            'page_analyses': current_file_page_analyses # Contains original image_path and analysis
-                        }
-                        processed_one_successfully = True
-
-                except pdf_processor.PDFProcessingError as e:
-                    logging.error(f"PDF '{filename}' 处理错误: {e}")
-                    flash(f"PDF '{filename}' 处理错误: {e}", 'danger')
-                    all_files_results.append({
-                        'original_filename': filename,
-                        'error': f"PDF '{filename}' 处理错误: {e}",
-                        'page_results': []
-                    })
-                except (gemini_client.GeminiClientError if gemini_client else Exception) as e: # Check if gemini_client is loaded
-                    logging.error(f"Error during Gemini API call for '{filename}': {e}")
-                    flash(f"处理 '{filename}' 时发生 Gemini API 错误: {e}", 'danger')
-                    all_files_results.append({
-                        'original_filename': filename,
-                        'error': f"处理 '{filename}' 时发生 Gemini API 错误: {e}",
-                        'page_results': []
-                    })
-                # Can add similar specific exception handling for OpenAIClientError (if defined in openai_client.py)
-                # except openai_client.OpenAIClientError as e:
-                #     logging.error(f"Error during OpenAI API call for '{filename}': {e}")
-                #     flash(f"Error during OpenAI API call for '{filename}': {e}", 'danger')
-                #     all_files_results.append({
-                #         'original_filename': filename,
-                #         'error': f"Error during OpenAI API call for '{filename}': {e}",
-                #         'page_results': []
-                #     })
-                except Exception as e:
-                    logging.error(f"An unknown error occurred while processing file '{filename}': {e}")
-                    flash(f"处理文件 '{filename}' 时发生未知错误: {e}", 'danger')
-                    all_files_results.append({
-                        'original_filename': filename,
-                        'error': f"处理文件 '{filename}' 时发生未知错误: {e}",
-                        'page_results': []
-                    })
-                finally:
-                    # Optional: Delete the uploaded PDF file after processing
-                    # if os.path.exists(pdf_path):
-                    #     try:
-                    #         os.remove(pdf_path)
-                    #         logging.info(f"Deleted uploaded PDF file: {pdf_path}")
-                    #     except OSError as e:
-                    #         logging.error(f"Error deleting PDF file {pdf_path}: {e}")
-                    pass
+                    job_file = {'filename': filename, 'pdf_path': pdf_path, 'document_hash': document_hash}
+                    if doc_index and document_hash:
+                        job_file.update(_indexed_document_results(doc_index, filename, document_hash, variant_key))
+                    job_files.append(job_file)
+                except OSError as e:
+                    logging.error(f"保存文件 '{filename}' 失败: {e}")
+                    flash(f"保存文件 '{filename}' 失败: {e}", 'danger')
             else:
                 if file.filename: # Only show warning if filename exists
                     flash(f"File '{file.filename}' type not allowed or invalid. Please upload PDF files.", 'warning')
-        
-        if not processed_one_successfully and not all_files_results:
-             # If no files were processed (e.g., all were invalid types or failed processing and no successful cases)
+
+        if not job_files:
             flash('No files were successfully processed.', 'info')
             return redirect(request.url)
 
-        return render_template('results.html', all_files_results=all_files_results)
+        job_options['document_variant_key'] = variant_key
+        job_options['document_hashes'] = [item['document_hash'] for item in job_files]
+        job_id = queue.submit(job_files, job_options, secrets={key: llm_options[key] for key in JOB_SECRET_OPTIONS})
+        if result_store:
+            # 命中整份文档索引的文件已有结果，直接保存供导出
+            for file_index, item in enumerate(job_files):
+                if item.get('page_results') is not None:
+                    result_store.get_result_store().put(_result_store_key(job_id, file_index), {
+                        'original_filename': item['filename'],
+                        'page_analyses': item['page_results']
+                    })
+        if _wants_json():
+            return jsonify({'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+        return redirect(url_for('job_status', job_id=job_id))
 
     # GET request, load default system prompt to pre-fill textarea
     default_system_prompt = os.getenv('DEFAULT_SYSTEM_PROMPT', "你是一个专业的文档分析助手。请详细分析并总结所提供图像中的内容。")
-    return render_template('index.html', default_system_prompt=default_system_prompt)
+    return render_template('index.html',
+                           default_system_prompt=default_system_prompt,
+                           default_max_concurrency=page_analysis.LLM_MAX_CONCURRENCY,
+                           max_concurrency_limit=page_analysis.LLM_MAX_CONCURRENCY_LIMIT,
+                           default_use_text_layer=pdf_processor.PDF_TEXT_LAYER_MODE == 'auto')
+
+
+# 不写入任务数据库的敏感选项
+JOB_SECRET_OPTIONS = ('gemini_api_key', 'openai_api_key')
+# SSE 连接空闲时发送心跳注释的间隔，避免代理断开长连接
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def _wants_json():
+    return request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json'
+
+
+def _uploads_base_dir():
+    # UPLOAD_FOLDER 的上级目录（默认 'uploads'），按 app.root_path 解析：写入页面图像、生成图像地址和提供图像时
+    # 使用同一个基准，与服务器的启动目录无关
+    return os.path.join(app.root_path, os.path.dirname(app.config['UPLOAD_FOLDER']))
+
+
+def _page_image_base_folder():
+    return os.path.join(_uploads_base_dir(), 'pdf_images')
+
+
+def _cleanup_job_file(pdf_path):
+    # 任务过期时删除该文件的页面图像目录（其中也包含缩略图/预览图）
+    shutil.rmtree(pdf_processor.page_image_folder(pdf_path, _page_image_base_folder()), ignore_errors=True)
+
+
+def _get_job_queue():
+    return job_queue.get_job_queue(_run_analysis_job, cleanup=_cleanup_job_file) if job_queue else None
+
+
+def _document_variant_key(llm_options, job_options):
+    """计算整份文档索引使用的分析配置键：生效的提供商/模型/提示词加上影响结果的处理选项（并发度只影响速度，不计入）。"""
+    identity = page_analysis.resolve_llm_identity(llm_options)
+    options = {key: job_options.get(key) for key in ('use_text_layer', 'resolution_budget', 'upload_format', 'upload_quality')}
+    options['dpi'] = int(os.getenv('PDF_IMAGE_DPI', 300))
+    return document_index.make_variant_key(
+        identity['provider'],
+        identity['model_name'],
+        identity['system_prompt'],
+        user_prompt=identity['user_prompt'],
+        endpoint=identity['endpoint'],
+        options=options
+    )
+
+
+def _indexed_document_results(doc_index, filename, document_hash, variant_key):
+    """
+    在整份文档索引中查找已上传过的相同文档。
+
+    返回:
+    dict: 命中时为 {'page_results', 'summary'}，可直接作为已完成的文件提交到任务队列；未命中时为空字典。
+    """
+    entry = doc_index.get(document_index.make_document_key(document_hash, variant_key))
+    if not entry:
+        return {}
+    # 复制后再修改，不影响索引条目本身
+    page_results = [dict(res) for res in entry['page_analyses']]
+    for res in page_results:
+        # 上次渲染的页面图像可能已被清理，此时结果页面不再显示图像
+        if res.get('image_path') and not os.path.exists(res['image_path']):
+            res['image_path'] = None
+    summary = _summarize_page_results(page_results)
+    summary.update(document_cache_hit=True, document_cached_at=entry['created_at'])
+    logging.info(f"文件 '{filename}' 命中整份文档索引 ({len(page_results)} 页)，跳过渲染和 LLM 调用。")
+    return {'page_results': page_results, 'summary': summary}
+
+
+def _result_store_key(job_id, file_index):
+    # 导出结果按任务和文件序号保存：不同任务中的同名文件互不覆盖
+    return f"{job_id}/{file_index}"
+
+
+def _summarize_page_results(page_analyses):
+    """统计一个文件的缓存命中、去重、文本层、复用上一版本的页面数和分辨率预算节省的字节数。"""
+    return {
+        'cache_hits': sum(1 for res in page_analyses if res.get('cached')),
+        'deduplicated_pages': sum(1 for res in page_analyses if res.get('dedup')),
+        'text_layer_pages': sum(1 for res in page_analyses if res.get('text_layer') and not res.get('dedup') and not res.get('reused_from')),
+        'reused_pages': sum(1 for res in page_analyses if res.get('reused_from')),
+        'bytes_saved': sum(res.get('bytes_saved') or 0 for res in page_analyses)
+    }
+
+
+def _web_page_result(res):
+    """把页面分析结果转换为结果页面使用的格式（图像路径改为相对 _uploads_base_dir()、可通过 /uploads_img 访问的路径）。"""
+    relative_image_path = None
+    if res.get('image_path'):
+        relative_image_path = os.path.relpath(res['image_path'], _uploads_base_dir()).replace('\\', '/')
+    return {
+        'image_web_path': relative_image_path,
+        'analysis': res['analysis'],
+        'page_number': res.get('page_number'),
+        'dedup': res.get('dedup'),
+        'duplicate_of': res.get('duplicate_of'),
+        'text_layer': res.get('text_layer'),
+        'reused_from': res.get('reused_from')
+    }
+
+
+@app.template_global()
+def page_image_urls(image_web_path):
+    """
+    返回页面图像各尺寸档位的地址，供结果页面懒加载预览图、按需打开原图。
+
+    返回:
+    dict: 'full' / 'preview' / 'thumb' 的 URL，以及按长边像素声明宽度的 'srcset'（未加载缩放模块时只含原图）。
+    """
+    urls = {'full': url_for('uploaded_file_image', filepath=image_web_path)}
+    if not image_variants:
+        urls.update(preview=urls['full'], thumb=urls['full'], srcset='')
+        return urls
+    for size in ('thumb', 'preview'):
+        urls[size] = url_for('uploaded_file_image', filepath=image_web_path, size=size)
+    urls['srcset'] = ', '.join(f"{urls[size]} {edge}w" for size, edge in image_variants.IMAGE_VARIANT_SIZES.items() if edge > 0)
+    return urls
+
+
+def _index_document(options, file_index, filename, pdf_path, page_analyses):
+    """把完整且没有出错的文件结果写入整份文档索引，供相同文档再次上传时直接复用。"""
+    document_hashes = options.get('document_hashes') or []
+    document_hash = document_hashes[file_index] if file_index < len(document_hashes) else None
+    variant_key = options.get('document_variant_key')
+    doc_index = document_index.get_document_index() if document_index and document_hash and variant_key else None
+    if not doc_index:
+        return
+    if any(page_analysis.is_error_analysis(res['analysis']) or res.get('truncated') for res in page_analyses):
+        logging.info(f"文件 '{filename}' 有页面分析失败或被截断，不写入整份文档索引。")
+        return
+    if any(not res.get('fingerprint') for res in page_analyses):
+        # 没有上一版本时渲染阶段不计算指纹；写入索引前补齐，供以后的新版本比对
+        fingerprints = pdf_processor.page_fingerprints(pdf_path)
+        page_analyses = [dict(res, fingerprint=res.get('fingerprint') or fingerprints.get(res.get('page_number'))) for res in page_analyses]
+    doc_index.put(document_index.make_document_key(document_hash, variant_key), document_hash, variant_key, filename, page_analyses)
+
+
+def _previous_version_results(options, file_index, filename):
+    """
+    查找同名文档在相同分析配置下的上一版本，返回 {页面内容指纹: 上一版本该页的结果}。
+
+    出错或被截断的页面不复用；没有上一版本或索引不可用时返回 None。
+    """
+    document_hashes = options.get('document_hashes') or []
+    variant_key = options.get('document_variant_key')
+    doc_index = document_index.get_document_index() if document_index and variant_key else None
+    if not doc_index:
+        return None
+    document_hash = document_hashes[file_index] if file_index < len(document_hashes) else None
+    previous = doc_index.find_previous_version(filename, variant_key, exclude_document_hash=document_hash)
+    if not previous:
+        return None
+    previous_results = {}
+    for res in previous['page_analyses']:
+        if res.get('fingerprint') and not res.get('truncated') and not page_analysis.is_error_analysis(res['analysis']):
+            previous_results.setdefault(res['fingerprint'], res)
+    logging.info(f"文件 '{filename}' 找到上一版本 ({previous['page_count']} 页，{len(previous_results)} 个可复用的页面指纹)。")
+    return previous_results or None
+
+
+def _run_analysis_job(job_id, files, options, reporter):
+    """在后台工作线程中逐个处理任务中的 PDF 文件，每完成一页即通过 reporter 上报结果。"""
+    llm_options = {key: options.get(key) for key in ('provider', 'model_name', 'system_prompt', 'gemini_api_key', 'openai_api_key', 'openai_base_url')}
+    resolution_budget = tuple(options['resolution_budget']) if options.get('resolution_budget') else None
+    # 页面图像在内存中交给 LLM；仅在需要结果页面展示时写入磁盘
+    base_image_output_folder = _page_image_base_folder() if SAVE_PAGE_IMAGES else None
+
+    for item in files:
+        file_index, filename, pdf_path = item['file_index'], item['filename'], item['pdf_path']
+        if reporter.is_cancelled():
+            reporter.file_finished(file_index, error=job_queue.JOB_CANCELLED_MESSAGE)
+            continue
+        try:
+            reporter.file_started(file_index, pdf_processor.get_page_count(pdf_path))
+            # 增量分析：与上一版本内容相同的页面不渲染，直接复用结果，只有修改过的页面和新页面调用 LLM；
+            # 只有存在上一版本时才需要在渲染时计算页面指纹
+            previous_results = _previous_version_results(options, file_index, filename)
+            # 流水线：每渲染完一页就立即提交分析，渲染与 LLM 调用相互重叠
+            page_images = pdf_processor.iter_pdf_pages(
+                pdf_path=pdf_path,
+                base_output_folder=base_image_output_folder,
+                dpi=int(os.getenv('PDF_IMAGE_DPI', 300)),
+                image_format=os.getenv('PDF_IMAGE_FORMAT', 'PNG'),
+                use_text_layer=options.get('use_text_layer'),
+                resolution_budget=resolution_budget,
+                upload_format=options.get('upload_format'),
+                upload_quality=options.get('upload_quality'),
+                known_fingerprints=previous_results.keys() if previous_results else None
+            )
+            current_file_page_analyses = page_analysis.analyze_pages_streaming(
+                page_images,
+                llm_options,
+                max_workers=options.get('analysis_concurrency'),
+                on_result=lambda res, file_index=file_index: reporter.page_done(file_index, res),
+                on_delta=lambda page_number, text, file_index=file_index: reporter.page_delta(file_index, page_number, text),
+                should_stop=reporter.is_cancelled,
+                previous_results=previous_results
+            )
+            logging.info(f"[任务 {job_id}] PDF '{filename}' 已转换为 {len(current_file_page_analyses)} 张图像。")
+
+            if not current_file_page_analyses:
+                reporter.file_finished(file_index, error=f"PDF '{filename}' 转换为图像失败。")
+                continue
+
+            summary = _summarize_page_results(current_file_page_analyses)
+            if reporter.is_cancelled():
+                reporter.file_finished(file_index, summary, error=f"{job_queue.JOB_CANCELLED_MESSAGE}已完成 {len(current_file_page_analyses)} 页。")
+                continue
+            logging.info(f"[任务 {job_id}] 文件 '{filename}' 的所有图像分析完成。共 {len(current_file_page_analyses)} 个结果，其中 {summary['cache_hits']} 个来自 OCR 结果缓存。")
+            if resolution_budget:
+                logging.info(f"[任务 {job_id}] 文件 '{filename}' 按分辨率预算 {resolution_budget} 渲染，估计节省 {summary['bytes_saved']} 字节图像数据。")
+
+            # Store results for export (not including web accessible paths, but original analysis)
+            result_store.get_result_store().put(_result_store_key(job_id, file_index), {
+                'original_filename': filename,
+                'page_analyses': current_file_page_analyses # Contains original image_path and analysis
+            })
+            _index_document(options, file_index, filename, pdf_path, current_file_page_analyses)
+            reporter.file_finished(file_index, summary)
+
+        except pdf_processor.PDFProcessingError as e:
+            logging.error(f"[任务 {job_id}] PDF '{filename}' 处理错误: {e}")
+            reporter.file_finished(file_index, error=f"PDF '{filename}' 处理错误: {e}")
+        except Exception as e:
+            logging.error(f"[任务 {job_id}] An unknown error occurred while processing file '{filename}': {e}")
+            reporter.file_finished(file_index, error=f"处理文件 '{filename}' 时发生未知错误: {e}")
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    # 任务进度和已完成页面的结果：浏览器访问时渲染结果页面，?format=json 或 Accept: application/json 时返回 JSON
+    queue = _get_job_queue()
+    job = queue.get_job(job_id) if queue else None
+    if not job:
+        if _wants_json():
+            return jsonify({"error": "Job not found."}), 404
+        flash(f"找不到任务 {job_id}。", 'warning')
+        return redirect(url_for('index'))
+    if _wants_json():
+        return jsonify(job)
+
+    all_files_results = []
+    for file_index, file_job in enumerate(job['files']):
+        file_data_for_template = {
+            'file_index': file_index,
+            'original_filename': file_job['filename'],
+            'status': file_job['status'],
+            'pending': file_job['status'] in ('queued', 'running'),
+            'page_count': file_job['page_count'],
+            'error': file_job['error'],
+            'page_results': [_web_page_result(res) for res in file_job['page_results']]
+        }
+        file_data_for_template.update(_summarize_page_results(file_job['page_results']))
+        if file_job['summary'] and file_job['summary'].get('document_cache_hit'):
+            file_data_for_template['document_cached_at'] = time.strftime('%Y-%m-%d %H:%M', time.localtime(file_job['summary']['document_cached_at']))
+        all_files_results.append(file_data_for_template)
+    return render_template('results.html', all_files_results=all_files_results, job=job)
+
+
+def _sse_event(event, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    以 Server-Sent Events 推送任务进度：每页完成时立即发送一个 'page' 事件，
+    文件状态变化时发送 'file' 事件，任务进度变化时发送 'job' 事件，任务结束后连接关闭。
+    流式调用 LLM 时，生成中的页面文本以 'delta' 事件推送：{file_index, page_number, offset, text}，
+    表示该页文本从 offset 处起为 text（重连后从 0 开始重发），该页的 'page' 事件到达后以其为准。
+
+    先补发 after 参数（或重连时的 Last-Event-ID）之后已完成的页面，再实时推送；
+    结果逐页从数据库读取并立即发出，服务端不缓存完整结果集。
+    """
+    queue = _get_job_queue()
+    if not queue or not queue.get_job(job_id, include_results=False):
+        return jsonify({"error": "Job not found."}), 404
+    after_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+
+    def generate():
+        last_event_id = after_id
+        sent_partials = {} # (file_index, page_number) -> 已发送的生成中文本长度
+        sent_file_states = {}
+        sent_job_state = None
+        last_sent = time.monotonic()
+        yield 'retry: 3000\n\n'
+        while True:
+            version = queue.update_version()
+            page_events = queue.get_page_results_since(job_id, last_event_id)
+            for event_id, file_index, res in page_events:
+                last_event_id = event_id
+                payload = _web_page_result(res)
+                payload['file_index'] = file_index
+                payload['image_urls'] = page_image_urls(payload['image_web_path']) if payload['image_web_path'] else None
+                sent_partials.pop((file_index, payload['page_number']), None)
+                yield _sse_event('page', payload, event_id)
+            if page_events:
+                last_sent = time.monotonic()
+                continue # 先发完积压的页面，再检查状态
+
+            for file_index, page_number, text in queue.get_partial_results(job_id):
+                offset = sent_partials.get((file_index, page_number), 0)
+                if len(text) > offset:
+                    sent_partials[(file_index, page_number)] = len(text)
+                    yield _sse_event('delta', {'file_index': file_index, 'page_number': page_number, 'offset': offset, 'text': text[offset:]})
+                    last_sent = time.monotonic()
+
+            job = queue.get_job(job_id, include_results=False)
+            for file_job in job['files']:
+                state = (file_job['status'], file_job['page_count'], file_job['error'])
+                if sent_file_states.get(file_job['file_index']) != state:
+                    sent_file_states[file_job['file_index']] = state
+                    yield _sse_event('file', {key: file_job[key] for key in ('file_index', 'status', 'page_count', 'pages_done', 'error')})
+                    last_sent = time.monotonic()
+            job_state = (job['status'], job['pages_done'], job['pages_total'])
+            if job_state != sent_job_state:
+                sent_job_state = job_state
+                yield _sse_event('job', {key: job[key] for key in ('job_id', 'status', 'error', 'pages_done', 'pages_total')})
+                last_sent = time.monotonic()
+            if job['status'] in job_queue.JOB_FINISHED_STATUSES:
+                # 任务结束前所有页面都已写入；上面的查询之后若仍有新页面，下一轮会先发出
+                if not queue.get_page_results_since(job_id, last_event_id, limit=1):
+                    return
+                continue
+
+            if time.monotonic() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+            queue.wait_for_update(version, timeout=1.0)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    # 取消排队中或正在执行的任务；已完成页面的结果保留
+    queue = _get_job_queue()
+    if not queue or not queue.get_job(job_id, include_results=False):
+        if _wants_json():
+            return jsonify({"error": "Job not found."}), 404
+        flash(f"找不到任务 {job_id}。", 'warning')
+        return redirect(url_for('index'))
+    outcome = queue.cancel(job_id)
+    if _wants_json():
+        if not outcome:
+            return jsonify({"error": "Job is not running in this process or has already finished."}), 409
+        return jsonify({"job_id": job_id, "status": outcome})
+    return redirect(url_for('job_status', job_id=job_id))
 
 
 @app.route('/api/get_models/<provider>', methods=['POST']) # Changed to POST to send API key in body
@@ -314,122 +627,152 @@ def get_models(provider):
             
     return jsonify(models_data), status_code
 
-@app.route('/export_markdown/<original_filename>')
-def export_markdown(original_filename):
-    # Get processed data for this file from cache
-    file_data = app.config['PROCESSED_DATA_CACHE'].get(original_filename)
+@app.route('/api/cache_stats')
+def cache_stats():
+    cache = result_cache.get_result_cache() if result_cache else None
+    stats = cache.stats() if cache else {"enabled": False}
+    # 同时返回导出用结果存储的条目数和大小
+    stats['result_store'] = result_store.get_result_store().stats() if result_store else None
+    doc_index = document_index.get_document_index() if document_index else None
+    stats['document_index'] = doc_index.stats() if doc_index else {"enabled": False}
+    return jsonify(stats)
+
+@app.route('/api/rate_limits')
+def rate_limits():
+    # 各提供商/端点/API Key 当前生效的速率 (AIMD 调整后)，用于观察负载下的收敛情况；
+    # 同时返回各端点熔断器的状态
+    if not rate_limiter:
+        return jsonify({"limiters": [], "circuit_breakers": []})
+    return jsonify({
+        "aimd_enabled": rate_limiter.RATE_LIMIT_AIMD_ENABLED,
+        "limiters": rate_limiter.rate_limit_snapshot(),
+        "circuit_breakers": retry_policy.circuit_breaker_snapshot() if retry_policy else []
+    })
+
+def _iter_markdown(file_data):
+    """逐段产出一个文件的 Markdown 导出内容；由调用方拼接或直接写出，耗时与内容长度成线性关系。"""
+    yield f"# Analysis Results: {file_data['original_filename']}\n\n"
+    for i, page_data in enumerate(file_data['page_analyses']):
+        # Original image path: page_data['image_path'] - can optionally include
+        # ![Page Image](image_path) # Local path may not display in all MD viewers
+        yield f"## Page {i+1}\n\n**Analysis Text:**\n```\n{page_data['analysis']}\n```\n\n---\n\n"
+
+
+class _ZipStreamBuffer:
+    """
+    zipfile 的只写输出目标：暂存写入的字节，由生成器在每次写入后取出并发送。
+
+    不提供 seek/tell，zipfile 会以流式模式（数据描述符）写入，无需回写本地文件头。
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _iter_markdown_zip(items):
+    """
+    把 (filename, file_data) 逐个写成 ZIP 中的 Markdown 条目，边压缩边产出 ZIP 字节。
+
+    同一时刻只持有一个文件的结果和一个页面的 Markdown，内存占用与导出的文件数无关。
+    """
+    buffer = _ZipStreamBuffer()
+    used_names = set()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for result_key, file_data in items:
+            if not file_data or not file_data.get('page_analyses'):
+                logging.warning(f"Skipping result '{result_key}' as its analysis data was not found during batch export.")
+                continue
+            # Create .md file using original filename; 不同任务中的同名文件加序号区分
+            original_filename = file_data['original_filename']
+            markdown_filename = f"{original_filename}_analysis.md"
+            suffix = 1
+            while markdown_filename in used_names:
+                suffix += 1
+                markdown_filename = f"{original_filename}_analysis_{suffix}.md"
+            used_names.add(markdown_filename)
+            with zf.open(markdown_filename, 'w') as entry:
+                for chunk in _iter_markdown(file_data):
+                    entry.write(chunk.encode('utf-8'))
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            logging.info(f"Added '{markdown_filename}' to ZIP stream.")
+    yield buffer.drain() # 最后一个条目的数据描述符和中央目录
+
+
+@app.route('/jobs/<job_id>/files/<int:file_index>/export_markdown')
+def export_markdown(job_id, file_index):
+    # Get processed data for this file from the result store (shared across worker processes with the SQLite backend)
+    file_data = result_store.get_result_store().get(_result_store_key(job_id, file_index)) if result_store else None
 
     if not file_data or not file_data.get('page_analyses'):
-        flash(f"Could not find analysis results for file '{original_filename}' for export.", 'warning')
+        flash(f"Could not find analysis results for file #{file_index + 1} of job {job_id} for export.", 'warning')
         # Redirect to results page or home page might be better, or show an error page
         # Trying to find it from the last rendered results in all_files_results is unreliable
         # Temporarily redirect back to home page
         return redirect(url_for('index'))
 
-    markdown_content = f"# Analysis Results: {file_data['original_filename']}\n\n"
-    
-    for i, page_data in enumerate(file_data['page_analyses']):
-        markdown_content += f"## Page {i+1}\n\n"
-        # Original image path: page_data['image_path'] - can optionally include
-        # markdown_content += f"![Page Image]({page_data['image_path']})\n\n" # Local path may not display in all MD viewers
-        markdown_content += f"**Analysis Text:**\n```\n{page_data['analysis']}\n```\n\n"
-        markdown_content += "---\n\n"
-
     # Create Markdown file for download
     response = Response(
-        markdown_content,
+        ''.join(_iter_markdown(file_data)),
         mimetype="text/markdown",
-        headers={"Content-disposition": f"attachment; filename={original_filename}_analysis.md"}
+        headers={"Content-disposition": f"attachment; filename={file_data['original_filename']}_analysis.md"}
     )
     return response
 
 @app.route('/export_all_markdown_zip')
 def export_all_markdown_zip():
-    processed_data = app.config.get('PROCESSED_DATA_CACHE')
-    if not processed_data:
+    processed_data = result_store.get_result_store().items() if result_store else iter(())
+    first_item = next(processed_data, None)
+    if first_item is None:
         flash('No processed files available for export.', 'warning')
         return redirect(url_for('index'))
 
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for original_filename, file_data in processed_data.items():
-            if not file_data or not file_data.get('page_analyses'):
-                logging.warning(f"Skipping file '{original_filename}' as its analysis data was not found during batch export.")
-                continue
-
-            markdown_content = f"# Analysis Results: {file_data['original_filename']}\n\n"
-            for i, page_data in enumerate(file_data['page_analyses']):
-                markdown_content += f"## Page {i+1}\n\n"
-                markdown_content += f"**Analysis Text:**\n```\n{page_data['analysis']}\n```\n\n"
-                markdown_content += "---\n\n"
-            
-            # Create .md file using original filename
-            markdown_filename = f"{original_filename}_analysis.md"
-            zf.writestr(markdown_filename, markdown_content)
-            logging.info(f"Added '{markdown_filename}' to ZIP file.")
-
-    memory_file.seek(0)
-    
-    if not memory_file.getvalue(): # Check if ZIP file is empty
-        flash('Failed to generate any Markdown files into the ZIP package.', 'danger')
-        return redirect(url_for('results')) # or index
-
-    return send_file(
-        memory_file,
+    # 以生成器响应边生成边发送 ZIP，不在内存中构建整个压缩包；首个字节无需等待全部文件压缩完成
+    return Response(
+        stream_with_context(_iter_markdown_zip(itertools.chain([first_item], processed_data))),
         mimetype='application/zip',
-        as_attachment=True,
-        download_name='all_markdown_exports.zip'
+        headers={"Content-disposition": "attachment; filename=all_markdown_exports.zip"}
     )
 
 # Add a route to serve uploaded images
 # This is necessary to display images in results.html
 @app.route('/uploads_img/<path:filepath>')
 def uploaded_file_image(filepath):
-    # filepath will be something like 'pdf_images/filename_images/page_1.png'
-    # We need to serve it from the project root (or a known parent directory)
-    # The parent directory of UPLOAD_FOLDER ('uploads/pdfs') is 'uploads'
-    # base_image_output_folder is 'uploads/pdf_images'
-    # So, we should build the path starting from the 'uploads' directory
-    # For security, should restrict which paths can be accessed
-    # image_directory = os.path.join(os.path.dirname(app.config['UPLOAD_FOLDER']), 'pdf_images')
-    # secure_path = safe_join(image_directory, filepath) # safe_join needs import
-    # return send_from_directory(os.path.dirname(secure_path), os.path.basename(secure_path))
-
-    # Simpler (but not fully secure) approach:
-    # Assume filepath is already the correct path relative to the 'uploads' directory
-    # E.g., if filepath is 'pdf_images/my_doc_images/page_1.png'
-    # Then the full path is 'uploads/pdf_images/my_doc_images/page_1.png'
-    from flask import send_from_directory
-    # The 'uploads' directory is the parent of UPLOAD_FOLDER ('uploads/pdfs')
-    uploads_base_dir = os.path.dirname(app.config['UPLOAD_FOLDER']) # 'uploads'
-    # Ensure path is safe to prevent directory traversal attacks
-    # os.path.normpath cleans up paths like '..'
-    # secure_filepath = secure_filename(filepath) # secure_filename is mainly for filenames, not paths
-    # We need to ensure filepath does not contain '..' etc.
-    # A safer approach would be to use safe_join (werkzeug.security.safe_join)
-    # Or explicitly serve files from a known, trusted root directory
-    # image_full_path = os.path.join(uploads_base_dir, filepath)
-    # if not os.path.abspath(image_full_path).startswith(os.path.abspath(uploads_base_dir)):
-    #     return "Forbidden", 403
-    # return send_from_directory(os.path.dirname(image_full_path), os.path.basename(image_full_path))
-
-    # Assuming filepath is already the correct path relative to the 'uploads' directory, e.g., 'pdf_images/...'
-    # and that pdf_processor generates paths this way
-    # In web_accessible_results, relative_image_path is 'uploads/pdf_images/...'
-    # So, when the template requests /uploads_img/uploads/pdf_images/... we need to strip the leading 'uploads/'
+    # filepath 形如 'pdf_images/<name>_images/page_1.png'，相对 _uploads_base_dir() 提供
+    # （旧结果中的地址带 'uploads/' 前缀，仍然兼容）
+    # size 参数选择尺寸档位：'thumb' / 'preview' 为生成并缓存的缩小图，'full'（默认）为原图
     if filepath.startswith('uploads/'):
         filepath = filepath[len('uploads/'):]
+    size = request.args.get('size', 'full')
+    if size not in IMAGE_SIZE_TIERS:
+        return "Unknown image size", 400
+
+    uploads_base_dir = _uploads_base_dir()
+    # safe_join 拒绝 '..' 和绝对路径，防止目录穿越
+    source_path = safe_join(uploads_base_dir, filepath)
+    if source_path is None or not os.path.isfile(source_path):
+        logging.warning(f"Requested image not found: '{filepath}'")
+        return "File not found", 404
 
-    # send_from_directory's first argument is the directory, second is the filename
-    # We need to serve 'pdf_images/...' from the 'uploads' directory
-    # So, the directory is 'uploads', and the filename is 'pdf_images/...'
-    # Or, the directory is 'uploads/pdf_images', and the filename is 'filename_images/page_1.png'
-    # Let's assume filepath is 'pdf_images/filename_images/page_1.png'
-    # Then we serve it from the 'uploads' directory
-    logging.info(f"Attempting to serve file: directory='{uploads_base_dir}', filepath='{filepath}'")
+    variant_path = None
+    if size != 'full' and image_variants:
+        variant_path = image_variants.get_image_variant(source_path, size)
     try:
-        return send_from_directory(uploads_base_dir, filepath)
-    except Exception as e:
+        # conditional=True 时 send_file 会设置 ETag / Last-Modified，并对 If-None-Match 等条件请求返回 304
+        return send_file(os.path.abspath(variant_path or source_path), conditional=True, etag=True, max_age=IMAGE_CACHE_MAX_AGE)
+    except OSError as e:
         logging.error(f"Error serving file {filepath}: {e}")
         return "File not found", 404
 
@@ -0,0 +1,211 @@
+"""
+性能基准脚本。
+
+用法:
+    python benchmark.py codecs [sample.pdf ...] [--dpi 300] [--pages 5] [--codecs PNG,JPEG:85,WEBP:85]
+                               [--max-long-edge 2048] [--max-pixels 0] [--simulate-scan]
+
+    python benchmark.py limiter [--waiters 1000] [--rate 2000] [--burst 10]
+
+    python benchmark.py gemini-model [--calls 2000] [--prompt-chars 2000]
+
+codecs: 比较各上传编码在样例页面上的载荷大小 (含 base64 膨胀) 和编码耗时。
+        未提供 PDF 时使用内置生成的文字样例页；--simulate-scan 为页面加入模糊和噪声，
+        近似扫描件（矢量文字页面上无损 PNG 往往最小，扫描件上 JPEG/WebP 优势明显）。
+limiter: 大量协程同时等待令牌时，比较 AsyncTokenBucketRateLimiter 与轮询式 consume_async 的
+         CPU 开销、放行时间相对理想时间表的误差以及是否按 FIFO 顺序放行。
+gemini-model: 比较每页新建 genai.GenerativeModel 与使用 GeminiClient 缓存实例的每次调用准备开销
+              (不发送网络请求)。
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageFilter
+
+import pdf_processor
+import rate_limiter
+
+DEFAULT_CODECS = "PNG,JPEG:85,JPEG:70,WEBP:85,WEBP:70"
+
+
+def _sample_document():
+    """生成几页排版密集的文字样例，用于没有真实 PDF 时的基准。"""
+    doc = fitz.open()
+    paragraph = ("The quick brown fox jumps over the lazy dog. 0123456789 "
+                 "Invoice total, tax and shipping are listed in the table below. ") * 12
+    for page_index in range(3):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(54, 54, 558, 420), f"Sample page {page_index + 1}\n\n{paragraph}", fontsize=10)
+        for row in range(12):
+            y = 440 + row * 24
+            page.draw_rect(fitz.Rect(54, y, 558, y + 24), color=(0, 0, 0), width=0.5)
+            page.insert_text((60, y + 16), f"Item {row + 1:02d}    qty {row * 3 + 1}    unit price {row * 7.5:.2f}", fontsize=9)
+    return doc
+
+
+def _parse_codecs(spec):
+    codecs = []
+    for item in spec.split(','):
+        name, _, quality = item.strip().partition(':')
+        if name:
+            codecs.append((name.upper(), int(quality) if quality else None))
+    return codecs
+
+
+def _simulate_scan(img):
+    """轻微模糊并叠加灰度噪声，近似扫描件的纸张纹理。"""
+    noise = Image.effect_noise(img.size, 24).convert('RGB')
+    return Image.blend(img.filter(ImageFilter.GaussianBlur(0.7)), noise, 0.08)
+
+
+def _load_sample_pages(pdf_paths, dpi, max_pages, resolution_budget, simulate_scan=False):
+    """按基准参数把样例页面渲染为 PIL 图像列表。"""
+    documents = [(path, fitz.open(path)) for path in pdf_paths] or [("<generated sample>", _sample_document())]
+    images = []
+    for label, doc in documents:
+        try:
+            for page_num in range(min(len(doc), max_pages)):
+                page = doc.load_page(page_num)
+                pix = page.get_pixmap(dpi=pdf_processor.budgeted_dpi(page, dpi, resolution_budget))
+                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                images.append(_simulate_scan(img) if simulate_scan else img)
+        finally:
+            doc.close()
+        print(f"Loaded {label}")
+    return images
+
+
+def run_codecs(args):
+    resolution_budget = (args.max_long_edge, args.max_pixels) if (args.max_long_edge or args.max_pixels) else None
+    images = _load_sample_pages(args.pdf, args.dpi, args.pages, resolution_budget, args.simulate_scan)
+    if not images:
+        print("No pages to benchmark.")
+        return 1
+    print(f"{len(images)} pages, first page {images[0].width}x{images[0].height} px\n")
+
+    rows = []
+    for codec, quality in _parse_codecs(args.codecs):
+        sizes, timings = [], []
+        for img in images:
+            start = time.perf_counter()
+            data = pdf_processor.encode_image(img, codec, quality)
+            timings.append(time.perf_counter() - start)
+            sizes.append(len(data))
+        label = f"{codec}:{quality}" if quality and codec in ('JPEG', 'JPG', 'WEBP') else codec
+        b64_total = sum(4 * -(-size // 3) for size in sizes) # data URL 中的 base64 长度
+        rows.append((label, sum(sizes), b64_total, statistics.mean(timings) * 1000, max(timings) * 1000))
+
+    baseline = rows[0][1]
+    print(f"{'codec':<10} {'bytes':>12} {'base64':>12} {'vs first':>9} {'enc ms/pg':>10} {'max ms':>8}")
+    for label, total, b64_total, mean_ms, max_ms in rows:
+        print(f"{label:<10} {total:>12,} {b64_total:>12,} {total / float(baseline):>8.2f}x {mean_ms:>10.1f} {max_ms:>8.1f}")
+    return 0
+
+
+async def _run_waiters(acquire, waiters):
+    """同时启动 waiters 个协程获取 1 个令牌，返回 (按完成顺序的协程序号, 相对开始的放行时间)。"""
+    loop = asyncio.get_running_loop()
+    grant_order, grant_times = [], [None] * waiters
+    ready = asyncio.Event()
+
+    async def waiter(index):
+        await ready.wait()
+        await acquire(1)
+        grant_times[index] = loop.time() - start
+        grant_order.append(index)
+
+    tasks = [asyncio.ensure_future(waiter(index)) for index in range(waiters)]
+    await asyncio.sleep(0) # 让所有协程先就位，再同时开始获取令牌
+    start = loop.time()
+    ready.set()
+    await asyncio.gather(*tasks)
+    return grant_order, grant_times
+
+
+def run_limiter(args):
+    # 理想时间表：前 burst 个立即放行，之后第 i 个在 (i + 1 - burst) / rate 秒放行
+    ideal = [max(0.0, (index + 1 - args.burst) / float(args.rate)) for index in range(args.waiters)]
+    limiters = [
+        ("async (FIFO timer)", lambda: rate_limiter.AsyncTokenBucketRateLimiter(args.rate, args.burst), 'acquire'),
+        ("sync consume_async", lambda: rate_limiter.TokenBucketRateLimiter(args.rate, args.burst), 'consume_async'),
+    ]
+    print(f"{args.waiters} concurrent waiters, {args.rate} tokens/s, burst {args.burst}, "
+          f"ideal makespan {ideal[-1] * 1000:.1f} ms\n")
+    print(f"{'limiter':<20} {'wall ms':>9} {'cpu ms':>8} {'mean err ms':>12} {'p99 err ms':>11} {'max err ms':>11} {'fifo':>5}")
+    for label, factory, method in limiters:
+        limiter = factory()
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        grant_order, grant_times = asyncio.run(_run_waiters(getattr(limiter, method), args.waiters))
+        wall_ms = (time.perf_counter() - wall_start) * 1000
+        cpu_ms = (time.process_time() - cpu_start) * 1000
+        # 第 k 个被放行的请求对应理想时间表的第 k 个时刻
+        errors = sorted(abs(grant_times[index] - ideal[rank]) * 1000 for rank, index in enumerate(grant_order))
+        fifo = grant_order == sorted(grant_order)
+        print(f"{label:<20} {wall_ms:>9.1f} {cpu_ms:>8.1f} {statistics.mean(errors):>12.3f} "
+              f"{errors[int(len(errors) * 0.99) - 1]:>11.3f} {errors[-1]:>11.3f} {str(fifo):>5}")
+    return 0
+
+
+def run_gemini_model(args):
+    import google.generativeai as genai
+    import gemini_client
+
+    client = gemini_client.GeminiClient("benchmark-key")
+    model_name = gemini_client.GEMINI_VISION_MODEL
+    prompt = ("请逐字识别页面中的全部文字，保留原有段落和表格结构。" * (args.prompt_chars // 24 + 1))[:args.prompt_chars]
+
+    def uncached():
+        model = genai.GenerativeModel(model_name, system_instruction=prompt)
+        model._client = client.generative_client
+        return model
+
+    def cached():
+        return client.generative_model(model_name, system_instruction=prompt)
+
+    print(f"{args.calls} calls, model {model_name}, system prompt {len(prompt)} chars\n")
+    print(f"{'factory':<22} {'total ms':>9} {'us/call':>9}")
+    for label, factory in (("new GenerativeModel", uncached), ("cached (GeminiClient)", cached)):
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            factory()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<22} {elapsed * 1000:>9.1f} {elapsed / args.calls * 1e6:>9.1f}")
+    client.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pdf-ocr performance benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    codecs_parser = subparsers.add_parser('codecs', help="compare upload payload size and encode time per codec")
+    codecs_parser.add_argument('pdf', nargs='*', help="sample PDF files (default: generated text pages)")
+    codecs_parser.add_argument('--dpi', type=int, default=300)
+    codecs_parser.add_argument('--pages', type=int, default=5, help="max pages per PDF")
+    codecs_parser.add_argument('--codecs', default=DEFAULT_CODECS, help="comma separated FORMAT[:quality] list")
+    codecs_parser.add_argument('--max-long-edge', type=int, default=0, help="resolution budget, see IMAGE_RESOLUTION_BUDGETS")
+    codecs_parser.add_argument('--max-pixels', type=int, default=0)
+    codecs_parser.add_argument('--simulate-scan', action='store_true', help="add blur and noise to approximate scanned pages")
+    codecs_parser.set_defaults(func=run_codecs)
+
+    limiter_parser = subparsers.add_parser('limiter', help="async token bucket overhead and accuracy")
+    limiter_parser.add_argument('--waiters', type=int, default=1000)
+    limiter_parser.add_argument('--rate', type=float, default=2000, help="tokens per second")
+    limiter_parser.add_argument('--burst', type=int, default=10, help="bucket size")
+    limiter_parser.set_defaults(func=run_limiter)
+
+    gemini_parser = subparsers.add_parser('gemini-model', help="per-call GenerativeModel setup cost, cached vs uncached")
+    gemini_parser.add_argument('--calls', type=int, default=2000)
+    gemini_parser.add_argument('--prompt-chars', type=int, default=2000, help="system prompt length")
+    gemini_parser.set_defaults(func=run_gemini_model)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
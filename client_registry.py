@@ -0,0 +1,140 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Pooled SDK clients: at most LLM_CLIENT_POOL_SIZE per registry, dropped after
+# LLM_CLIENT_IDLE_SECONDS without use (0 = never evict for idleness)
+LLM_CLIENT_POOL_SIZE = int(os.getenv("LLM_CLIENT_POOL_SIZE", "16"))
+LLM_CLIENT_IDLE_SECONDS = float(os.getenv("LLM_CLIENT_IDLE_SECONDS", "300"))
+
+
+def close_on_loop(loop, close):
+    """
+    Returns a zero-argument release callable for a client bound to an event loop.
+
+    close() must return the coroutine that closes the client (e.g. httpx.AsyncClient.aclose);
+    it is scheduled on loop from whichever thread runs the release. A client whose loop has
+    already been closed cannot be awaited any more, so there is nothing left to do for it.
+    """
+    def _release():
+        if loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(close(), loop)
+    return _release
+
+
+class ClientRegistry:
+    """
+    A bounded LRU registry of SDK clients keyed by credentials and endpoint.
+
+    Each client owns an HTTP connection pool, so reusing it across pages keeps
+    TLS sessions and keep-alive connections warm. Entries unused for
+    idle_seconds are evicted on the next lookup; when the registry is full the
+    least recently used entry is evicted.
+
+    An evicted client may still be in use by another thread (a long streaming
+    response, or a retry loop holding it), so it is never closed directly.
+    When `release` is provided, release(client) must return a zero-argument
+    callable that frees the client's connections without referencing the
+    client itself; it runs once the last reference to the evicted client is
+    gone, which is immediately if no request holds it.
+    """
+    def __init__(self, name, max_size=LLM_CLIENT_POOL_SIZE, idle_seconds=LLM_CLIENT_IDLE_SECONDS, release=None):
+        self.name = name
+        self.max_size = max(1, max_size)
+        self.idle_seconds = idle_seconds
+        self._release = release
+        self._entries = OrderedDict() # key -> [client, last_used]
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def get(self, key, factory, is_stale=None):
+        """
+        Returns the client for key, creating it with factory() on a miss.
+
+        Args:
+            key: hashable key, e.g. (api_key, base_url).
+            factory: zero-argument callable creating a new client.
+            is_stale: optional predicate(key) -> bool; matching entries are
+                      evicted regardless of age (e.g. async clients whose event
+                      loop has been closed).
+        """
+        now = time.monotonic()
+        idle = []
+        with self._lock:
+            self._evict_idle(now, idle, is_stale)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = now
+                self._entries.move_to_end(key)
+                self.reused += 1
+                client = entry[0]
+            else:
+                client = None
+        self._retire(idle)
+        if client is not None:
+            return client
+
+        # Build outside the lock: creating a client can take a while (proxy/env lookups)
+        client = factory()
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: # Another thread won the race; use its client
+                entry[1] = now
+                self._entries.move_to_end(key)
+                winner = entry[0]
+            else:
+                winner = None
+                self._entries[key] = [client, now]
+                self.created += 1
+                while len(self._entries) > self.max_size:
+                    evicted.append(self._entries.popitem(last=False)[1][0])
+        if winner is not None:
+            self._retire([client])
+            return winner
+        self._retire(evicted)
+        logging.info(f"{self.name}: created client #{self.created} ({len(self._entries)} pooled).")
+        return client
+
+    def _evict_idle(self, now, evicted, is_stale):
+        for key in list(self._entries):
+            client, last_used = self._entries[key]
+            if (self.idle_seconds and now - last_used > self.idle_seconds) or (is_stale and is_stale(key)):
+                del self._entries[key]
+                evicted.append(client)
+
+    def _retire(self, clients):
+        # Called outside the lock. Closing is deferred to when the client becomes unreachable,
+        # so a request still holding it finishes on an open connection pool.
+        if not self._release:
+            return
+        for client in clients:
+            try:
+                weakref.finalize(client, self._release_safely, self._release(client))
+            except Exception as e:
+                logging.warning(f"{self.name}: could not schedule release of evicted client: {e}")
+
+    def _release_safely(self, release):
+        try:
+            release()
+        except Exception as e:
+            logging.warning(f"{self.name}: error closing evicted client: {e}")
+
+    def clear(self):
+        with self._lock:
+            clients = [entry[0] for entry in self._entries.values()]
+            self._entries.clear()
+        self._retire(clients)
+
+    def stats(self):
+        with self._lock:
+            return {'name': self.name, 'pooled': len(self._entries), 'created': self.created, 'reused': self.reused}
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 整份文档的结果索引：相同 PDF 在相同提供商/模型/提示词下重新上传时直接复用上次的结果，不渲染也不调用 LLM；
+# 同名文档的新版本按页面内容指纹复用上一版本中未修改页面的结果
+DOCUMENT_INDEX_ENABLED = os.getenv('DOCUMENT_INDEX_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+DOCUMENT_INDEX_PATH = os.getenv('DOCUMENT_INDEX_PATH', 'uploads/cache/documents.sqlite3')
+DOCUMENT_INDEX_TTL_SECONDS = int(os.getenv('DOCUMENT_INDEX_TTL_SECONDS', 30 * 24 * 3600)) # 默认 30 天，0 表示永不过期
+
+UPLOAD_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def save_and_hash_upload(file_storage, destination):
+    """
+    把上传文件逐块写入 destination，同时计算内容的 SHA-256，不需要再次读取整个文件。
+
+    参数:
+    file_storage: werkzeug 的 FileStorage（或任何带 stream 属性的上传对象）。
+    destination (str): 保存路径。
+
+    返回:
+    str: 文件内容的 SHA-256 十六进制摘要。
+    """
+    digest = hashlib.sha256()
+    with open(destination, 'wb') as out:
+        while True:
+            chunk = file_storage.stream.read(UPLOAD_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+def _hash_fields(*fields):
+    # 各字段带长度前缀后拼接（与 result_cache.make_cache_key 相同），避免不同字段组合产生相同的输入
+    digest = hashlib.sha256()
+    for field in fields:
+        encoded = (field or '').encode('utf-8')
+        digest.update(len(encoded).to_bytes(8, 'big'))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+def make_variant_key(provider, model_name, system_prompt, user_prompt=None, endpoint=None, options=None):
+    """计算分析配置键：提供商/端点 + 模型名 + 提示词 + 影响结果的处理选项的 SHA-256。"""
+    options_json = json.dumps(options or {}, sort_keys=True, ensure_ascii=False)
+    return _hash_fields(provider, endpoint, model_name, system_prompt, user_prompt, options_json)
+
+
+def make_document_key(document_hash, variant_key):
+    """计算整份文档的索引键：文档内容哈希 + 分析配置键。"""
+    return _hash_fields(document_hash, variant_key)
+
+
+class DocumentIndex:
+    """
+    基于 SQLite 的整份文档结果索引。
+
+    以 make_document_key 计算的键保存一个文件全部页面的分析结果（JSON），同时记录文档哈希和分析配置键；
+    超过 ttl_seconds 的条目视为过期。
+    数据库可被多个工作进程共享。
+    """
+    def __init__(self, db_path, ttl_seconds=DOCUMENT_INDEX_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " document_key TEXT PRIMARY KEY,"
+                " document_hash TEXT NOT NULL,"
+                " variant_key TEXT NOT NULL,"
+                " filename TEXT NOT NULL,"
+                " page_count INTEGER NOT NULL,"
+                " page_analyses TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_created ON documents (created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_versions ON documents (variant_key, filename, created_at)")
+        logging.info(f"Document index ready at {db_path} (TTL {ttl_seconds}s).")
+
+    def _connection(self):
+        # 每个线程使用独立连接；WAL 模式允许多进程并发读写
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _expiry_cutoff(self):
+        return time.time() - self.ttl_seconds if self.ttl_seconds else 0
+
+    def get(self, document_key):
+        """
+        返回索引中的文档结果；未命中或已过期时返回 None。
+
+        返回:
+        dict | None: {'filename', 'page_count', 'page_analyses', 'created_at'}
+        """
+        now = time.time()
+        try:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "SELECT filename, page_count, page_analyses, created_at FROM documents WHERE document_key = ? AND created_at >= ?",
+                    (document_key, self._expiry_cutoff())
+                ).fetchone()
+                if row:
+                    conn.execute("UPDATE documents SET last_access = ? WHERE document_key = ?", (now, document_key))
+        except sqlite3.Error as e:
+            logging.error(f"Document index read failed: {e}")
+            row = None
+
+        with self._stats_lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not row:
+            return None
+        filename, page_count, page_analyses, created_at = row
+        return {'filename': filename, 'page_count': page_count, 'page_analyses': json.loads(page_analyses), 'created_at': created_at}
+
+    def find_previous_version(self, filename, variant_key, exclude_document_hash=None):
+        """
+        返回同名文档在相同分析配置下最近一次保存的结果（视为上一版本），用于增量分析修改过的文档。
+
+        参数:
+        filename (str): 上传时的文件名。
+        variant_key (str): 分析配置键（见 make_variant_key）。
+        exclude_document_hash (str): 可选，排除内容哈希相同的条目（即当前版本本身）。
+
+        返回:
+        dict | None: 与 get 相同的格式；没有上一版本时返回 None。
+        """
+        try:
+            row = self._connection().execute(
+                "SELECT filename, page_count, page_analyses, created_at FROM documents "
+                "WHERE variant_key = ? AND filename = ? AND document_hash != ? AND created_at >= ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (variant_key, filename, exclude_document_hash or '', self._expiry_cutoff())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Document index lookup of previous version of '{filename}' failed: {e}")
+            return None
+        if not row:
+            return None
+        filename, page_count, page_analyses, created_at = row
+        return {'filename': filename, 'page_count': page_count, 'page_analyses': json.loads(page_analyses), 'created_at': created_at}
+
+    def put(self, document_key, document_hash, variant_key, filename, page_analyses):
+        """保存一个文件全部页面的分析结果，并清理过期条目。"""
+        now = time.time()
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO documents (document_key, document_hash, variant_key, filename, page_count, page_analyses, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (document_key, document_hash, variant_key, filename, len(page_analyses), json.dumps(page_analyses, ensure_ascii=False), now, now)
+                )
+                if self.ttl_seconds:
+                    conn.execute("DELETE FROM documents WHERE created_at < ?", (self._expiry_cutoff(),))
+        except sqlite3.Error as e:
+            logging.error(f"Document index write failed for '{filename}': {e}")
+
+    def stats(self):
+        try:
+            entries = self._connection().execute(
+                "SELECT COUNT(*) FROM documents WHERE created_at >= ?", (self._expiry_cutoff(),)
+            ).fetchone()[0]
+        except sqlite3.Error as e:
+            logging.error(f"Document index stats failed: {e}")
+            entries = None
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        return {'enabled': True, 'hits': hits, 'misses': misses, 'entries': entries, 'ttl_seconds': self.ttl_seconds}
+
+
+_document_index = None
+_document_index_lock = threading.Lock()
+
+
+def get_document_index():
+    """返回进程内共享的 DocumentIndex；索引被禁用或无法初始化时返回 None。"""
+    global _document_index
+    if not DOCUMENT_INDEX_ENABLED:
+        return None
+    with _document_index_lock:
+        if _document_index is None:
+            try:
+                _document_index = DocumentIndex(DOCUMENT_INDEX_PATH)
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Could not initialize document index at {DOCUMENT_INDEX_PATH}: {e}")
+                return None
+        return _document_index
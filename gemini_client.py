@@ -1,14 +1,21 @@
 import os
+import re
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 import google.api_core.exceptions # For specific API error handling
 from PIL import Image, UnidentifiedImageError
 from dotenv import load_dotenv
 import logging
 import traceback
+import threading
+import weakref
+from collections import OrderedDict
 import asyncio # For async operations
 import httpx # For async client if google-generativeai doesn't provide one directly for all operations
 
-from rate_limiter import TokenBucketRateLimiter
+import rate_limiter
+import retry_policy
+import client_registry
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s - %(module)s - %(message)s')
@@ -72,11 +79,164 @@ GEMINI_TEXT_MODEL = os.getenv("GEMINI_TEXT_MODEL", "gemini-1.0-pro") # 或者例
 logger.info(f"Using Gemini Vision Model: {GEMINI_VISION_MODEL}")
 logger.info(f"Using Gemini Text Model (for tests/future use): {GEMINI_TEXT_MODEL}")
 
-# Rate Limiter Configuration
-# API_CALLS_PER_SECOND = float(os.getenv("API_CALLS_PER_SECOND", "1")) # e.g., 1 call per second
-# API_MAX_TOKENS = float(os.getenv("API_MAX_TOKENS", "5")) # e.g., burst up to 5 calls
-# gemini_rate_limiter = TokenBucketRateLimiter(tokens_per_second=API_CALLS_PER_SECOND, max_tokens=API_MAX_TOKENS)
-# logger.info(f"Gemini rate limiter configured: {API_CALLS_PER_SECOND} tokens/sec, max {API_MAX_TOKENS} tokens.")
+# Rate limits, applied per API key (0 = unlimited)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "500"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+# Tokens reserved from the TPM bucket before each request; corrected from usage_metadata afterwards
+GEMINI_TOKENS_PER_REQUEST_ESTIMATE = int(os.getenv("GEMINI_TOKENS_PER_REQUEST_ESTIMATE", "1500"))
+logger.info(f"Gemini rate limits: {GEMINI_RPM or 'unlimited'} RPM, {GEMINI_TPM or 'unlimited'} TPM per API key.")
+# GenerativeModel instances kept per API key, keyed by (model, system prompt); a batch reuses one
+GEMINI_MODEL_CACHE_SIZE = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "32"))
+
+# GeminiClient relies on private google-generativeai internals (see requirements.txt);
+# this is the version they were verified against
+GENAI_TESTED_VERSION = "0.8.6"
+if genai.__version__ != GENAI_TESTED_VERSION:
+    logger.warning(f"google-generativeai {genai.__version__} is installed but GeminiClient was verified against "
+                   f"{GENAI_TESTED_VERSION}; per-key clients use private SDK internals and may break.")
+if not hasattr(genai_client, "_ClientManager"):
+    logger.error(f"google-generativeai {genai.__version__} no longer provides client._ClientManager, "
+                 f"which GeminiClient needs; install google-generativeai=={GENAI_TESTED_VERSION}.")
+
+
+class GeminiClient:
+    """
+    Gemini API clients bound to one API key.
+
+    genai.configure() changes process-wide state, so swapping keys per request
+    leaks one user's key into another user's concurrent request. Each
+    GeminiClient owns a private client manager configured with its own key and
+    transport, and attaches its service clients to the models it creates.
+    """
+    def __init__(self, api_key, transport=None):
+        self.api_key = api_key
+        self._manager = genai_client._ClientManager()
+        self._manager.configure(api_key=api_key, transport=transport)
+        self.generative_client = self._manager.get_default_client("generative")
+        self._models = OrderedDict() # (model_name, system_instruction, async_client) -> GenerativeModel
+        self._models_lock = threading.Lock()
+
+    def generative_model(self, model_name, system_instruction=None, async_client=None):
+        """
+        Returns a GenerativeModel that sends its requests with this client's key.
+
+        Models are memoized (LRU, GEMINI_MODEL_CACHE_SIZE entries): the model name and
+        system prompt are the same for every page of a batch, and a GenerativeModel
+        holds no per-request state, so one instance is shared by concurrent calls.
+        """
+        key = (model_name, system_instruction, async_client)
+        with self._models_lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        model._client = self.generative_client
+        model._async_client = async_client
+        with self._models_lock:
+            model = self._models.setdefault(key, model)
+            self._models.move_to_end(key)
+            while len(self._models) > max(1, GEMINI_MODEL_CACHE_SIZE):
+                self._models.popitem(last=False)
+        return model
+
+    def make_async_client(self):
+        # Async (grpc_asyncio) channels are bound to the event loop they are used on
+        loop = asyncio.get_running_loop()
+        async_client = self._manager.make_client("generative_async")
+        _async_client_loops[async_client] = loop
+        return async_client
+
+    def list_models(self):
+        return genai.list_models(client=self._manager.get_default_client("model"))
+
+    def closer(self):
+        """
+        Returns a callable closing the transports of every service client this key has
+        opened (generative, model, ...). It holds the client manager, not this object,
+        so it can run as a finalizer once the GeminiClient is gone.
+        """
+        service_clients = self._manager.clients # Filled lazily, so read it when closing
+
+        def _close():
+            for service_client in list(service_clients.values()):
+                transport = getattr(service_client, "transport", None)
+                if transport is not None:
+                    transport.close()
+        return _close
+
+    def close(self):
+        self.closer()()
+
+
+_client_registry = client_registry.ClientRegistry("Gemini clients", release=lambda client: client.closer())
+_async_client_loops = weakref.WeakKeyDictionary() # async service client -> the event loop its channel is bound to
+_async_client_registry = client_registry.ClientRegistry(
+    "Gemini async clients",
+    release=lambda client: client_registry.close_on_loop(_async_client_loops[client], client.transport.close)
+)
+
+
+def get_gemini_client(api_key):
+    """Returns the pooled GeminiClient for this API key."""
+    return _client_registry.get(api_key, lambda: GeminiClient(api_key))
+
+
+def get_async_generative_client(gemini_client):
+    """Returns the pooled async generative service client for this key on the running event loop."""
+    loop = asyncio.get_running_loop()
+    return _async_client_registry.get((loop, gemini_client.api_key), gemini_client.make_async_client,
+                                      is_stale=lambda key: key[0].is_closed())
+
+
+def _rate_limits(api_key):
+    return rate_limiter.get_provider_limits("gemini", None, api_key, GEMINI_RPM, GEMINI_TPM, GEMINI_TOKENS_PER_REQUEST_ESTIMATE)
+
+
+def _usage_total_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
+
+
+RETRY_POLICY = retry_policy.RetryPolicy()
+# Transient errors worth retrying: timeouts, 5xx, and 429 / ResourceExhausted
+_RETRYABLE_ERRORS = (
+    google.api_core.exceptions.DeadlineExceeded,
+    google.api_core.exceptions.ServiceUnavailable,
+    google.api_core.exceptions.InternalServerError,
+    google.api_core.exceptions.BadGateway,
+    google.api_core.exceptions.GatewayTimeout,
+    google.api_core.exceptions.TooManyRequests,
+    ConnectionError,
+)
+
+
+def _is_retryable_error(error):
+    return isinstance(error, _RETRYABLE_ERRORS)
+
+
+def _counts_as_outage(error):
+    # A 429 / quota error means the endpoint is up; AIMD handles it, not the circuit breaker
+    return not isinstance(error, google.api_core.exceptions.TooManyRequests)
+
+
+def _retry_after_seconds(error):
+    """
+    Extracts the server-suggested retry delay from a 429 / ResourceExhausted error:
+    a google.rpc.RetryInfo detail, a Retry-After header, or "retry in 12.3s" in the message.
+    """
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    match = re.search(r"retry in ([0-9.]+)\s*s", str(error), re.IGNORECASE)
+    return float(match.group(1)) if match else None
 
 def test_text_generation():
     logger.info("--- Starting Text Generation Test ---")
@@ -113,129 +273,303 @@ def test_text_generation():
     finally:
         logger.info("--- Finished Text Generation Test ---")
 
-def analyze_image(image_path, user_prompt=None, system_prompt_override=None, api_key_override=None, model_name_override=None):
-    original_env_api_key = GEMINI_API_KEY # Store the key from .env, if any
-    temporarily_configured_with_override_key = False
-    
-    current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else original_env_api_key
+def _build_image_part(image_path=None, image_bytes=None, image_mime_type=None):
+    """
+    Returns the image content part for generate_content.
+
+    In-memory image bytes are sent as an inline blob, skipping the disk read and PIL decode.
+    Otherwise the image file is opened with PIL as before.
+    """
+    if image_bytes is not None:
+        return {"mime_type": image_mime_type or "image/png", "data": image_bytes}
+    img = Image.open(image_path)
+    img.load() # Ensure image data is loaded
+    logger.debug(f"Image loaded: {image_path}, format: {img.format}, mode: {img.mode}, size: {img.size}")
+    return img
+
+def analyze_image(image_path=None, user_prompt=None, system_prompt_override=None, api_key_override=None, model_name_override=None, image_bytes=None, image_mime_type=None):
+    """
+    Analyzes an image using the Gemini API.
+    Pass either image_path, or already-encoded image_bytes (with image_mime_type) to skip disk I/O;
+    image_path is then only used as a label in logs and error messages.
+    """
+    image_label = image_path or "in-memory image"
+    current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else GEMINI_API_KEY
 
     if not current_api_key_to_use:
         logger.error("No Gemini API key provided (neither in .env nor via UI). Cannot analyze image.")
         return "Error: Gemini API key not configured."
 
+    limits = _rate_limits(current_api_key_to_use)
+    breaker = retry_policy.get_circuit_breaker("gemini")
     try:
-        # Configure API key if override is provided and different from .env key, or if .env key was not set
-        if api_key_override and api_key_override.strip() and api_key_override != original_env_api_key:
-            logger.info(f"Temporarily configuring genai with API key provided via UI.")
-            genai.configure(api_key=api_key_override)
-            temporarily_configured_with_override_key = True
-        elif not original_env_api_key and api_key_override and api_key_override.strip(): # .env key was empty, UI key provided
-            logger.info(f"Configuring genai with API key provided via UI (no .env key was set).")
-            genai.configure(api_key=api_key_override)
-            # No need to "restore" if original_env_api_key was None/empty
-        elif not genai.API_KEY: # If somehow not configured yet (e.g. .env key was empty and no override)
-             logger.info(f"Configuring genai with current_api_key_to_use as it was not configured.")
-             genai.configure(api_key=current_api_key_to_use)
-
+        # The key travels with the client, so concurrent requests with different keys don't interfere
+        gemini = get_gemini_client(current_api_key_to_use)
 
         final_system_prompt = DEFAULT_SYSTEM_PROMPT
         if system_prompt_override and system_prompt_override.strip():
             final_system_prompt = system_prompt_override.strip()
-            logger.info(f"Using system_prompt_override for '{image_path}'.")
+            logger.info(f"Using system_prompt_override for '{image_label}'.")
 
         request_options = {"timeout": 60}
-        logger.info(f"Analyzing image: {image_path} with system prompt: \"{final_system_prompt[:100]}...\"")
-        logger.debug(f"Opening image: {image_path}")
-        img = Image.open(image_path)
-        img.load()
-        logger.debug(f"Image loaded: {image_path}, format: {img.format}, mode: {img.mode}, size: {img.size}")
+        logger.info(f"Analyzing image: {image_label} with system prompt: \"{final_system_prompt[:100]}...\"")
+        image_part = _build_image_part(image_path, image_bytes, image_mime_type)
         
         # Model selection
         model_to_use = model_name_override if model_name_override and model_name_override.strip() else GEMINI_VISION_MODEL
         logger.info(f"Using Gemini vision model: {model_to_use}")
         
-        model = genai.GenerativeModel(model_to_use, system_instruction=final_system_prompt)
+        model = gemini.generative_model(model_to_use, system_instruction=final_system_prompt)
         
         content_parts = []
         if user_prompt and user_prompt.strip():
             content_parts.append(user_prompt.strip())
-        content_parts.append(img)
-
-        # Consume a token before making the API call
-        # if not gemini_rate_limiter.consume(1):
-        #     logger.warning(f"Rate limit exceeded for {image_path}. Waiting for token...")
-        #     # Simple busy wait; in a real async scenario, this would be handled differently
-        #     # For synchronous, we might just wait or raise an error.
-        #     # For this example, let's try to wait once.
-        #     import time # Make sure time is imported if not already at top level
-        #     time.sleep(1.0 / gemini_rate_limiter.tokens_per_second if gemini_rate_limiter.tokens_per_second > 0 else 1.0)
-        #     if not gemini_rate_limiter.consume(1):
-        #         logger.error(f"Still rate limited after waiting for {image_path}. Aborting call.")
-        #         return f"Error: Rate limit exceeded for {image_path}."
-        # logger.info(f"Token consumed for {image_path}. Proceeding with API call.")
-
-        logger.info(f"Sending request to Gemini API (model: {model_to_use}) for image '{image_path}' with timeout: {request_options['timeout']}s...")
+        content_parts.append(image_part)
+
+        logger.info(f"Sending request to Gemini API (model: {model_to_use}) for image '{image_label}' with timeout: {request_options['timeout']}s...")
         logger.debug(f"Content parts for API: {content_parts}")
-        
-        response = model.generate_content(content_parts, request_options=request_options)
-        logger.debug(f"Raw response from Gemini API for '{image_path}': {response}")
+
+        def _send():
+            # Every attempt waits for room in this key's RPM and TPM budgets
+            limits.acquire(GEMINI_TOKENS_PER_REQUEST_ESTIMATE)
+            try:
+                response = model.generate_content(content_parts, request_options=request_options)
+            except google.api_core.exceptions.TooManyRequests as tmr:
+                limits.on_rate_limited(_retry_after_seconds(tmr))
+                raise
+            limits.record_usage(GEMINI_TOKENS_PER_REQUEST_ESTIMATE, _usage_total_tokens(response))
+            limits.on_success()
+            return response
+
+        response = retry_policy.call_with_retry(_send, RETRY_POLICY, breaker, _is_retryable_error, _counts_as_outage, label=image_label)
+        logger.debug(f"Raw response from Gemini API for '{image_label}': {response}")
         if response and response.parts:
             if hasattr(response.parts[0], 'text') and response.parts[0].text is not None:
-                logger.info(f"Successfully extracted text from response.parts[0] for '{image_path}'.")
+                logger.info(f"Successfully extracted text from response.parts[0] for '{image_label}'.")
                 return response.parts[0].text.strip()
             else: 
                 if response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason_message') and response.prompt_feedback.block_reason_message:
                     block_msg = response.prompt_feedback.block_reason_message
-                    logger.warning(f"Content generation for '{image_path}' blocked by API (prompt_feedback): {block_msg}")
+                    logger.warning(f"Content generation for '{image_label}' blocked by API (prompt_feedback): {block_msg}")
                     return f"Error: Content generation blocked - {block_msg}"
                 if response.candidates:
                     for i, candidate in enumerate(response.candidates):
-                        logger.debug(f"Checking candidate {i} for '{image_path}': {candidate}")
+                        logger.debug(f"Checking candidate {i} for '{image_label}': {candidate}")
                         if hasattr(candidate, 'finish_reason') and candidate.finish_reason != 'STOP' and candidate.finish_reason != 'FINISH_REASON_UNSPECIFIED':
                             reason = candidate.finish_reason
                             safety_ratings_str = f" Safety ratings: {candidate.safety_ratings}" if hasattr(candidate, 'safety_ratings') else ""
-                            error_msg = f"Content generation for '{image_path}' stopped. Finish reason: {reason}.{safety_ratings_str}"
+                            error_msg = f"Content generation for '{image_label}' stopped. Finish reason: {reason}.{safety_ratings_str}"
                             logger.warning(error_msg)
                             return f"Error: {error_msg}"
-                logger.error(f"No text in response.parts[0] for '{image_path}' and no clear blocking reason. Parts: {response.parts}")
-                return f"Error: No text found in Gemini API response part for '{image_path}'."
+                logger.error(f"No text in response.parts[0] for '{image_label}' and no clear blocking reason. Parts: {response.parts}")
+                return f"Error: No text found in Gemini API response part for '{image_label}'."
         elif response and hasattr(response, 'text') and response.text is not None: 
-            logger.info(f"Successfully extracted text from response.text (fallback) for '{image_path}'.")
+            logger.info(f"Successfully extracted text from response.text (fallback) for '{image_label}'.")
             return response.text.strip()
-        logger.error(f"Unexpected response structure or empty response from Gemini API for '{image_path}'. Full response: {response}")
-        return f"Error: Unexpected or empty response from Gemini API for '{image_path}'."
+        logger.error(f"Unexpected response structure or empty response from Gemini API for '{image_label}'. Full response: {response}")
+        return f"Error: Unexpected or empty response from Gemini API for '{image_label}'."
     except FileNotFoundError:
         logger.error(f"Image file not found: {image_path}")
         return f"Error: Image file not found at {image_path}"
     except UnidentifiedImageError:
-        logger.error(f"Cannot identify image file (possibly corrupt or unsupported format): {image_path}")
-        return f"Error: Cannot identify image file (corrupt or unsupported format): {image_path}"
+        logger.error(f"Cannot identify image file (possibly corrupt or unsupported format): {image_label}")
+        return f"Error: Cannot identify image file (corrupt or unsupported format): {image_label}"
     except genai.types.generation_types.BlockedPromptException as bpe:
-        logger.error(f"Gemini API request for '{image_path}' blocked due to prompt content: {bpe}")
-        return f"Error: Gemini API request for '{image_path}' was blocked. Reason: {bpe}"
+        logger.error(f"Gemini API request for '{image_label}' blocked due to prompt content: {bpe}")
+        return f"Error: Gemini API request for '{image_label}' was blocked. Reason: {bpe}"
     except google.api_core.exceptions.DeadlineExceeded as dee:
         timeout_val = request_options.get('timeout', 'N/A')
-        logger.error(f"Gemini API call for '{image_path}' timed out after {timeout_val}s: {dee}")
-        return f"Error: Gemini API call for '{image_path}' timed out after {timeout_val} seconds. Details: {str(dee)}"
+        logger.error(f"Gemini API call for '{image_label}' timed out after {timeout_val}s: {dee}")
+        return f"Error: Gemini API call for '{image_label}' timed out after {timeout_val} seconds. Details: {str(dee)}"
+    except retry_policy.CircuitOpenError as coe:
+        logger.error(f"Gemini API call skipped: {coe}")
+        return f"Error: {coe}"
+    except google.api_core.exceptions.TooManyRequests as tmr: # 429 / ResourceExhausted (quota)
+        logger.error(f"Gemini API rate limit or quota exceeded for '{image_label}': {tmr}")
+        return f"Error: Gemini API rate limit or quota exceeded for '{image_label}': {str(tmr)}"
     except google.api_core.exceptions.GoogleAPIError as gae: # Catching more general Google API errors
-        logger.error(f"A Google API error occurred for '{image_path}': {gae}. This could be due to proxy issues, authentication, or quotas.")
-        return f"Error: A Google API error occurred for '{image_path}': {str(gae)}"
+        logger.error(f"A Google API error occurred for '{image_label}': {gae}. This could be due to proxy issues, authentication, or quotas.")
+        return f"Error: A Google API error occurred for '{image_label}': {str(gae)}"
+    except Exception as e:
+        logger.error(f"An unexpected error occurred in analyze_image for '{image_label}': {str(e)}\n{traceback.format_exc()}")
+        return f"An unexpected error occurred while analyzing the image '{image_label}': {str(e)}"
+
+
+def analyze_image_stream(image_path=None, user_prompt=None, system_prompt_override=None, api_key_override=None, model_name_override=None, image_bytes=None, image_mime_type=None):
+    """
+    Streaming variant of analyze_image: yields the analysis text in chunks as Gemini generates it
+    (generate_content(stream=True)). Accepts the same arguments.
+
+    A failure before any text is produced is yielded as a single "Error: ..." chunk, the same text
+    analyze_image would return. Only opening the stream (which includes receiving the first chunk)
+    is retried; an error after text has been yielded is raised, since the partial output has already
+    been consumed. Closing the generator early cancels the underlying response stream.
+    """
+    image_label = image_path or "in-memory image"
+    current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else GEMINI_API_KEY
+
+    if not current_api_key_to_use:
+        logger.error("No Gemini API key provided (neither in .env nor via UI). Cannot analyze image.")
+        yield "Error: Gemini API key not configured."
+        return
+
+    limits = _rate_limits(current_api_key_to_use)
+    breaker = retry_policy.get_circuit_breaker("gemini")
+    request_options = {"timeout": 60}
+    try:
+        gemini = get_gemini_client(current_api_key_to_use)
+        final_system_prompt = system_prompt_override.strip() if system_prompt_override and system_prompt_override.strip() else DEFAULT_SYSTEM_PROMPT
+        model_to_use = model_name_override if model_name_override and model_name_override.strip() else GEMINI_VISION_MODEL
+        model = gemini.generative_model(model_to_use, system_instruction=final_system_prompt)
+
+        content_parts = []
+        if user_prompt and user_prompt.strip():
+            content_parts.append(user_prompt.strip())
+        content_parts.append(_build_image_part(image_path, image_bytes, image_mime_type))
+        logger.info(f"Streaming analysis of '{image_label}' with Gemini model {model_to_use}, timeout: {request_options['timeout']}s...")
+
+        def _send():
+            limits.acquire(GEMINI_TOKENS_PER_REQUEST_ESTIMATE)
+            try:
+                response = model.generate_content(content_parts, stream=True, request_options=request_options)
+            except google.api_core.exceptions.TooManyRequests as tmr:
+                limits.on_rate_limited(_retry_after_seconds(tmr))
+                raise
+            limits.on_success()
+            return response
+
+        response = retry_policy.call_with_retry(_send, RETRY_POLICY, breaker, _is_retryable_error, _counts_as_outage, label=image_label)
+    except FileNotFoundError:
+        logger.error(f"Image file not found: {image_path}")
+        yield f"Error: Image file not found at {image_path}"
+        return
+    except UnidentifiedImageError:
+        logger.error(f"Cannot identify image file (possibly corrupt or unsupported format): {image_label}")
+        yield f"Error: Cannot identify image file (corrupt or unsupported format): {image_label}"
+        return
+    except genai.types.generation_types.BlockedPromptException as bpe:
+        logger.error(f"Gemini API request for '{image_label}' blocked due to prompt content: {bpe}")
+        yield f"Error: Gemini API request for '{image_label}' was blocked. Reason: {bpe}"
+        return
+    except google.api_core.exceptions.DeadlineExceeded as dee:
+        logger.error(f"Gemini API call for '{image_label}' timed out after {request_options['timeout']}s: {dee}")
+        yield f"Error: Gemini API call for '{image_label}' timed out after {request_options['timeout']} seconds. Details: {str(dee)}"
+        return
+    except retry_policy.CircuitOpenError as coe:
+        logger.error(f"Gemini API call skipped: {coe}")
+        yield f"Error: {coe}"
+        return
+    except google.api_core.exceptions.TooManyRequests as tmr:
+        logger.error(f"Gemini API rate limit or quota exceeded for '{image_label}': {tmr}")
+        yield f"Error: Gemini API rate limit or quota exceeded for '{image_label}': {str(tmr)}"
+        return
+    except google.api_core.exceptions.GoogleAPIError as gae:
+        logger.error(f"A Google API error occurred for '{image_label}': {gae}.")
+        yield f"Error: A Google API error occurred for '{image_label}': {str(gae)}"
+        return
     except Exception as e:
-        logger.error(f"An unexpected error occurred in analyze_image for '{image_path}': {str(e)}\n{traceback.format_exc()}")
-        return f"An unexpected error occurred while analyzing the image '{image_path}': {str(e)}"
+        logger.error(f"An unexpected error occurred opening the Gemini stream for '{image_label}': {str(e)}\n{traceback.format_exc()}")
+        yield f"An unexpected error occurred while analyzing the image '{image_label}': {str(e)}"
+        return
+
+    produced = False
+    completed = False
+    try:
+        for chunk in response:
+            text = "".join(part.text for part in chunk.parts if part.text)
+            if text:
+                produced = True
+                yield text
+        completed = True
     finally:
-        if temporarily_configured_with_override_key and original_env_api_key:
-            logger.info(f"Restoring genai configuration with original API key from .env.")
+        if not completed:
+            # The gRPC stream exposes cancel(); stop the generation instead of letting it run on unread
+            cancel = getattr(getattr(response, "_iterator", None), "cancel", None)
+            if cancel:
+                cancel()
+            logger.info(f"Gemini stream for '{image_label}' closed before the generation finished.")
+
+    limits.record_usage(GEMINI_TOKENS_PER_REQUEST_ESTIMATE, _usage_total_tokens(response))
+    if produced:
+        logger.info(f"Gemini streaming analysis successful for '{image_label}'.")
+        return
+    if response.prompt_feedback and getattr(response.prompt_feedback, 'block_reason_message', None):
+        block_msg = response.prompt_feedback.block_reason_message
+        logger.warning(f"Content generation for '{image_label}' blocked by API (prompt_feedback): {block_msg}")
+        yield f"Error: Content generation blocked - {block_msg}"
+        return
+    for candidate in response.candidates or []:
+        reason = getattr(candidate.finish_reason, 'name', candidate.finish_reason) # proto enum
+        if reason not in ('STOP', 'FINISH_REASON_UNSPECIFIED'):
+            error_msg = f"Content generation for '{image_label}' stopped. Finish reason: {reason}."
+            logger.warning(error_msg)
+            yield f"Error: {error_msg}"
+            return
+    logger.error(f"Gemini stream for '{image_label}' contained no text.")
+    yield f"Error: Unexpected or empty response from Gemini API for '{image_label}'."
+
+
+def analyze_image_pack(parts, system_prompt_override=None, api_key_override=None, model_name_override=None, label="image pack"):
+    """
+    Analyzes several images in one generate_content request.
+
+    parts is the ordered content: text strings (e.g. page markers) and image dicts with
+    image_path, or image_bytes and image_mime_type. Returns the full response text or an
+    "Error: ..." string; the rate-limit reservation scales with the number of images.
+    """
+    current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else GEMINI_API_KEY
+    if not current_api_key_to_use:
+        logger.error("No Gemini API key provided (neither in .env nor via UI). Cannot analyze images.")
+        return "Error: Gemini API key not configured."
+
+    image_count = sum(1 for part in parts if not isinstance(part, str))
+    token_estimate = GEMINI_TOKENS_PER_REQUEST_ESTIMATE * image_count
+    limits = _rate_limits(current_api_key_to_use)
+    breaker = retry_policy.get_circuit_breaker("gemini")
+    request_options = {"timeout": 60 + 30 * max(0, image_count - 1)}
+    try:
+        final_system_prompt = system_prompt_override.strip() if system_prompt_override and system_prompt_override.strip() else DEFAULT_SYSTEM_PROMPT
+        model_to_use = model_name_override if model_name_override and model_name_override.strip() else GEMINI_VISION_MODEL
+        model = get_gemini_client(current_api_key_to_use).generative_model(model_to_use, system_instruction=final_system_prompt)
+        content_parts = [part if isinstance(part, str) else _build_image_part(part.get('image_path'), part.get('image_bytes'), part.get('image_mime_type'))
+                         for part in parts]
+        logger.info(f"Analyzing {label} ({image_count} images) in one request with Gemini model {model_to_use}, timeout: {request_options['timeout']}s...")
+
+        def _send():
+            limits.acquire(token_estimate)
             try:
-                genai.configure(api_key=original_env_api_key)
-            except Exception as e_restore:
-                logger.error(f"Error restoring genai configuration with .env key: {e_restore}")
-        elif temporarily_configured_with_override_key and not original_env_api_key:
-            # If we used an override key because the .env key was missing,
-            # there's no "original" state to restore to that involves a key.
-            # We could try to "unconfigure" but genai library might not support that directly.
-            # For now, we'll leave it configured with the override key if no .env key existed.
-            logger.info("Original .env API key was not set; genai remains configured with the UI-provided key for this session.")
+                response = model.generate_content(content_parts, request_options=request_options)
+            except google.api_core.exceptions.TooManyRequests as tmr:
+                limits.on_rate_limited(_retry_after_seconds(tmr))
+                raise
+            limits.record_usage(token_estimate, _usage_total_tokens(response))
+            limits.on_success()
+            return response
+
+        response = retry_policy.call_with_retry(_send, RETRY_POLICY, breaker, _is_retryable_error, _counts_as_outage, label=label)
+        if response and response.parts and getattr(response.parts[0], 'text', None):
+            logger.info(f"Gemini analysis successful for {label}.")
+            return "".join(part.text for part in response.parts if part.text).strip()
+        if response.prompt_feedback and getattr(response.prompt_feedback, 'block_reason_message', None):
+            logger.warning(f"Content generation for {label} blocked by API (prompt_feedback): {response.prompt_feedback.block_reason_message}")
+            return f"Error: Content generation blocked - {response.prompt_feedback.block_reason_message}"
+        logger.error(f"Unexpected or empty response from Gemini API for {label}.")
+        return f"Error: Unexpected or empty response from Gemini API for {label}."
+    except (FileNotFoundError, UnidentifiedImageError) as e:
+        logger.error(f"Cannot read image for {label}: {e}")
+        return f"Error: Cannot read image for {label}: {e}"
+    except retry_policy.CircuitOpenError as coe:
+        logger.error(f"Gemini API call skipped: {coe}")
+        return f"Error: {coe}"
+    except google.api_core.exceptions.TooManyRequests as tmr:
+        logger.error(f"Gemini API rate limit or quota exceeded for {label}: {tmr}")
+        return f"Error: Gemini API rate limit or quota exceeded for {label}: {str(tmr)}"
+    except google.api_core.exceptions.GoogleAPIError as gae:
+        logger.error(f"A Google API error occurred for {label}: {gae}")
+        return f"Error: A Google API error occurred for {label}: {str(gae)}"
+    except Exception as e:
+        logger.error(f"An unexpected error occurred analyzing {label}: {str(e)}\n{traceback.format_exc()}")
+        return f"An unexpected error occurred while analyzing {label}: {str(e)}"
 
 
 def analyze_images_batch(image_paths, user_prompt=None, system_prompt_override=None, api_key_override=None, model_name_override=None):
@@ -255,38 +589,16 @@ def analyze_images_batch(image_paths, user_prompt=None, system_prompt_override=N
     
 def list_gemini_models(api_key_override=None):
         """Lists available Gemini models, prioritizing vision models."""
-        original_env_api_key = GEMINI_API_KEY
-        temporarily_configured = False
-        current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else original_env_api_key
+        current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else GEMINI_API_KEY
     
         if not current_api_key_to_use:
             logger.error("No Gemini API key available to list models.")
             return {"error": "API key not configured."}
     
         try:
-            if api_key_override and api_key_override.strip() and api_key_override != original_env_api_key:
-                logger.info("Temporarily configuring genai with provided API key to list models.")
-                genai.configure(api_key=api_key_override)
-                temporarily_configured = True
-            elif not original_env_api_key and api_key_override and api_key_override.strip():
-                logger.info("Configuring genai with provided API key to list models (no .env key).")
-                genai.configure(api_key=api_key_override)
-            # If no override and no .env key, current_api_key_to_use would be None,
-            # and we would have already returned an error.
-            # If .env key was used for initial config, and no override, we use that.
-            # If an override was provided and is different, it's handled above.
-            # This explicit check for genai.API_KEY is problematic and not needed
-            # as current_api_key_to_use should be the source of truth for the key in this function.
-            # We ensure genai is configured if a key is available.
-            # The initial configuration at module load handles the .env key.
-            # The temporary configuration handles the override.
-            # If current_api_key_to_use is set, we assume genai will be/is configured with it.
-            # No need for: elif not genai.API_KEY:
-    
-    
             logger.info("Fetching list of Gemini models...")
             models_info = []
-            for m in genai.list_models():
+            for m in get_gemini_client(current_api_key_to_use).list_models():
                 # We are interested in models that support 'generateContent' for vision tasks
                 if 'generateContent' in m.supported_generation_methods:
                     # Prioritize models clearly marked for vision or multimodal
@@ -312,128 +624,115 @@ def list_gemini_models(api_key_override=None):
         except Exception as e:
             logger.error(f"Error listing Gemini models: {e}\n{traceback.format_exc()}")
             return {"error": f"Failed to list Gemini models: {str(e)}"}
-        finally:
-            if temporarily_configured and original_env_api_key:
-                logger.info("Restoring genai configuration with original .env API key after listing models.")
-                try:
-                    genai.configure(api_key=original_env_api_key)
-                except Exception as e_restore:
-                    logger.error(f"Error restoring genai configuration: {e_restore}")
-            elif temporarily_configured and not original_env_api_key:
-                logger.info("Original .env API key was not set; genai remains configured with the UI-provided key for this session.")
-
-async def analyze_image_async(image_path, user_prompt=None, system_prompt_override=None, api_key_override=None, model_name_override=None):
+
+async def analyze_image_async(image_path=None, user_prompt=None, system_prompt_override=None, api_key_override=None, model_name_override=None, image_bytes=None, image_mime_type=None):
     """
     Asynchronously analyzes an image using the Gemini API.
     Includes rate limiting and API key handling.
+    Accepts in-memory image_bytes like analyze_image.
     """
-    original_env_api_key = GEMINI_API_KEY
-    temporarily_configured_with_override_key = False
-    
-    current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else original_env_api_key
+    image_label = image_path or "in-memory image"
+    current_api_key_to_use = api_key_override if api_key_override and api_key_override.strip() else GEMINI_API_KEY
 
     if not current_api_key_to_use:
         logger.error("Async: No Gemini API key provided. Cannot analyze image.")
         return "Error: Gemini API key not configured."
 
+    limits = _rate_limits(current_api_key_to_use)
+    breaker = retry_policy.get_circuit_breaker("gemini")
     try:
-        if api_key_override and api_key_override.strip() and api_key_override != original_env_api_key:
-            logger.info(f"Async: Temporarily configuring genai with API key provided via UI.")
-            # genai.configure is synchronous, ensure this is okay in async context or find async alternative if exists
-            genai.configure(api_key=api_key_override)
-            temporarily_configured_with_override_key = True
-        elif not original_env_api_key and api_key_override and api_key_override.strip():
-            logger.info(f"Async: Configuring genai with API key provided via UI (no .env key was set).")
-            genai.configure(api_key=api_key_override)
-        elif not genai.API_KEY: # Check if genai is configured at all
-             logger.info(f"Async: Configuring genai with current_api_key_to_use as it was not configured.")
-             genai.configure(api_key=current_api_key_to_use)
+        gemini = get_gemini_client(current_api_key_to_use)
+        async_client = get_async_generative_client(gemini)
 
         final_system_prompt = DEFAULT_SYSTEM_PROMPT
         if system_prompt_override and system_prompt_override.strip():
             final_system_prompt = system_prompt_override.strip()
-            logger.info(f"Async: Using system_prompt_override for '{image_path}'.")
+            logger.info(f"Async: Using system_prompt_override for '{image_label}'.")
 
         request_options = {"timeout": 60} # Timeout for the async call
-        logger.info(f"Async: Analyzing image: {image_path} with system prompt: \"{final_system_prompt[:100]}...\"")
+        logger.info(f"Async: Analyzing image: {image_label} with system prompt: \"{final_system_prompt[:100]}...\"")
         
-        # Asynchronously open image if it becomes a bottleneck, for now, keep it sync
+        # In-memory bytes need no I/O; opening a file path is still sync for now
         # In a high-throughput Celery worker, disk I/O might also benefit from async via libraries like aiofiles
-        img = Image.open(image_path)
-        img.load() # Ensure image data is loaded
-        logger.debug(f"Async: Image loaded: {image_path}, format: {img.format}, mode: {img.mode}, size: {img.size}")
+        image_part = _build_image_part(image_path, image_bytes, image_mime_type)
         
         model_to_use = model_name_override if model_name_override and model_name_override.strip() else GEMINI_VISION_MODEL
         logger.info(f"Async: Using Gemini vision model: {model_to_use}")
         
-        # google-generativeai uses an internal http client that should handle async correctly
-        model = genai.GenerativeModel(model_to_use, system_instruction=final_system_prompt)
+        model = gemini.generative_model(model_to_use, system_instruction=final_system_prompt, async_client=async_client)
         
         content_parts = []
         if user_prompt and user_prompt.strip():
             content_parts.append(user_prompt.strip())
-        content_parts.append(img) # PIL Image object
+        content_parts.append(image_part) # PIL Image object or inline blob
 
-        # Asynchronously consume a token from the rate limiter
-        # await gemini_rate_limiter.consume_async(1)
-        # logger.info(f"Async: Token consumed for {image_path}. Proceeding with API call.")
+        logger.info(f"Async: Sending request to Gemini API (model: {model_to_use}) for image '{image_label}' with timeout: {request_options['timeout']}s...")
 
-        logger.info(f"Async: Sending request to Gemini API (model: {model_to_use}) for image '{image_path}' with timeout: {request_options['timeout']}s...")
-        
-        response = await model.generate_content_async(content_parts, request_options=request_options)
-        logger.debug(f"Async: Raw response from Gemini API for '{image_path}': {response}")
+        async def _send():
+            await limits.acquire_async(GEMINI_TOKENS_PER_REQUEST_ESTIMATE)
+            try:
+                response = await model.generate_content_async(content_parts, request_options=request_options)
+            except google.api_core.exceptions.TooManyRequests as tmr:
+                limits.on_rate_limited(_retry_after_seconds(tmr))
+                raise
+            limits.record_usage(GEMINI_TOKENS_PER_REQUEST_ESTIMATE, _usage_total_tokens(response))
+            limits.on_success()
+            return response
+
+        response = await retry_policy.call_with_retry_async(_send, RETRY_POLICY, breaker, _is_retryable_error, _counts_as_outage, label=image_label)
+        logger.debug(f"Async: Raw response from Gemini API for '{image_label}': {response}")
 
         if response and response.parts:
             if hasattr(response.parts[0], 'text') and response.parts[0].text is not None:
-                logger.info(f"Async: Successfully extracted text from response.parts[0] for '{image_path}'.")
+                logger.info(f"Async: Successfully extracted text from response.parts[0] for '{image_label}'.")
                 return response.parts[0].text.strip()
             else:
                 # Handle blocked prompts or other issues similar to synchronous version
                 if response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason_message') and response.prompt_feedback.block_reason_message:
                     block_msg = response.prompt_feedback.block_reason_message
-                    logger.warning(f"Async: Content generation for '{image_path}' blocked by API: {block_msg}")
+                    logger.warning(f"Async: Content generation for '{image_label}' blocked by API: {block_msg}")
                     return f"Error: Content generation blocked - {block_msg}"
                 if response.candidates:
                     for candidate in response.candidates:
                         if hasattr(candidate, 'finish_reason') and candidate.finish_reason != 'STOP' and candidate.finish_reason != 'FINISH_REASON_UNSPECIFIED': # Added FINISH_REASON_UNSPECIFIED
                             reason = candidate.finish_reason
                             safety_str = f" Safety: {candidate.safety_ratings}" if hasattr(candidate, 'safety_ratings') else ""
-                            error_msg = f"Async: Content generation for '{image_path}' stopped. Reason: {reason}.{safety_str}"
+                            error_msg = f"Async: Content generation for '{image_label}' stopped. Reason: {reason}.{safety_str}"
                             logger.warning(error_msg)
                             return f"Error: {error_msg}"
-                logger.error(f"Async: No text in response.parts[0] for '{image_path}' and no clear blocking reason. Parts: {response.parts}")
-                return f"Error: No text found in Gemini API response part for '{image_path}'."
+                logger.error(f"Async: No text in response.parts[0] for '{image_label}' and no clear blocking reason. Parts: {response.parts}")
+                return f"Error: No text found in Gemini API response part for '{image_label}'."
         elif response and hasattr(response, 'text') and response.text is not None:
-            logger.info(f"Async: Successfully extracted text from response.text (fallback) for '{image_path}'.")
+            logger.info(f"Async: Successfully extracted text from response.text (fallback) for '{image_label}'.")
             return response.text.strip()
-        logger.error(f"Async: Unexpected response structure or empty response from Gemini API for '{image_path}'.")
-        return f"Error: Unexpected or empty response from Gemini API for '{image_path}'."
+        logger.error(f"Async: Unexpected response structure or empty response from Gemini API for '{image_label}'.")
+        return f"Error: Unexpected or empty response from Gemini API for '{image_label}'."
 
     except FileNotFoundError:
-        logger.error(f"Async: Image file not found: {image_path}")
+        logger.error(f"Async: Image file not found: {image_label}")
         return f"Error: Image file not found at {image_path}"
     except UnidentifiedImageError:
-        logger.error(f"Async: Cannot identify image file: {image_path}")
-        return f"Error: Cannot identify image file: {image_path}"
+        logger.error(f"Async: Cannot identify image file: {image_label}")
+        return f"Error: Cannot identify image file: {image_label}"
     except genai.types.generation_types.BlockedPromptException as bpe:
-        logger.error(f"Async: Gemini API request for '{image_path}' blocked: {bpe}")
-        return f"Error: Gemini API request for '{image_path}' was blocked. Reason: {bpe}"
+        logger.error(f"Async: Gemini API request for '{image_label}' blocked: {bpe}")
+        return f"Error: Gemini API request for '{image_label}' was blocked. Reason: {bpe}"
     except google.api_core.exceptions.DeadlineExceeded as dee:
         timeout_val = request_options.get('timeout', 'N/A')
-        logger.error(f"Async: Gemini API call for '{image_path}' timed out after {timeout_val}s: {dee}")
-        return f"Error: Gemini API call for '{image_path}' timed out. Details: {str(dee)}"
+        logger.error(f"Async: Gemini API call for '{image_label}' timed out after {timeout_val}s: {dee}")
+        return f"Error: Gemini API call for '{image_label}' timed out. Details: {str(dee)}"
+    except retry_policy.CircuitOpenError as coe:
+        logger.error(f"Async: Gemini API call skipped: {coe}")
+        return f"Error: {coe}"
+    except google.api_core.exceptions.TooManyRequests as tmr:
+        logger.error(f"Async: Gemini API rate limit or quota exceeded for '{image_label}': {tmr}")
+        return f"Error: Gemini API rate limit or quota exceeded for '{image_label}': {str(tmr)}"
     except google.api_core.exceptions.GoogleAPIError as gae:
-        logger.error(f"Async: A Google API error occurred for '{image_path}': {gae}")
-        return f"Error: A Google API error occurred for '{image_path}': {str(gae)}"
+        logger.error(f"Async: A Google API error occurred for '{image_label}': {gae}")
+        return f"Error: A Google API error occurred for '{image_label}': {str(gae)}"
     except Exception as e:
-        logger.error(f"Async: An unexpected error occurred for '{image_path}': {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"Async: An unexpected error occurred for '{image_label}': {str(e)}\n{traceback.format_exc()}")
         return f"An unexpected error occurred: {str(e)}"
-    finally:
-        if temporarily_configured_with_override_key and original_env_api_key:
-            logger.info(f"Async: Restoring genai configuration with original API key from .env.")
-            genai.configure(api_key=original_env_api_key) # Synchronous configure
-        elif temporarily_configured_with_override_key and not original_env_api_key:
-            logger.info("Async: Original .env API key was not set; genai remains configured with the UI-provided key.")
 
 
 async def main_async_test():
@@ -0,0 +1,100 @@
+import os
+import hashlib
+import logging
+import threading
+from PIL import Image
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 结果页面使用的缩略图 / 预览图尺寸（长边像素）；原图仍可通过 size=full 按需获取
+IMAGE_THUMB_MAX_EDGE = int(os.getenv('IMAGE_THUMB_MAX_EDGE', 320))
+IMAGE_PREVIEW_MAX_EDGE = int(os.getenv('IMAGE_PREVIEW_MAX_EDGE', 1024))
+IMAGE_VARIANT_FORMAT = os.getenv('IMAGE_VARIANT_FORMAT', 'WEBP').upper() # WEBP 或 JPEG
+IMAGE_VARIANT_QUALITY = int(os.getenv('IMAGE_VARIANT_QUALITY', 80))
+# 派生图保存在原图所在目录的子目录中，随页面图像目录一起在任务过期时删除，不单独占用缓存空间
+IMAGE_VARIANT_SUBDIR = 'variants'
+
+IMAGE_VARIANT_SIZES = {
+    'thumb': IMAGE_THUMB_MAX_EDGE,
+    'preview': IMAGE_PREVIEW_MAX_EDGE,
+}
+
+_VARIANT_EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+
+# 同一个派生图只生成一次：并发请求同一张图时后到的请求等待先到的请求写完（按路径哈希分段加锁）
+_generation_locks = [threading.Lock() for _ in range(32)]
+
+
+def _variant_format():
+    if IMAGE_VARIANT_FORMAT in _VARIANT_EXTENSIONS:
+        return IMAGE_VARIANT_FORMAT
+    logging.warning(f"Unsupported IMAGE_VARIANT_FORMAT '{IMAGE_VARIANT_FORMAT}', using JPEG.")
+    return 'JPEG'
+
+
+def _variant_cache_path(source_path, size, image_format):
+    # 文件名带上原图修改时间、文件大小和派生参数的摘要：原图被重新渲染或参数变化后自动生成新的派生图
+    stat = os.stat(source_path)
+    key = f"{stat.st_mtime_ns}|{stat.st_size}|{size}|{IMAGE_VARIANT_SIZES[size]}|{image_format}|{IMAGE_VARIANT_QUALITY}"
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]
+    source_dir, source_name = os.path.split(source_path)
+    stem = os.path.splitext(source_name)[0]
+    return os.path.join(source_dir, IMAGE_VARIANT_SUBDIR, f"{stem}_{size}_{digest}.{_VARIANT_EXTENSIONS[image_format]}")
+
+
+def _generation_lock(path):
+    return _generation_locks[hash(path) % len(_generation_locks)]
+
+
+def _render_variant(source_path, target_path, max_edge, image_format):
+    with Image.open(source_path) as img:
+        img.draft('RGB', (max_edge, max_edge)) # JPEG 原图可直接按缩小比例解码
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # 先写临时文件再原子替换，避免其他请求读到写了一半的图像
+        tmp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            img.save(tmp_path, format=image_format, quality=IMAGE_VARIANT_QUALITY)
+            os.replace(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def get_image_variant(source_path, size):
+    """
+    返回原图指定尺寸档位的派生图路径，不存在时生成并缓存到原图目录下的 IMAGE_VARIANT_SUBDIR 子目录。
+
+    参数:
+    source_path (str): 原始页面图像的路径。
+    size (str): 'thumb' 或 'preview'。
+
+    返回:
+    str | None: 派生图路径。原图本身不大于目标尺寸或生成失败时返回 None，调用方应直接使用原图。
+    """
+    max_edge = IMAGE_VARIANT_SIZES.get(size)
+    if not max_edge or max_edge <= 0:
+        return None
+
+    image_format = _variant_format()
+    try:
+        target_path = _variant_cache_path(source_path, size, image_format)
+        if os.path.exists(target_path):
+            return target_path
+
+        with _generation_lock(target_path):
+            if os.path.exists(target_path):
+                return target_path
+            with Image.open(source_path) as img:
+                if max(img.size) <= max_edge:
+                    return None
+            _render_variant(source_path, target_path, max_edge, image_format)
+        logging.info(f"Generated {size} variant for {source_path}: {target_path}")
+        return target_path
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not generate {size} variant for {source_path}: {e}")
+        return None
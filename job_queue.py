@@ -0,0 +1,555 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 后台任务队列配置：任务状态和逐页结果保存在本地 SQLite 中，由进程内的工作线程执行，
+# 无需 Redis / RabbitMQ 等外部消息代理
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'uploads/cache/jobs.sqlite3')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2)) # 同时执行的任务数（每个任务内的页面并发见 LLM_MAX_CONCURRENCY）
+# 任务租约时长：持有任务的进程每隔 1/3 租约时长续约一次；租约过期（进程已退出或卡死）的任务才会被其他进程恢复
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 60))
+# 已结束任务的保留时长：到期后删除任务记录和页面图像等输出（上传的 PDF 在任务结束时即删除）；0 表示永久保留
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 7 * 24 * 3600))
+JOB_SWEEP_INTERVAL_SECONDS = 600
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+JOB_FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+JOB_CANCELLED_MESSAGE = "任务已取消。"
+
+
+class JobReporter:
+    """任务处理函数用来上报进度的对象，绑定到单个任务。"""
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+
+    def file_started(self, file_index, page_count=None):
+        self.queue._update_file(self.job_id, file_index, status='running', page_count=page_count)
+
+    def page_delta(self, file_index, page_number, text):
+        """上报某页生成中的一段文本（只保存在内存中，该页完成后丢弃）。"""
+        self.queue._append_partial(self.job_id, file_index, page_number, text)
+
+    def page_done(self, file_index, result):
+        self.queue._add_page_result(self.job_id, file_index, result)
+
+    def is_cancelled(self):
+        return self.job_id in self.queue._cancel_requested
+
+    def file_finished(self, file_index, summary=None, error=None):
+        self.queue._update_file(self.job_id, file_index, status='failed' if error else 'done', summary=summary, error=error)
+
+
+class JobQueue:
+    """
+    基于 SQLite 的本地任务队列。
+
+    submit() 立即返回任务 ID；工作线程按提交顺序领取任务并调用 handler，
+    handler 通过 JobReporter 逐页写入结果，get_job() 随时可读取进度和已完成页面的结果。
+    数据库可被多个 Web 工作进程共享：任一进程都能查询任务，也都能领取不依赖内存中密钥的任务。
+
+    界面填写的 API Key 等敏感选项（secrets）只保存在提交任务的进程内存中，不写入磁盘；
+    这类任务只能由提交它的进程执行，进程重启后会被标记为失败。
+
+    任务结束（完成、失败或取消）后删除上传的 PDF；超过 JOB_RETENTION_SECONDS 的已结束任务连同记录一起清理，
+    并对每个文件调用 cleanup(pdf_path) 删除由它派生的输出（如页面图像）。
+
+    生成中的页面文本（page_delta）只保存在执行任务的进程内存中，供实时推送使用。
+    """
+    def __init__(self, db_path, handler, workers=JOB_WORKERS, cleanup=None):
+        self.db_path = db_path
+        self.handler = handler
+        self.cleanup = cleanup
+        self.workers = max(1, workers)
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._secrets = {} # job_id -> dict，仅存于内存
+        self._wakeup = threading.Condition()
+        self._updates = threading.Condition() # 任一任务有进度时通知，用于实时推送
+        self._update_version = 0
+        self._partials = {} # job_id -> {(file_index, page_number): 生成中的文本}
+        self._partials_lock = threading.Lock()
+        self._cancel_requested = set()
+        self._threads = []
+        self._threads_lock = threading.Lock()
+        self._last_sweep = 0
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " owner TEXT,"
+                " needs_secrets INTEGER NOT NULL DEFAULT 0,"
+                " options TEXT NOT NULL,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " finished_at REAL,"
+                " lease_expires_at REAL)"
+            )
+            # 兼容升级前创建的数据库
+            if 'lease_expires_at' not in [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]:
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_expires_at REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_files ("
+                " job_id TEXT NOT NULL,"
+                " file_index INTEGER NOT NULL,"
+                " filename TEXT NOT NULL,"
+                " pdf_path TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " page_count INTEGER,"
+                " summary TEXT,"
+                " error TEXT,"
+                " PRIMARY KEY (job_id, file_index))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_pages ("
+                " job_id TEXT NOT NULL,"
+                " file_index INTEGER NOT NULL,"
+                " page_number INTEGER,"
+                " result TEXT NOT NULL,"
+                " finished_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_job_pages_job ON job_pages (job_id, file_index, page_number)")
+        self._recover_stale_jobs()
+        logging.info(f"Job queue ready at {db_path} ({self.workers} workers).")
+
+    def _connection(self):
+        # 每个线程使用独立连接；WAL 模式允许多进程并发读写
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _recover_stale_jobs(self):
+        """
+        恢复租约已过期的任务（持有它的进程已退出或长时间没有续约）：执行中的任务重新排队，
+        依赖内存中密钥的任务（执行中或等待提交进程执行的排队任务）无法恢复，标记为失败。
+
+        仍由存活进程持有（租约未过期）的任务不受影响，无论它已运行多久。
+        """
+        now = time.time()
+        recovered = 0
+        failed = []
+        with self._connection() as conn:
+            stale = conn.execute(
+                "SELECT job_id, needs_secrets FROM jobs WHERE (status = 'running' OR (status = 'queued' AND needs_secrets = 1)) "
+                "AND COALESCE(lease_expires_at, 0) < ?",
+                (now,)
+            ).fetchall()
+            for job_id, needs_secrets in stale:
+                if needs_secrets:
+                    # 条件更新：检查之后若原进程恰好续约，则不处理
+                    if conn.execute(
+                            "UPDATE jobs SET status = 'failed', error = ?, updated_at = ?, finished_at = ? "
+                            "WHERE job_id = ? AND status IN ('queued', 'running') AND COALESCE(lease_expires_at, 0) < ?",
+                            ("任务被中断（服务重启）。界面填写的 API Key 不会写入磁盘，请重新上传。", now, now, job_id, now)).rowcount:
+                        failed.append(job_id)
+                    continue
+                if not conn.execute(
+                        "UPDATE jobs SET status = 'queued', owner = NULL, lease_expires_at = NULL, updated_at = ? "
+                        "WHERE job_id = ? AND status = 'running' AND COALESCE(lease_expires_at, 0) < ?",
+                        (now, job_id, now)).rowcount:
+                    continue
+                recovered += 1
+                # 已完成的文件保留结果，只重新处理未完成的文件
+                conn.execute(
+                    "DELETE FROM job_pages WHERE job_id = ? AND file_index IN "
+                    "(SELECT file_index FROM job_files WHERE job_id = ? AND status != 'done')", (job_id, job_id)
+                )
+                conn.execute("UPDATE job_files SET status = 'queued', page_count = NULL, summary = NULL, error = NULL "
+                             "WHERE job_id = ? AND status != 'done'", (job_id,))
+        for job_id in failed:
+            self._discard_uploads(job_id)
+        recovered += len(failed)
+        if recovered:
+            logging.warning(f"Recovered {recovered} interrupted job(s) with expired leases from {self.db_path}.")
+            self._notify_update()
+            with self._wakeup:
+                self._wakeup.notify_all()
+
+    def _renew_leases(self):
+        """为本进程持有的排队中/执行中任务续约。"""
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                (time.time() + JOB_LEASE_SECONDS, self.owner)
+            )
+
+    def _heartbeat_loop(self):
+        # 续约与页面进度无关：即使单页分析耗时很长，任务也不会被其他进程误判为中断
+        while True:
+            time.sleep(max(1.0, JOB_LEASE_SECONDS / 3.0))
+            try:
+                self._renew_leases()
+                self._recover_stale_jobs()
+                if JOB_RETENTION_SECONDS and time.time() - self._last_sweep >= JOB_SWEEP_INTERVAL_SECONDS:
+                    self._last_sweep = time.time()
+                    self._sweep_expired_jobs()
+            except sqlite3.Error as e:
+                logging.error(f"Job queue heartbeat failed: {e}")
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not remove job file {path}: {e}")
+
+    def _discard_uploads(self, job_id):
+        """任务结束后删除其上传的 PDF；页面图像等输出保留到任务过期。"""
+        for (pdf_path,) in self._connection().execute("SELECT pdf_path FROM job_files WHERE job_id = ?", (job_id,)):
+            self._remove_file(pdf_path)
+
+    def _sweep_expired_jobs(self):
+        """删除结束超过 JOB_RETENTION_SECONDS 的任务记录、上传文件及其派生输出。"""
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        conn = self._connection()
+        expired = [row[0] for row in conn.execute(
+            "SELECT job_id FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?", (cutoff,)
+        )]
+        swept = 0
+        for job_id in expired:
+            with conn:
+                pdf_paths = [row[0] for row in conn.execute("SELECT pdf_path FROM job_files WHERE job_id = ?", (job_id,))]
+                # 多个进程可能同时清理：只有成功删除任务记录的进程负责删除文件
+                if not conn.execute("DELETE FROM jobs WHERE job_id = ? AND finished_at < ?", (job_id, cutoff)).rowcount:
+                    continue
+                conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM job_pages WHERE job_id = ?", (job_id,))
+            swept += 1
+            for pdf_path in pdf_paths:
+                self._remove_file(pdf_path)
+                if self.cleanup:
+                    try:
+                        self.cleanup(pdf_path)
+                    except Exception as e:
+                        logging.warning(f"Cleanup of outputs for {pdf_path} failed: {e}")
+        if swept:
+            logging.info(f"Removed {swept} expired job(s) and their files from {self.db_path}.")
+
+    def start(self):
+        """启动工作线程（幂等）。"""
+        with self._threads_lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            heartbeat = threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True)
+            heartbeat.start()
+            self._threads.append(heartbeat)
+
+    def submit(self, files, options, secrets=None):
+        """
+        提交一个任务并立即返回任务 ID。
+
+        参数:
+            files (list): [{'filename': ..., 'pdf_path': ...}]，按处理顺序排列。
+                          已有结果的文件（如整份文档命中索引）可附带 'page_results' 和 'summary'，
+                          提交时直接记为完成，不再交给 handler；全部文件都已完成时任务立即结束。
+            options (dict): 可序列化为 JSON 的处理选项，会写入数据库。
+            secrets (dict): 可选，仅保存在内存中的敏感选项（如 API Key），执行时合并到 options。
+
+        返回:
+            str: 任务 ID。
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        pending = [item for item in files if item.get('page_results') is None]
+        secrets = {key: value for key, value in (secrets or {}).items() if value}
+        if secrets and pending:
+            self._secrets[job_id] = secrets
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, status, owner, needs_secrets, options, created_at, updated_at, finished_at, lease_expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, 'queued' if pending else 'done', self.owner, 1 if secrets and pending else 0,
+                 json.dumps(options, ensure_ascii=False), now, now, None if pending else now, now + JOB_LEASE_SECONDS)
+            )
+            for index, item in enumerate(files):
+                page_results = item.get('page_results')
+                conn.execute(
+                    "INSERT INTO job_files (job_id, file_index, filename, pdf_path, status, page_count, summary) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, index, item['filename'], item['pdf_path'], 'queued' if page_results is None else 'done',
+                     None if page_results is None else len(page_results),
+                     json.dumps(item['summary'], ensure_ascii=False) if item.get('summary') is not None else None)
+                )
+                conn.executemany(
+                    "INSERT INTO job_pages (job_id, file_index, page_number, result, finished_at) VALUES (?, ?, ?, ?, ?)",
+                    [(job_id, index, result.get('page_number'), json.dumps(result, ensure_ascii=False), now) for result in page_results or []]
+                )
+        if not pending:
+            logging.info(f"Job {job_id} completed on submission: all {len(files)} file(s) already had results.")
+            self._discard_uploads(job_id)
+            self._notify_update()
+            return job_id
+        logging.info(f"Job {job_id} queued with {len(pending)} of {len(files)} file(s) to process.")
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def _claim_next(self):
+        """领取最早的可执行任务；没有时返回 None。"""
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT job_id, options FROM jobs WHERE status = 'queued' AND (needs_secrets = 0 OR owner = ?) "
+                "ORDER BY created_at LIMIT 1",
+                (self.owner,)
+            ).fetchone()
+            if row:
+                now = time.time()
+                conn.execute("UPDATE jobs SET status = 'running', owner = ?, updated_at = ?, lease_expires_at = ? WHERE job_id = ?",
+                             (self.owner, now, now + JOB_LEASE_SECONDS, row[0]))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        return row
+
+    def _worker_loop(self):
+        while True:
+            try:
+                claimed = self._claim_next()
+            except sqlite3.Error as e:
+                logging.error(f"Job queue claim failed: {e}")
+                claimed = None
+            if not claimed:
+                # 也定期轮询，以便领取其他进程提交的任务
+                with self._wakeup:
+                    self._wakeup.wait(timeout=2.0)
+                continue
+            self._run(*claimed)
+
+    def _run(self, job_id, options_json):
+        options = json.loads(options_json)
+        options.update(self._secrets.get(job_id, {}))
+        files = self._connection().execute(
+            "SELECT file_index, filename, pdf_path FROM job_files WHERE job_id = ? AND status = 'queued' ORDER BY file_index", (job_id,)
+        ).fetchall()
+        files = [{'file_index': index, 'filename': filename, 'pdf_path': pdf_path} for index, filename, pdf_path in files]
+        logging.info(f"Job {job_id} started ({len(files)} file(s)).")
+        error = None
+        try:
+            self.handler(job_id, files, options, JobReporter(self, job_id))
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed: {e}")
+            error = str(e)
+        finally:
+            self._secrets.pop(job_id, None)
+            with self._partials_lock:
+                self._partials.pop(job_id, None)
+        status = 'failed' if error else 'done'
+        if job_id in self._cancel_requested:
+            self._cancel_requested.discard(job_id)
+            status, error = 'cancelled', JOB_CANCELLED_MESSAGE
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? WHERE job_id = ?",
+                         (status, error, now, now, job_id))
+        self._discard_uploads(job_id)
+        logging.info(f"Job {job_id} {status}.")
+        self._notify_update()
+
+    def cancel(self, job_id):
+        """
+        请求取消任务。排队中的任务直接标记为已取消；本进程正在执行的任务不再读取后续页面，
+        正在生成的页面在收到下一段文本时中止，已完成页面的结果保留。
+
+        返回:
+            str | None: 'cancelled'（已取消）或 'cancelling'（正在停止）；任务不存在、已结束
+                        或正由其他进程执行时返回 None。
+        """
+        now = time.time()
+        with self._connection() as conn:
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', error = ?, updated_at = ?, finished_at = ? WHERE job_id = ? AND status = 'queued'",
+                (JOB_CANCELLED_MESSAGE, now, now, job_id)
+            ).rowcount
+            if cancelled:
+                conn.execute("UPDATE job_files SET status = 'failed', error = ? WHERE job_id = ? AND status != 'done'", (JOB_CANCELLED_MESSAGE, job_id))
+            else:
+                running = conn.execute("SELECT 1 FROM jobs WHERE job_id = ? AND status = 'running' AND owner = ?",
+                                       (job_id, self.owner)).fetchone()
+        if cancelled:
+            self._secrets.pop(job_id, None)
+            self._discard_uploads(job_id)
+            logging.info(f"Job {job_id} cancelled before it started.")
+            self._notify_update()
+            return 'cancelled'
+        if running:
+            self._cancel_requested.add(job_id)
+            logging.info(f"Cancelling job {job_id}.")
+            return 'cancelling'
+        return None
+
+    def _touch(self, conn, job_id):
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def _notify_update(self):
+        with self._updates:
+            self._update_version += 1
+            self._updates.notify_all()
+
+    def update_version(self):
+        """返回本进程内任务进度的版本号，配合 wait_for_update 使用。"""
+        with self._updates:
+            return self._update_version
+
+    def wait_for_update(self, seen_version, timeout):
+        """
+        等待本进程内任一任务出现新进度（版本号不再等于 seen_version），最多 timeout 秒。
+
+        其他进程执行的任务不会触发通知，调用方需以超时作为轮询间隔。
+        """
+        with self._updates:
+            self._updates.wait_for(lambda: self._update_version != seen_version, timeout=timeout)
+            return self._update_version
+
+    def _update_file(self, job_id, file_index, status, page_count=None, summary=None, error=None):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE job_files SET status = ?, page_count = COALESCE(?, page_count), summary = COALESCE(?, summary), error = ? "
+                "WHERE job_id = ? AND file_index = ?",
+                (status, page_count, json.dumps(summary, ensure_ascii=False) if summary is not None else None, error, job_id, file_index)
+            )
+            self._touch(conn, job_id)
+        self._notify_update()
+
+    def _append_partial(self, job_id, file_index, page_number, text):
+        with self._partials_lock:
+            partials = self._partials.setdefault(job_id, {})
+            partials[(file_index, page_number)] = partials.get((file_index, page_number), '') + text
+        self._notify_update()
+
+    def get_partial_results(self, job_id):
+        """
+        返回本进程内该任务正在生成的页面文本。
+
+        返回:
+            list: [(file_index, page_number, 目前已生成的文本)]
+        """
+        with self._partials_lock:
+            return [(file_index, page_number, text) for (file_index, page_number), text in self._partials.get(job_id, {}).items()]
+
+    def _add_page_result(self, job_id, file_index, result):
+        # 先丢弃生成中的文本再写入结果，推送端不会在页面完成后再发出它的片段
+        with self._partials_lock:
+            self._partials.get(job_id, {}).pop((file_index, result.get('page_number')), None)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO job_pages (job_id, file_index, page_number, result, finished_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, file_index, result.get('page_number'), json.dumps(result, ensure_ascii=False), time.time())
+            )
+            self._touch(conn, job_id)
+        self._notify_update()
+
+    def get_page_results_since(self, job_id, after_id=0, limit=100):
+        """
+        按完成顺序返回 after_id 之后完成的至多 limit 个页面结果。
+
+        返回:
+            list: [(事件 ID, file_index, 结果字典)]；事件 ID 单调递增，可作为下次调用的 after_id。
+        """
+        rows = self._connection().execute(
+            "SELECT rowid, file_index, result FROM job_pages WHERE job_id = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+            (job_id, after_id, limit)
+        ).fetchall()
+        return [(event_id, file_index, json.loads(result)) for event_id, file_index, result in rows]
+
+    def get_job(self, job_id, include_results=True):
+        """
+        返回任务的状态、逐文件进度和（可选）已完成页面的结果；任务不存在时返回 None。
+
+        每个文件的 'page_results' 按页码排序；'pages_done' 为已完成的页数，
+        'page_count' 在开始处理该文件后才可知。'last_event_id' 为最近完成页面的事件 ID
+        （见 get_page_results_since），用于从当前进度接续实时推送。
+        """
+        conn = self._connection()
+        job = conn.execute(
+            "SELECT status, error, created_at, updated_at, finished_at FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if not job:
+            return None
+        status, error, created_at, updated_at, finished_at = job
+        files = []
+        for file_index, filename, file_status, page_count, summary, file_error in conn.execute(
+                "SELECT file_index, filename, status, page_count, summary, error FROM job_files WHERE job_id = ? ORDER BY file_index",
+                (job_id,)):
+            files.append({
+                'file_index': file_index,
+                'filename': filename,
+                'status': file_status,
+                'page_count': page_count,
+                'pages_done': 0,
+                'summary': json.loads(summary) if summary else None,
+                'error': file_error,
+                'page_results': [],
+            })
+        for file_index, pages_done in conn.execute(
+                "SELECT file_index, COUNT(*) FROM job_pages WHERE job_id = ? GROUP BY file_index", (job_id,)):
+            files[file_index]['pages_done'] = pages_done
+        if include_results:
+            for file_index, result in conn.execute(
+                    "SELECT file_index, result FROM job_pages WHERE job_id = ? ORDER BY file_index, page_number", (job_id,)):
+                files[file_index]['page_results'].append(json.loads(result))
+
+        last_event_id = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM job_pages WHERE job_id = ?", (job_id,)).fetchone()[0]
+        pages_total = sum(item['page_count'] or 0 for item in files)
+        return {
+            'job_id': job_id,
+            'status': status,
+            'error': error,
+            'created_at': created_at,
+            'updated_at': updated_at,
+            'finished_at': finished_at,
+            'pages_done': sum(item['pages_done'] for item in files),
+            'pages_total': pages_total if all(item['page_count'] is not None for item in files) else None,
+            'last_event_id': last_event_id,
+            'files': files,
+        }
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue(handler=None, cleanup=None):
+    """
+    返回进程内共享的 JobQueue；首次调用时必须提供 handler。无法初始化时返回 None。
+
+    handler(job_id, files, options, reporter) 在工作线程中执行一个任务；
+    cleanup(pdf_path) 可选，在任务过期时删除由该文件派生的输出。
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            if handler is None:
+                return None
+            try:
+                _job_queue = JobQueue(JOB_QUEUE_PATH, handler, cleanup=cleanup)
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Could not initialize job queue at {JOB_QUEUE_PATH}: {e}")
+                return None
+            # 立即启动，使本进程也参与领取重新排队的任务和恢复租约过期的任务
+            _job_queue.start()
+        return _job_queue
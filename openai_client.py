@@ -1,12 +1,19 @@
 import base64
 import os
 import logging
+import mimetypes
+import email.utils
+import time
 import asyncio # For async operations
+import weakref
+import itertools
 import httpx # For async client
-from openai import OpenAI, AsyncOpenAI # Import AsyncOpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, RateLimitError, APIConnectionError, InternalServerError, BadRequestError, UnprocessableEntityError # Import AsyncOpenAI
 from dotenv import load_dotenv
 
-# from rate_limiter import TokenBucketRateLimiter
+import rate_limiter
+import retry_policy
+import client_registry
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,36 +27,73 @@ OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4-vision-preview")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") # Optional, for custom endpoints
 DEFAULT_SYSTEM_PROMPT = os.getenv("DEFAULT_SYSTEM_PROMPT", "Analyze this image and describe its content.")
 
-# Rate Limiter Configuration - assuming same env vars for now, can be made specific
-# API_CALLS_PER_SECOND_OPENAI = float(os.getenv("API_CALLS_PER_SECOND_OPENAI", os.getenv("API_CALLS_PER_SECOND", "1")))
-# API_MAX_TOKENS_OPENAI = float(os.getenv("API_MAX_TOKENS_OPENAI", os.getenv("API_MAX_TOKENS", "5")))
-# openai_rate_limiter = TokenBucketRateLimiter(tokens_per_second=API_CALLS_PER_SECOND_OPENAI, max_tokens=API_MAX_TOKENS_OPENAI)
-# logging.info(f"OpenAI rate limiter configured: {API_CALLS_PER_SECOND_OPENAI} tokens/sec, max {API_MAX_TOKENS_OPENAI} tokens.")
+# Rate limits, applied per base URL and API key (0 = unlimited)
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))
+# Tokens reserved from the TPM bucket before each request; corrected from response.usage afterwards
+OPENAI_TOKENS_PER_REQUEST_ESTIMATE = int(os.getenv("OPENAI_TOKENS_PER_REQUEST_ESTIMATE", "2000"))
+OPENAI_MAX_OUTPUT_TOKENS = 1024
+
+# Per-request timeout; retries are done by retry_policy (backoff, jitter, circuit breaker),
+# so the SDK's own retries are disabled for analysis clients
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+_ANALYSIS_CLIENT_OPTIONS = {"max_retries": 0, "timeout": OPENAI_TIMEOUT_SECONDS}
+RETRY_POLICY = retry_policy.RetryPolicy()
+logging.info(f"OpenAI rate limits: {OPENAI_RPM or 'unlimited'} RPM, {OPENAI_TPM or 'unlimited'} TPM per base URL and API key.")
 
 
 if not OPENAI_API_KEY:
     logging.warning("OPENAI_API_KEY not found in .env. Will rely on UI input if provided.")
 
-# Initialize OpenAI client - this will be the default client if no overrides are given
-# It might fail if OPENAI_API_KEY is not set, which is handled in analyze_image_openai
-_default_client = None
-_default_async_client = None # For async operations
+# Clients are pooled per (API key, base URL) so that pages and requests reuse the same
+# HTTP connection pool (keep-alive, TLS sessions) instead of building a client per call.
+# Async clients are additionally keyed by event loop, since their connections are bound to it.
+# Each pooled client gets an HTTP client we create ourselves, so an evicted client's
+# connection pool can be closed once the client is no longer referenced
+_http_clients = weakref.WeakKeyDictionary() # OpenAI client -> its httpx.Client
+# Base URLs whose server rejected stream_options; streams to them are opened without it
+_stream_usage_unsupported = set()
+_client_registry = client_registry.ClientRegistry("OpenAI clients", release=lambda client: _http_clients[client].close)
+# Async clients are closed on the event loop their connections belong to
+_async_http_clients = weakref.WeakKeyDictionary() # AsyncOpenAI client -> (event loop, its httpx.AsyncClient)
+_async_client_registry = client_registry.ClientRegistry(
+    "OpenAI async clients",
+    release=lambda client: client_registry.close_on_loop(_async_http_clients[client][0], _async_http_clients[client][1].aclose)
+)
+
+
+def get_openai_client(api_key, base_url=None):
+    """Returns a pooled OpenAI client for this API key and base URL."""
+    def _create():
+        http_client = DefaultHttpxClient()
+        if base_url:
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, **_ANALYSIS_CLIENT_OPTIONS)
+        else:
+            client = OpenAI(api_key=api_key, http_client=http_client, **_ANALYSIS_CLIENT_OPTIONS)
+        _http_clients[client] = http_client
+        return client
+    return _client_registry.get((api_key, base_url or None), _create)
+
 
-if OPENAI_API_KEY:
-    try:
-        if OPENAI_BASE_URL:
-            _default_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-            _default_async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+def get_async_openai_client(api_key, base_url=None):
+    """Returns a pooled AsyncOpenAI client for this API key and base URL on the running event loop."""
+    loop = asyncio.get_running_loop()
+
+    def _create():
+        http_client = DefaultAsyncHttpxClient()
+        if base_url:
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, **_ANALYSIS_CLIENT_OPTIONS)
         else:
-            _default_client = OpenAI(api_key=OPENAI_API_KEY)
-            _default_async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-        logging.info("Default OpenAI sync and async clients initialized with .env settings.")
-    except Exception as e:
-        logging.error(f"Failed to initialize default OpenAI clients with .env settings: {e}")
-        _default_client = None
-        _default_async_client = None
-else:
-    logging.info("Default OpenAI clients not initialized as OPENAI_API_KEY is missing in .env.")
+            client = AsyncOpenAI(api_key=api_key, http_client=http_client, **_ANALYSIS_CLIENT_OPTIONS)
+        _async_http_clients[client] = (loop, http_client)
+        return client
+    # Clients created on loops that have since been closed can never be used again
+    return _async_client_registry.get((loop, api_key, base_url or None), _create, is_stale=lambda key: key[0].is_closed())
+
+
+def client_pool_stats():
+    return [_client_registry.stats(), _async_client_registry.stats()]
+
 
 
 def encode_image_to_base64(image_path):
@@ -64,22 +108,77 @@ def encode_image_to_base64(image_path):
         logging.error(f"Error encoding image {image_path}: {e}")
         return None
 
+def build_image_data_url(image_path: str = None, image_bytes: bytes = None, image_mime_type: str = None) -> str | None:
+    """
+    Builds a base64 data URL for either in-memory image bytes or a local image file.
+
+    In-memory bytes are used as-is, so no disk read is needed. The MIME type defaults
+    to one guessed from the file extension, falling back to image/png.
+    """
+    if image_bytes is not None:
+        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    else:
+        base64_image = encode_image_to_base64(image_path)
+    if not base64_image:
+        return None
+    mime_type = image_mime_type or (mimetypes.guess_type(image_path)[0] if image_path else None) or "image/png"
+    return f"data:{mime_type};base64,{base64_image}"
+
+def _rate_limits(api_key, base_url):
+    return rate_limiter.get_provider_limits("openai", base_url, api_key, OPENAI_RPM, OPENAI_TPM, OPENAI_TOKENS_PER_REQUEST_ESTIMATE)
+
+def _usage_total_tokens(response):
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None) if usage else None
+
+def _retry_after_seconds(error):
+    """Reads Retry-After (seconds or HTTP date) or retry-after-ms from a rate-limit error response."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _is_retryable_error(error):
+    """Timeouts, connection errors, 5xx and 429 are transient; other API errors (400, 401, ...) are not."""
+    return isinstance(error, (APIConnectionError, InternalServerError, RateLimitError))
+
+def _is_stream_failure(error):
+    # Reading a stream can also fail with a bare transport error (dropped connection, read timeout)
+    return _is_retryable_error(error) or isinstance(error, httpx.TransportError)
+
+def _counts_as_outage(error):
+    # A 429 means the endpoint is up, just throttling us; AIMD handles that, not the circuit breaker
+    return not isinstance(error, RateLimitError)
+
 def analyze_image_openai(
-    image_path: str,
+    image_path: str = None,
     system_prompt_override: str = None,
     api_key_override: str = None,
     model_name_override: str = None,
-    base_url_override: str = None
+    base_url_override: str = None,
+    image_bytes: bytes = None,
+    image_mime_type: str = None
 ) -> str | None:
     """
     Analyzes an image using the OpenAI API, allowing for API key and model overrides.
 
     Args:
-        image_path: Path to the local image file.
+        image_path: Path to the local image file. Used only as a label when image_bytes is given.
         system_prompt_override: Optional system prompt to override the default.
         api_key_override: Optional API key to use instead of the one from .env.
         model_name_override: Optional model name to use.
         base_url_override: Optional base URL for the OpenAI API.
+        image_bytes: Optional already-encoded image bytes (e.g. a rendered PDF page kept in memory).
+        image_mime_type: MIME type of image_bytes, e.g. "image/png".
 
     Returns:
         The analysis text from OpenAI, or None if an error occurs.
@@ -92,82 +191,308 @@ def analyze_image_openai(
         logging.error("OpenAI API key is not configured (neither in .env nor via UI). Cannot analyze image.")
         return "Error: OpenAI API key not configured."
 
-    # Determine which client to use
-    active_client = _default_client
-    # If overrides are present that differ from the default client's config, create a temporary client
-    if (api_key_override and api_key_override != OPENAI_API_KEY) or \
-       (base_url_override and base_url_override != OPENAI_BASE_URL) or \
-       (not _default_client and current_api_key): # If default client failed to init but we have a key now
-        try:
-            logging.info("Creating temporary OpenAI client due to override or missing default client.")
-            if current_base_url:
-                active_client = OpenAI(api_key=current_api_key, base_url=current_base_url)
-            else:
-                active_client = OpenAI(api_key=current_api_key)
-        except Exception as e:
-            logging.error(f"Failed to initialize temporary OpenAI client with overrides: {e}")
-            return f"Error: Failed to initialize OpenAI client: {e}"
-    
-    if not active_client:
-        logging.error("OpenAI client could not be initialized. Cannot analyze image.")
-        return "Error: OpenAI client initialization failed."
+    try:
+        active_client = get_openai_client(current_api_key, current_base_url)
+    except Exception as e:
+        logging.error(f"Failed to initialize OpenAI client: {e}")
+        return f"Error: Failed to initialize OpenAI client: {e}"
 
 
-    base64_image = encode_image_to_base64(image_path)
-    if not base64_image:
+    image_label = image_path or "in-memory image"
+    image_data_url = build_image_data_url(image_path, image_bytes, image_mime_type)
+    if not image_data_url:
         return "Error: Could not encode image."
 
     final_system_prompt = system_prompt_override if system_prompt_override and system_prompt_override.strip() else DEFAULT_SYSTEM_PROMPT
     
-    logging.info(f"Analyzing image {image_path} with OpenAI model {current_model_name} using system prompt: '{final_system_prompt}'")
-
-    # Consume a token before making the API call
-    # if not openai_rate_limiter.consume(1):
-    #     logging.warning(f"OpenAI rate limit exceeded for {image_path}. Waiting for token...")
-    #     import time # Ensure time is imported
-    #     time.sleep(1.0 / openai_rate_limiter.tokens_per_second if openai_rate_limiter.tokens_per_second > 0 else 1.0)
-    #     if not openai_rate_limiter.consume(1):
-    #         logging.error(f"Still rate limited after waiting for OpenAI call for {image_path}. Aborting.")
-    #         return f"Error: OpenAI Rate limit exceeded for {image_path}."
-    # logging.info(f"OpenAI token consumed for {image_path}. Proceeding with API call.")
+    logging.info(f"Analyzing image {image_label} with OpenAI model {current_model_name} using system prompt: '{final_system_prompt}'")
 
-    try:
-        response = active_client.chat.completions.create(
-            model=current_model_name,
-            messages=[
-                {
-                    "role": "system",
-                    "content": final_system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}" # Assuming PNG, adjust if other formats are common
+    limits = _rate_limits(current_api_key, current_base_url)
+    breaker = retry_policy.get_circuit_breaker("openai", current_base_url)
+
+    def _send():
+        # Every attempt waits for room in this endpoint/key's RPM and TPM budgets
+        limits.acquire(OPENAI_TOKENS_PER_REQUEST_ESTIMATE)
+        try:
+            response = active_client.chat.completions.create(
+                model=current_model_name,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": final_system_prompt
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": image_data_url
+                                }
                             }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1024 # Adjust as needed
-        )
+                        ]
+                    }
+                ],
+                max_tokens=OPENAI_MAX_OUTPUT_TOKENS
+            )
+        except RateLimitError as e:
+            limits.on_rate_limited(_retry_after_seconds(e))
+            raise
+        limits.record_usage(OPENAI_TOKENS_PER_REQUEST_ESTIMATE, _usage_total_tokens(response))
+        limits.on_success()
+        return response
+
+    try:
+        response = retry_policy.call_with_retry(_send, RETRY_POLICY, breaker, _is_retryable_error, _counts_as_outage, label=image_label)
         
         if response.choices and response.choices[0].message and response.choices[0].message.content:
             analysis_text = response.choices[0].message.content.strip()
-            logging.info(f"OpenAI analysis successful for {image_path}.")
+            logging.info(f"OpenAI analysis successful for {image_label}.")
             return analysis_text
         else:
-            logging.error(f"OpenAI API response did not contain expected content for {image_path}. Response: {response}")
+            logging.error(f"OpenAI API response did not contain expected content for {image_label}. Response: {response}")
             return "Error: OpenAI API response was empty or malformed."
 
+    except retry_policy.CircuitOpenError as e:
+        logging.error(f"OpenAI call skipped: {e}")
+        return f"Error: {e}"
+    except RateLimitError as e:
+        logging.error(f"OpenAI rate limit hit for {image_label}: {e}")
+        return f"Error: OpenAI rate limit exceeded: {e}"
     except Exception as e:
-        logging.error(f"Error during OpenAI API call for {image_path}: {e}")
+        logging.error(f"Error during OpenAI API call for {image_label}: {e}")
         if "OPENAI_API_KEY" in str(e).upper() or "AUTHENTICATION" in str(e).upper():
              return "Error: OpenAI API request failed. Check API key and permissions."
         return f"Error: An exception occurred during OpenAI API call: {e}"
 
+def analyze_image_openai_stream(
+    image_path: str = None,
+    system_prompt_override: str = None,
+    api_key_override: str = None,
+    model_name_override: str = None,
+    base_url_override: str = None,
+    image_bytes: bytes = None,
+    image_mime_type: str = None
+):
+    """
+    Streaming variant of analyze_image_openai: yields the analysis text in deltas as the
+    model generates it (chat completions with stream=True). Accepts the same arguments.
+
+    A failure before any text is produced is yielded as a single "Error: ..." chunk, the same
+    text analyze_image_openai would return. Opening the stream and receiving its first chunk
+    are retried like a non-streaming call; an error after text has been yielded is raised,
+    since the partial output has already been consumed. Failures while reading the stream
+    count towards the circuit breaker and rate limiter just like failures opening it, and the
+    usage reported on the final chunk (requested via stream_options) replaces the TPM estimate.
+    Endpoints that reject stream_options are remembered and streamed without it.
+    Closing the generator early (e.g. to cut off a runaway generation) closes the HTTP
+    response, which stops the generation server-side.
+    """
+    current_api_key = api_key_override if api_key_override and api_key_override.strip() else OPENAI_API_KEY
+    current_base_url = base_url_override if base_url_override and base_url_override.strip() else OPENAI_BASE_URL
+    current_model_name = model_name_override if model_name_override and model_name_override.strip() else OPENAI_MODEL_NAME
+
+    if not current_api_key:
+        logging.error("OpenAI API key is not configured (neither in .env nor via UI). Cannot analyze image.")
+        yield "Error: OpenAI API key not configured."
+        return
+
+    image_label = image_path or "in-memory image"
+    image_data_url = build_image_data_url(image_path, image_bytes, image_mime_type)
+    if not image_data_url:
+        yield "Error: Could not encode image."
+        return
+
+    final_system_prompt = system_prompt_override if system_prompt_override and system_prompt_override.strip() else DEFAULT_SYSTEM_PROMPT
+    logging.info(f"Streaming analysis of {image_label} with OpenAI model {current_model_name}")
+
+    limits = _rate_limits(current_api_key, current_base_url)
+    breaker = retry_policy.get_circuit_breaker("openai", current_base_url)
+
+    def _open_stream():
+        request = dict(
+            model=current_model_name,
+            messages=[
+                {"role": "system", "content": final_system_prompt},
+                {"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url}}
+                ]}
+            ],
+            max_tokens=OPENAI_MAX_OUTPUT_TOKENS,
+            stream=True
+        )
+        client = get_openai_client(current_api_key, current_base_url)
+        if current_base_url in _stream_usage_unsupported:
+            return client.chat.completions.create(**request)
+        try:
+            # Without this, streamed responses carry no usage and the TPM estimate is never corrected
+            return client.chat.completions.create(stream_options={"include_usage": True}, **request)
+        except (BadRequestError, UnprocessableEntityError) as e:
+            # Some OpenAI-compatible servers reject parameters they do not know; stream without usage
+            try:
+                stream = client.chat.completions.create(**request)
+            except Exception:
+                raise e
+            _stream_usage_unsupported.add(current_base_url)
+            logging.warning(f"OpenAI endpoint {current_base_url or 'default'} rejected stream_options ({e}); "
+                            f"streaming without usage reports, token usage stays estimated.")
+            return stream
+
+    def _send():
+        # The first chunk is read here, so a stream that fails before producing anything is retried
+        limits.acquire(OPENAI_TOKENS_PER_REQUEST_ESTIMATE)
+        stream = None
+        try:
+            stream = _open_stream()
+            chunks = iter(stream)
+            first_chunk = next(chunks, None)
+        except Exception as e:
+            if stream is not None:
+                stream.close()
+            if isinstance(e, RateLimitError):
+                limits.on_rate_limited(_retry_after_seconds(e))
+            raise
+        limits.on_success()
+        return stream, chunks, first_chunk
+
+    try:
+        stream, chunks, first_chunk = retry_policy.call_with_retry(_send, RETRY_POLICY, breaker, _is_stream_failure, _counts_as_outage,
+                                                           label=image_label)
+    except retry_policy.CircuitOpenError as e:
+        logging.error(f"OpenAI call skipped: {e}")
+        yield f"Error: {e}"
+        return
+    except RateLimitError as e:
+        logging.error(f"OpenAI rate limit hit for {image_label}: {e}")
+        yield f"Error: OpenAI rate limit exceeded: {e}"
+        return
+    except Exception as e:
+        logging.error(f"Error opening OpenAI stream for {image_label}: {e}")
+        if "OPENAI_API_KEY" in str(e).upper() or "AUTHENTICATION" in str(e).upper():
+            yield "Error: OpenAI API request failed. Check API key and permissions."
+        else:
+            yield f"Error: An exception occurred during OpenAI API call: {e}"
+        return
+
+    produced = False
+    total_tokens = None
+    completed = False
+    failure = None
+    try:
+        for chunk in itertools.chain([first_chunk] if first_chunk is not None else [], chunks):
+            # The usage chunk requested via stream_options comes last, with no choices
+            total_tokens = _usage_total_tokens(chunk) or total_tokens
+            delta = chunk.choices[0].delta.content if chunk.choices and chunk.choices[0].delta else None
+            if delta:
+                produced = True
+                yield delta
+        completed = True
+    except Exception as e:
+        # Same bookkeeping call_with_retry and _send do for a failed attempt
+        if isinstance(e, RateLimitError):
+            limits.on_rate_limited(_retry_after_seconds(e))
+        if _is_stream_failure(e) and _counts_as_outage(e):
+            breaker.record_failure()
+        if produced:
+            raise
+        failure = e
+    finally:
+        stream.close()
+        if not completed:
+            logging.info(f"OpenAI stream for {image_label} closed before the generation finished.")
+        limits.record_usage(OPENAI_TOKENS_PER_REQUEST_ESTIMATE, total_tokens)
+
+    if failure is not None:
+        logging.error(f"OpenAI stream for {image_label} failed before producing text: {failure}")
+        yield f"Error: An exception occurred during OpenAI API call: {failure}"
+    elif produced:
+        logging.info(f"OpenAI streaming analysis successful for {image_label}.")
+    else:
+        logging.error(f"OpenAI stream for {image_label} contained no content.")
+        yield "Error: OpenAI API response was empty or malformed."
+
+def analyze_image_pack_openai(
+    parts: list,
+    system_prompt_override: str = None,
+    api_key_override: str = None,
+    model_name_override: str = None,
+    base_url_override: str = None,
+    label: str = "image pack"
+) -> str:
+    """
+    Analyzes several images in one chat completion request.
+
+    Args:
+        parts: ordered message content: text strings (e.g. page markers) and image dicts
+               with image_path, or image_bytes and image_mime_type.
+        label: used in log and error messages.
+        Other arguments as for analyze_image_openai.
+
+    Returns:
+        The full response text, or an "Error: ..." string. The output token limit and the
+        rate-limit reservation scale with the number of images.
+    """
+    current_api_key = api_key_override if api_key_override and api_key_override.strip() else OPENAI_API_KEY
+    current_base_url = base_url_override if base_url_override and base_url_override.strip() else OPENAI_BASE_URL
+    current_model_name = model_name_override if model_name_override and model_name_override.strip() else OPENAI_MODEL_NAME
+
+    if not current_api_key:
+        logging.error("OpenAI API key is not configured (neither in .env nor via UI). Cannot analyze images.")
+        return "Error: OpenAI API key not configured."
+
+    content = []
+    for part in parts:
+        if isinstance(part, str):
+            content.append({"type": "text", "text": part})
+            continue
+        image_data_url = build_image_data_url(part.get('image_path'), part.get('image_bytes'), part.get('image_mime_type'))
+        if not image_data_url:
+            return "Error: Could not encode image."
+        content.append({"type": "image_url", "image_url": {"url": image_data_url}})
+    image_count = sum(1 for part in parts if not isinstance(part, str))
+
+    final_system_prompt = system_prompt_override if system_prompt_override and system_prompt_override.strip() else DEFAULT_SYSTEM_PROMPT
+    logging.info(f"Analyzing {label} ({image_count} images) in one request with OpenAI model {current_model_name}")
+
+    limits = _rate_limits(current_api_key, current_base_url)
+    breaker = retry_policy.get_circuit_breaker("openai", current_base_url)
+    token_estimate = OPENAI_TOKENS_PER_REQUEST_ESTIMATE * image_count
+
+    def _send():
+        limits.acquire(token_estimate)
+        try:
+            response = get_openai_client(current_api_key, current_base_url).chat.completions.create(
+                model=current_model_name,
+                messages=[
+                    {"role": "system", "content": final_system_prompt},
+                    {"role": "user", "content": content}
+                ],
+                max_tokens=OPENAI_MAX_OUTPUT_TOKENS * image_count
+            )
+        except RateLimitError as e:
+            limits.on_rate_limited(_retry_after_seconds(e))
+            raise
+        limits.record_usage(token_estimate, _usage_total_tokens(response))
+        limits.on_success()
+        return response
+
+    try:
+        response = retry_policy.call_with_retry(_send, RETRY_POLICY, breaker, _is_retryable_error, _counts_as_outage, label=label)
+        if response.choices and response.choices[0].message and response.choices[0].message.content:
+            logging.info(f"OpenAI analysis successful for {label}.")
+            return response.choices[0].message.content.strip()
+        logging.error(f"OpenAI API response did not contain expected content for {label}.")
+        return "Error: OpenAI API response was empty or malformed."
+    except retry_policy.CircuitOpenError as e:
+        logging.error(f"OpenAI call skipped: {e}")
+        return f"Error: {e}"
+    except RateLimitError as e:
+        logging.error(f"OpenAI rate limit hit for {label}: {e}")
+        return f"Error: OpenAI rate limit exceeded: {e}"
+    except Exception as e:
+        logging.error(f"Error during OpenAI API call for {label}: {e}")
+        return f"Error: An exception occurred during OpenAI API call: {e}"
+
 def list_openai_models(api_key_override: str = None, base_url_override: str = None):
     """
     Lists available OpenAI models, attempting to filter for vision-capable ones.
@@ -179,12 +504,9 @@ def list_openai_models(api_key_override: str = None, base_url_override: str = No
         logging.error("OpenAI API key not configured to list models.")
         return {"error": "API key not configured."}
 
-    temp_client = None
     try:
-        if current_base_url:
-            temp_client = OpenAI(api_key=current_api_key, base_url=current_base_url)
-        else:
-            temp_client = OpenAI(api_key=current_api_key)
+        # Reuse the pooled client's connections, but keep the SDK's default retries for this one-off call
+        temp_client = get_openai_client(current_api_key, current_base_url).with_options(max_retries=2)
         logging.info("Fetching list of OpenAI models...")
         
         models_list = temp_client.models.list()
@@ -216,14 +538,17 @@ def list_openai_models(api_key_override: str = None, base_url_override: str = No
         return {"error": f"Failed to list OpenAI models: {str(e)}"}
 
 async def analyze_image_openai_async(
-    image_path: str,
+    image_path: str = None,
     system_prompt_override: str = None,
     api_key_override: str = None,
     model_name_override: str = None,
-    base_url_override: str = None
+    base_url_override: str = None,
+    image_bytes: bytes = None,
+    image_mime_type: str = None
 ) -> str | None:
     """
     Asynchronously analyzes an image using the OpenAI API.
+    Accepts the same arguments as analyze_image_openai, including in-memory image_bytes.
     """
     current_api_key = api_key_override if api_key_override and api_key_override.strip() else OPENAI_API_KEY
     current_base_url = base_url_override if base_url_override and base_url_override.strip() else OPENAI_BASE_URL
@@ -233,57 +558,63 @@ async def analyze_image_openai_async(
         logging.error("Async OpenAI: API key is not configured. Cannot analyze image.")
         return "Error: OpenAI API key not configured."
 
-    active_async_client = _default_async_client
-    if (api_key_override and api_key_override != OPENAI_API_KEY) or \
-       (base_url_override and base_url_override != OPENAI_BASE_URL) or \
-       (not _default_async_client and current_api_key):
-        try:
-            logging.info("Async OpenAI: Creating temporary async client due to override or missing default.")
-            if current_base_url:
-                active_async_client = AsyncOpenAI(api_key=current_api_key, base_url=current_base_url)
-            else:
-                active_async_client = AsyncOpenAI(api_key=current_api_key)
-        except Exception as e:
-            logging.error(f"Async OpenAI: Failed to initialize temporary async client: {e}")
-            return f"Error: Failed to initialize OpenAI async client: {e}"
-    
-    if not active_async_client:
-        logging.error("Async OpenAI: Client could not be initialized.")
-        return "Error: OpenAI async client initialization failed."
+    try:
+        active_async_client = get_async_openai_client(current_api_key, current_base_url)
+    except Exception as e:
+        logging.error(f"Async OpenAI: Failed to initialize async client: {e}")
+        return f"Error: Failed to initialize OpenAI async client: {e}"
 
-    base64_image = encode_image_to_base64(image_path) # This is sync, consider aiofiles for full async
-    if not base64_image:
+    image_label = image_path or "in-memory image"
+    image_data_url = build_image_data_url(image_path, image_bytes, image_mime_type) # File reads are sync, consider aiofiles for full async
+    if not image_data_url:
         return "Error: Could not encode image."
 
     final_system_prompt = system_prompt_override if system_prompt_override and system_prompt_override.strip() else DEFAULT_SYSTEM_PROMPT
     
-    logging.info(f"Async OpenAI: Analyzing {image_path} with model {current_model_name}")
+    logging.info(f"Async OpenAI: Analyzing {image_label} with model {current_model_name}")
+
+    limits = _rate_limits(current_api_key, current_base_url)
+    breaker = retry_policy.get_circuit_breaker("openai", current_base_url)
 
-    # await openai_rate_limiter.consume_async(1)
-    # logging.info(f"Async OpenAI: Token consumed for {image_path}. Proceeding.")
+    async def _send():
+        await limits.acquire_async(OPENAI_TOKENS_PER_REQUEST_ESTIMATE)
+        try:
+            response = await active_async_client.chat.completions.create(
+                model=current_model_name,
+                messages=[
+                    {"role": "system", "content": final_system_prompt},
+                    {"role": "user", "content": [
+                        {"type": "image_url", "image_url": {"url": image_data_url}}
+                    ]}
+                ],
+                max_tokens=OPENAI_MAX_OUTPUT_TOKENS
+            )
+        except RateLimitError as e:
+            limits.on_rate_limited(_retry_after_seconds(e))
+            raise
+        limits.record_usage(OPENAI_TOKENS_PER_REQUEST_ESTIMATE, _usage_total_tokens(response))
+        limits.on_success()
+        return response
 
     try:
-        response = await active_async_client.chat.completions.create(
-            model=current_model_name,
-            messages=[
-                {"role": "system", "content": final_system_prompt},
-                {"role": "user", "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}}
-                ]}
-            ],
-            max_tokens=1024
-        )
+        response = await retry_policy.call_with_retry_async(_send, RETRY_POLICY, breaker, _is_retryable_error, _counts_as_outage, label=image_label)
         
         if response.choices and response.choices[0].message and response.choices[0].message.content:
             analysis_text = response.choices[0].message.content.strip()
-            logging.info(f"Async OpenAI: Analysis successful for {image_path}.")
+            logging.info(f"Async OpenAI: Analysis successful for {image_label}.")
             return analysis_text
         else:
-            logging.error(f"Async OpenAI: API response did not contain expected content for {image_path}.")
+            logging.error(f"Async OpenAI: API response did not contain expected content for {image_label}.")
             return "Error: OpenAI API response was empty or malformed."
 
+    except retry_policy.CircuitOpenError as e:
+        logging.error(f"Async OpenAI: Call skipped: {e}")
+        return f"Error: {e}"
+    except RateLimitError as e:
+        logging.error(f"Async OpenAI: Rate limit hit for {image_label}: {e}")
+        return f"Error: OpenAI rate limit exceeded: {e}"
     except Exception as e:
-        logging.error(f"Async OpenAI: Error during API call for {image_path}: {e}")
+        logging.error(f"Async OpenAI: Error during API call for {image_label}: {e}")
         return f"Error: An exception occurred during async OpenAI API call: {e}"
 
 
@@ -0,0 +1,683 @@
+import os
+import re
+import json
+import math
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# LLM 客户端按需加载：任一客户端加载失败时，仍可使用另一个提供商
+try:
+    import gemini_client
+except ImportError as e:
+    logging.error(f"Error importing gemini_client in page_analysis: {e}")
+    gemini_client = None
+try:
+    import openai_client
+except ImportError as e:
+    logging.error(f"Error importing openai_client in page_analysis: {e}")
+    openai_client = None
+
+import result_cache
+import page_dedup
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SUPPORTED_PROVIDERS = ['gemini', 'openai', 'volcano', 'google']
+OPENAI_COMPATIBLE_PROVIDERS = ['openai', 'volcano', 'google'] # 通过 openai_client 调用
+
+# 单个文件内同时进行的 LLM 页面分析请求数上限
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 4))
+# 并发度的硬上限：上传表单和调用方传入的值都会被限制在 1..LLM_MAX_CONCURRENCY_LIMIT
+LLM_MAX_CONCURRENCY_LIMIT = int(os.getenv('LLM_MAX_CONCURRENCY_LIMIT', 32))
+
+# 流水线模式下已产出但尚未分析完成的页面数上限（背压），默认为并发度的两倍
+LLM_MAX_PENDING_PAGES = int(os.getenv('LLM_MAX_PENDING_PAGES', 0))
+
+# Gemini 用户提示固定，指令部分由系统提示负责
+DEFAULT_USER_PROMPT = "请分析这张图片。"
+
+# 上传前的分辨率预算 (最长边像素, 总像素数)，0 表示不限制。提供商在服务端也会缩小过大的图像，
+# 超出部分只会增加上传流量和 base64 开销。OpenAI 高细节模式先缩放到 2048x2048 以内，再把短边缩到 768。
+DEFAULT_RESOLUTION_BUDGETS = {
+    'openai': (2048, 768 * 2048),
+    'volcano': (2048, 768 * 2048),
+    'google': (3072, 0),
+    'gemini': (3072, 0),
+}
+# JSON 覆盖，例如 {"openai": [1536, 0], "gemini/gemini-1.5-flash": [2048, 0], "volcano": null}；
+# 键为提供商或 "提供商/模型名前缀"，值为 null 表示不限制
+try:
+    IMAGE_RESOLUTION_BUDGETS = json.loads(os.getenv('IMAGE_RESOLUTION_BUDGETS') or '{}')
+except ValueError as e:
+    logging.error(f"IMAGE_RESOLUTION_BUDGETS is not valid JSON, ignoring it: {e}")
+    IMAGE_RESOLUTION_BUDGETS = {}
+
+# 发送给 LLM 的图像编码格式和质量，与磁盘预览格式 (PDF_IMAGE_FORMAT) 相互独立。
+# 留空表示与预览格式相同；可按提供商覆盖，例如 LLM_IMAGE_CODEC_GEMINI=WEBP、LLM_IMAGE_QUALITY_OPENAI=80
+LLM_IMAGE_CODEC = os.getenv('LLM_IMAGE_CODEC', '').strip().upper()
+LLM_IMAGE_QUALITY = int(os.getenv('LLM_IMAGE_QUALITY', 85))
+
+# 空白页不调用 LLM，直接使用此文本作为分析结果
+BLANK_PAGE_ANALYSIS = os.getenv('BLANK_PAGE_ANALYSIS', "（空白页）")
+
+# 客户端返回的错误文本前缀
+ERROR_ANALYSIS_PREFIXES = ("Error:", "错误", "An unexpected error occurred", "分析图像时出错", "未能分析此图像")
+
+# 以流式方式调用 LLM，边生成边产出文本：可把生成中的文本实时推送到浏览器，并提前中止失控的生成
+LLM_STREAM_OUTPUT = os.getenv('LLM_STREAM_OUTPUT', 'true').lower() in ('1', 'true', 'yes')
+# 单页分析文本超过此字符数时中止生成并截断（例如模型陷入重复输出），0 表示不限制；仅在流式调用时生效
+LLM_MAX_OUTPUT_CHARS = int(os.getenv('LLM_MAX_OUTPUT_CHARS', 0))
+TRUNCATED_ANALYSIS_NOTE = "\n\n[输出超过 {max_chars} 个字符，已中止生成]"
+CANCELLED_ANALYSIS = "错误: 任务已取消，此页分析未完成。"
+
+# 多页打包：把至多 LLM_PACK_PAGES 页图像放进同一个请求，系统提示和请求开销由这些页面分摊（1 = 不打包）。
+# 每个请求中图像的估计输入 Token 不超过 LLM_PACK_TOKEN_BUDGET；响应按页面标记拆分，拆分失败时逐页重新分析
+LLM_PACK_PAGES = int(os.getenv('LLM_PACK_PAGES', 1))
+LLM_PACK_TOKEN_BUDGET = int(os.getenv('LLM_PACK_TOKEN_BUDGET', 8000))
+PACK_PAGE_MARKER = "[[PAGE {index}]]"
+PACK_PAGE_MARKER_PATTERN = re.compile(r'^[ \t]*\[\[PAGE (\d+)\]\][ \t]*$', re.MULTILINE)
+PACK_INSTRUCTION = ("以下共有 {count} 页图像，每页图像前有一行页面标记（{first} 到 {last}）。"
+                    "请按系统提示分别处理每一页：每页的输出以单独一行的相同标记开头，按顺序输出全部 {count} 页，"
+                    "不要合并页面，也不要输出其他标记。")
+
+
+def _page_image_source(page):
+    """
+    将页面输入统一为 (image_path, image_bytes, mime_type, page_number)。
+
+    page 可以是 pdf_processor.PageImage（内存中的已编码图像，image_path 可能为空），
+    也可以是磁盘上的图像路径字符串。
+    """
+    if isinstance(page, str):
+        return page, None, None, None
+    return page.image_path, page.data, page.mime_type, page.page_number
+
+
+def resolve_llm_identity(llm_options):
+    """
+    解析实际生效的提供商、端点、模型和提示词（应用客户端的默认值）。
+
+    用于构造缓存键：同一页面在相同身份下的分析结果可以复用。
+    """
+    provider = llm_options.get('provider')
+    model_name = (llm_options.get('model_name') or '').strip()
+    system_prompt = (llm_options.get('system_prompt') or '').strip()
+    identity = {'provider': provider, 'endpoint': None, 'model_name': model_name,
+                'system_prompt': system_prompt, 'user_prompt': None}
+    if provider in OPENAI_COMPATIBLE_PROVIDERS and openai_client:
+        identity['endpoint'] = (llm_options.get('openai_base_url') or '').strip() or openai_client.OPENAI_BASE_URL
+        identity['model_name'] = model_name or openai_client.OPENAI_MODEL_NAME
+        identity['system_prompt'] = system_prompt or openai_client.DEFAULT_SYSTEM_PROMPT
+    elif provider == 'gemini' and gemini_client:
+        identity['model_name'] = model_name or gemini_client.GEMINI_VISION_MODEL
+        identity['system_prompt'] = system_prompt or gemini_client.DEFAULT_SYSTEM_PROMPT
+        identity['user_prompt'] = llm_options.get('user_prompt', DEFAULT_USER_PROMPT)
+    return identity
+
+
+def resolve_resolution_budget(llm_options):
+    """
+    返回当前提供商/模型的分辨率预算 (最长边像素, 总像素数)，不限制时返回 None。
+
+    优先使用 IMAGE_RESOLUTION_BUDGETS 中最长匹配的 "提供商/模型名前缀"，其次是提供商本身，
+    最后是 DEFAULT_RESOLUTION_BUDGETS。
+    """
+    identity = resolve_llm_identity(llm_options)
+    provider, model_name = identity['provider'], identity['model_name'] or ''
+    budget = DEFAULT_RESOLUTION_BUDGETS.get(provider)
+    best_prefix_len = -1
+    for key, value in IMAGE_RESOLUTION_BUDGETS.items():
+        key_provider, _, model_prefix = key.partition('/')
+        if key_provider != provider or not model_name.startswith(model_prefix):
+            continue
+        if len(model_prefix) > best_prefix_len:
+            budget, best_prefix_len = value, len(model_prefix)
+    if not budget or not any(budget):
+        return None
+    return int(budget[0] or 0), int(budget[1] or 0)
+
+
+def resolve_upload_codec(llm_options):
+    """
+    返回当前提供商的上传图像编码 (格式, 质量)。格式为 None 表示与预览格式相同。
+
+    LLM_IMAGE_CODEC_<PROVIDER> / LLM_IMAGE_QUALITY_<PROVIDER> 优先于 LLM_IMAGE_CODEC / LLM_IMAGE_QUALITY。
+    """
+    suffix = (llm_options.get('provider') or '').upper()
+    codec = os.getenv(f'LLM_IMAGE_CODEC_{suffix}', '').strip().upper() or LLM_IMAGE_CODEC or None
+    quality = int(os.getenv(f'LLM_IMAGE_QUALITY_{suffix}') or LLM_IMAGE_QUALITY)
+    return codec, quality
+
+
+def is_error_analysis(analysis):
+    """判断分析文本是否为客户端返回的错误信息（错误结果不写入缓存）。"""
+    return not analysis or analysis.startswith(ERROR_ANALYSIS_PREFIXES)
+
+
+def estimate_image_tokens(provider, width, height):
+    """
+    按提供商的计费规则估算一张图像的输入 Token 数，用于多页打包的 Token 预算。
+
+    OpenAI 高细节模式：先缩放到 2048x2048 以内，再把短边缩到 768，每个 512px 图块 170 Token，另加 85。
+    Gemini：不超过 384px 的图像为 258 Token，更大的图像按 768px 图块计，每块 258 Token。
+    """
+    if not width or not height:
+        return 0
+    if provider in OPENAI_COMPATIBLE_PROVIDERS:
+        scale = min(1.0, 2048.0 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768.0 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512.0) * math.ceil(height / 512.0)
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * math.ceil(width / 768.0) * math.ceil(height / 768.0)
+
+
+def _page_cache_key(image_path, image_bytes, llm_options):
+    if image_bytes is None:
+        try:
+            with open(image_path, 'rb') as image_file:
+                image_bytes = image_file.read()
+        except OSError:
+            return None
+    identity = resolve_llm_identity(llm_options)
+    return result_cache.make_cache_key(
+        image_bytes,
+        provider=identity['provider'],
+        model_name=identity['model_name'],
+        system_prompt=identity['system_prompt'],
+        user_prompt=identity['user_prompt'],
+        endpoint=identity['endpoint']
+    )
+
+
+def _call_llm(image_path, image_bytes, mime_type, page_label, llm_options, stream=False):
+    """调用所选提供商分析图像；stream 为 True 时返回逐段产出文本的生成器，否则返回完整文本。"""
+    provider = llm_options.get('provider')
+    model_name = llm_options.get('model_name')
+    system_prompt = llm_options.get('system_prompt')
+    logging.info(f"正在分析图像: {page_label} 使用 LLM: {provider}, 模型: {model_name or '默认'}, 系统提示: {(system_prompt or '')[:50]}...")
+    if provider in OPENAI_COMPATIBLE_PROVIDERS and openai_client:
+        analyze = openai_client.analyze_image_openai_stream if stream else openai_client.analyze_image_openai
+        return analyze(
+            image_path=image_path,
+            system_prompt_override=system_prompt,
+            api_key_override=llm_options.get('openai_api_key') or None,
+            model_name_override=model_name or None,
+            base_url_override=llm_options.get('openai_base_url') or None,
+            image_bytes=image_bytes,
+            image_mime_type=mime_type
+        )
+    if provider == 'gemini' and gemini_client:
+        analyze = gemini_client.analyze_image_stream if stream else gemini_client.analyze_image
+        return analyze(
+            image_path=image_path,
+            user_prompt=llm_options.get('user_prompt', DEFAULT_USER_PROMPT),
+            system_prompt_override=system_prompt,
+            api_key_override=llm_options.get('gemini_api_key') or None,
+            model_name_override=model_name or None,
+            image_bytes=image_bytes,
+            image_mime_type=mime_type
+        )
+    logging.error(f"未知或未加载的 LLM 提供商 '{provider}'，无法分析图像 '{page_label}'")
+    error = f"错误: 未知或未加载的 LLM 提供商 '{provider}'"
+    return iter([error]) if stream else error
+
+
+def _consume_stream(chunks, page_number, page_label, on_delta=None, should_stop=None):
+    """
+    读取流式调用产出的文本，逐段转交 on_delta。
+
+    超过 LLM_MAX_OUTPUT_CHARS 时截断并关闭流；should_stop() 返回 True 时放弃此页。
+    关闭生成器会同时关闭底层的 HTTP / gRPC 流，服务端随即停止生成。
+
+    返回:
+        tuple: (分析文本, 是否被截断)
+    """
+    parts = []
+    length = 0
+    truncated = False
+    try:
+        for chunk in chunks:
+            if should_stop and should_stop():
+                logging.info(f"任务已取消，中止页面 '{page_label}' 的生成。")
+                return CANCELLED_ANALYSIS, False
+            if LLM_MAX_OUTPUT_CHARS and length + len(chunk) > LLM_MAX_OUTPUT_CHARS:
+                chunk = chunk[:LLM_MAX_OUTPUT_CHARS - length]
+                truncated = True
+            parts.append(chunk)
+            length += len(chunk)
+            if on_delta and chunk:
+                try:
+                    on_delta(page_number, chunk)
+                except Exception as e:
+                    logging.error(f"on_delta callback failed for page {page_number}: {e}")
+            if truncated:
+                logging.warning(f"页面 '{page_label}' 的输出超过 {LLM_MAX_OUTPUT_CHARS} 个字符，已中止生成。")
+                break
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    analysis = "".join(parts).strip()
+    if truncated:
+        analysis += TRUNCATED_ANALYSIS_NOTE.format(max_chars=LLM_MAX_OUTPUT_CHARS)
+    return analysis, truncated
+
+
+def _call_llm_pack(parts, pack_label, llm_options):
+    """在一个请求中分析多页图像，返回完整响应文本（含页面标记）。"""
+    provider = llm_options.get('provider')
+    if provider in OPENAI_COMPATIBLE_PROVIDERS and openai_client:
+        return openai_client.analyze_image_pack_openai(
+            parts,
+            system_prompt_override=llm_options.get('system_prompt'),
+            api_key_override=llm_options.get('openai_api_key') or None,
+            model_name_override=llm_options.get('model_name') or None,
+            base_url_override=llm_options.get('openai_base_url') or None,
+            label=pack_label
+        )
+    if provider == 'gemini' and gemini_client:
+        return gemini_client.analyze_image_pack(
+            parts,
+            system_prompt_override=llm_options.get('system_prompt'),
+            api_key_override=llm_options.get('gemini_api_key') or None,
+            model_name_override=llm_options.get('model_name') or None,
+            label=pack_label
+        )
+    return f"错误: 未知或未加载的 LLM 提供商 '{provider}'"
+
+
+def split_packed_response(text, count):
+    """
+    按页面标记把打包请求的响应拆分为 count 段。
+
+    标记必须恰好是 1..count 且按顺序出现，否则返回 None（由调用方退回逐页分析）。
+    """
+    matches = list(PACK_PAGE_MARKER_PATTERN.finditer(text or ''))
+    if [int(match.group(1)) for match in matches] != list(range(1, count + 1)):
+        return None
+    sections = []
+    for position, match in enumerate(matches):
+        end = matches[position + 1].start() if position + 1 < len(matches) else len(text)
+        sections.append(text[match.end():end].strip())
+    if not all(sections):
+        return None
+    return sections
+
+
+def analyze_page(page, llm_options, on_delta=None, should_stop=None):
+    """
+    使用所选 LLM 提供商分析单个页面图像。
+
+    若启用了 OCR 结果缓存，相同页面图像在相同提供商/模型/提示词下的结果直接从缓存返回，
+    不调用 API。任何异常都会被转换为该页面的错误文本，不会向外抛出，
+    因此单个页面失败不会影响同一文件中的其他页面。
+
+    启用 LLM_STREAM_OUTPUT 时以流式方式调用，生成中的文本逐段交给 on_delta；
+    输出超过 LLM_MAX_OUTPUT_CHARS 时中止生成并截断（截断的结果不写入缓存）。
+
+    参数:
+        page (PageImage | str): 内存中的页面图像，或页面图像路径。
+        llm_options (dict): LLM 配置，包含 provider、model_name、system_prompt、
+                            gemini_api_key、openai_api_key、openai_base_url 等键。
+        on_delta (callable): 可选，on_delta(page_number, 文本片段)，在生成过程中调用。
+        should_stop (callable): 可选，返回 True 时不再分析此页（已开始的生成会被中止）。
+
+    返回:
+        dict: {'page_number': ..., 'image_path': ..., 'analysis': ..., 'cached': bool,
+               'dedup': None, 'duplicate_of': None, 'text_layer': False, 'bytes_saved': int,
+               'truncated': bool, 'fingerprint': ..., 'reused_from': None}
+              image_path 在页面未写入磁盘时为 None；bytes_saved 为分辨率预算估计节省的图像字节数；
+              fingerprint 为页面内容指纹（page 不是 PageImage 时为 None）。
+    """
+    image_path, image_bytes, mime_type, page_number = _page_image_source(page)
+    page_label = image_path or f"page {page_number}"
+    result = {'page_number': page_number, 'image_path': image_path, 'analysis': None, 'cached': False,
+              'dedup': None, 'duplicate_of': None, 'text_layer': False,
+              'bytes_saved': getattr(page, 'estimated_bytes_saved', 0), 'truncated': False,
+              'fingerprint': getattr(page, 'fingerprint', None), 'reused_from': None}
+    if should_stop and should_stop():
+        result['analysis'] = CANCELLED_ANALYSIS
+        return result
+
+    cache = result_cache.get_result_cache()
+    cache_key = None
+    try:
+        if cache:
+            cache_key = _page_cache_key(image_path, image_bytes, llm_options)
+            cached_analysis = cache.get(cache_key) if cache_key else None
+            if cached_analysis is not None:
+                logging.info(f"OCR 结果缓存命中: {page_label}")
+                result.update(analysis=cached_analysis, cached=True)
+                return result
+
+        if LLM_STREAM_OUTPUT:
+            chunks = _call_llm(image_path, image_bytes, mime_type, page_label, llm_options, stream=True)
+            analysis, result['truncated'] = _consume_stream(chunks, page_number, page_label, on_delta, should_stop)
+        else:
+            analysis = _call_llm(image_path, image_bytes, mime_type, page_label, llm_options)
+        if cache_key and not is_error_analysis(analysis) and not result['truncated']:
+            cache.put(cache_key, analysis)
+    except Exception as e:
+        logging.error(f"分析图像 '{page_label}' 时出错: {e}")
+        analysis = f"分析图像时出错: {e}"
+
+    result['analysis'] = analysis if analysis else "未能分析此图像。"
+    return result
+
+
+def analyze_page_pack(pages, llm_options, should_stop=None):
+    """
+    在一个 LLM 请求中分析多页（页面标记见 PACK_PAGE_MARKER），返回与 pages 顺序一致的结果字典列表。
+
+    已在缓存中的页面不进入请求；只剩一页时按单页分析。响应无法按标记拆分、
+    或请求本身失败（例如图像过多超出上下文）时，逐页调用 analyze_page 重新分析。
+    """
+    if should_stop and should_stop():
+        return [analyze_page(page, llm_options, should_stop=should_stop) for page in pages]
+
+    def _llm_result(page, analysis, cached):
+        image_path, _, _, page_number = _page_image_source(page)
+        return {'page_number': page_number, 'image_path': image_path, 'analysis': analysis, 'cached': cached,
+                'dedup': None, 'duplicate_of': None, 'text_layer': False,
+                'bytes_saved': getattr(page, 'estimated_bytes_saved', 0), 'truncated': False,
+                'fingerprint': getattr(page, 'fingerprint', None), 'reused_from': None}
+
+    results = [None] * len(pages)
+    cache = result_cache.get_result_cache()
+    cache_keys = [None] * len(pages)
+    uncached = []
+    for position, page in enumerate(pages):
+        image_path, image_bytes, _, page_number = _page_image_source(page)
+        if cache:
+            cache_keys[position] = _page_cache_key(image_path, image_bytes, llm_options)
+            cached_analysis = cache.get(cache_keys[position]) if cache_keys[position] else None
+            if cached_analysis is not None:
+                logging.info(f"OCR 结果缓存命中: page {page_number}")
+                results[position] = _llm_result(page, cached_analysis, True)
+                continue
+        uncached.append(position)
+
+    if len(uncached) == 1:
+        results[uncached[0]] = analyze_page(pages[uncached[0]], llm_options, should_stop=should_stop)
+    elif uncached:
+        parts = [PACK_INSTRUCTION.format(count=len(uncached), first=PACK_PAGE_MARKER.format(index=1),
+                                         last=PACK_PAGE_MARKER.format(index=len(uncached)))]
+        for index, position in enumerate(uncached, 1):
+            image_path, image_bytes, mime_type, _ = _page_image_source(pages[position])
+            parts.append(PACK_PAGE_MARKER.format(index=index))
+            parts.append({'image_path': image_path, 'image_bytes': image_bytes, 'image_mime_type': mime_type})
+        page_numbers = [pages[position].page_number for position in uncached]
+        pack_label = f"pages {', '.join(str(number) for number in page_numbers)}"
+        try:
+            response = _call_llm_pack(parts, pack_label, llm_options)
+        except Exception as e:
+            logging.error(f"打包分析 {pack_label} 时出错: {e}")
+            response = None
+        sections = None if is_error_analysis(response) else split_packed_response(response, len(uncached))
+        if sections is None:
+            logging.warning(f"打包分析 {pack_label} 失败或响应无法按页面标记拆分，改为逐页分析。")
+            for position in uncached:
+                results[position] = analyze_page(pages[position], llm_options, should_stop=should_stop)
+        else:
+            logging.info(f"打包分析完成: {pack_label}，共 1 个请求。")
+            for position, analysis in zip(uncached, sections):
+                results[position] = _llm_result(pages[position], analysis, False)
+                if cache_keys[position]:
+                    cache.put(cache_keys[position], analysis)
+    return results
+
+
+def _pack_limits(max_pending):
+    """返回 (每个请求最多打包的页数, Token 预算)；页数不超过 max_pending，避免凑包时背压阻塞。"""
+    return max(1, min(LLM_PACK_PAGES, max_pending)), LLM_PACK_TOKEN_BUDGET
+
+
+def clamp_concurrency(max_workers):
+    """把请求的并发度限制在 1..LLM_MAX_CONCURRENCY_LIMIT；未指定时使用 LLM_MAX_CONCURRENCY。"""
+    return max(1, min(int(max_workers or LLM_MAX_CONCURRENCY), LLM_MAX_CONCURRENCY_LIMIT))
+
+
+def _classify_page(deduplicator, page, previous_results=None):
+    """
+    返回 (类型, 原始页码)：'text_layer'、'blank'、'duplicate'、'reused' 或 'unique'。
+
+    'reused' 表示页面内容指纹与上一版本文档中的某页相同，此时原始页码为上一版本中的页码。
+    这类页面在渲染阶段已被跳过（没有图像数据），因此先于去重判断，也不参与后续页面的去重。
+    """
+    if isinstance(page, str):
+        return 'unique', None
+    fingerprint = getattr(page, 'fingerprint', None)
+    if previous_results and fingerprint is not None and fingerprint in previous_results:
+        return 'reused', previous_results[fingerprint]['page_number']
+    if getattr(page, 'text', None) is not None:
+        return 'text_layer', None
+    if deduplicator is not None and page.page_number is not None:
+        return deduplicator.classify(page.page_number, page.data)
+    return 'unique', None
+
+
+def _skipped_page_result(page, kind, original_result=None):
+    """为文本层页面、空白页、重复页或复用上一版本结果的页面构造结果，不调用 LLM。"""
+    image_path, _, _, page_number = _page_image_source(page)
+    result = {'page_number': page_number, 'image_path': image_path, 'analysis': None, 'cached': False,
+              'dedup': None, 'duplicate_of': None, 'text_layer': False, 'bytes_saved': 0, 'truncated': False,
+              'fingerprint': getattr(page, 'fingerprint', None), 'reused_from': None}
+    if kind == 'text_layer':
+        result.update(analysis=page.text, text_layer=True)
+    elif kind == 'blank':
+        result.update(analysis=BLANK_PAGE_ANALYSIS, dedup=kind)
+    elif kind == 'reused':
+        result.update(analysis=original_result['analysis'], reused_from=original_result['page_number'],
+                      text_layer=original_result.get('text_layer', False))
+    else:
+        result.update(analysis=original_result['analysis'], dedup=kind, duplicate_of=original_result['page_number'],
+                      text_layer=original_result['text_layer'])
+    return result
+
+
+def _failed_page_result(page, error):
+    """分析任务本身抛出异常（而不是返回错误文本）时，为该页构造错误结果。"""
+    image_path, _, _, page_number = _page_image_source(page)
+    return {'page_number': page_number, 'image_path': image_path, 'analysis': f"分析图像时出错: {error}", 'cached': False,
+            'dedup': None, 'duplicate_of': None, 'text_layer': False,
+            'bytes_saved': getattr(page, 'estimated_bytes_saved', 0), 'truncated': False,
+            'fingerprint': getattr(page, 'fingerprint', None), 'reused_from': None}
+
+
+def analyze_pages_streaming(page_iter, llm_options, max_workers=None, max_pending=None, dedup=True, on_result=None,
+                            on_delta=None, should_stop=None, previous_results=None):
+    """
+    边产出边分析：从 page_iter（例如 pdf_processor.iter_pdf_pages）每取得一页，
+    就立即提交给线程池分析，使 CPU 密集的渲染与网络密集的 LLM 调用相互重叠。
+
+    当尚未完成分析的页面数达到 max_pending 时，迭代会暂停（背压），
+    避免渲染速度远快于分析时在内存中积压过多页面图像。
+
+    启用去重时（PAGE_DEDUP_ENABLED），空白页直接得到固定结果，与前面某页几乎相同的页面
+    复用该页的分析结果，二者都不调用 LLM。只带文本层（page.text）的页面直接以内嵌文本作为结果。
+    提供 previous_results 时，内容指纹与上一版本某页相同的页面直接复用该页的结果，只有修改过的页面和新页面调用 LLM；
+    这类页面通常未被渲染（见 pdf_processor.iter_pdf_pages 的 known_fingerprints），结果的 image_path 为 None。
+
+    LLM_PACK_PAGES > 1 时，需要调用 LLM 的页面先凑成一包（页数和估计的图像 Token 受限），
+    再以一个请求分析（见 analyze_page_pack）；打包的页面不产生流式片段。
+
+    参数:
+        page_iter (iterable): 按页码顺序产出 PageImage 或页面图像路径的可迭代对象。
+        llm_options (dict): 见 analyze_page。
+        max_workers (int): 最大并发请求数，默认为 LLM_MAX_CONCURRENCY。
+        max_pending (int): 已提交但未完成的页面数上限，默认为并发度的两倍。
+        dedup (bool): 是否进行空白页/重复页检测。
+        on_result (callable): 可选，每页结果就绪时立即以结果字典调用（按完成顺序而非页码顺序，
+                              可能来自工作线程），用于上报进度或流式推送。
+        on_delta (callable): 可选，见 analyze_page；流式调用时以 (页码, 文本片段) 调用。
+        should_stop (callable): 可选，返回 True 时停止读取后续页面，已提交的页面尽快结束，
+                                返回的结果只包含已读取的页面。
+        previous_results (dict): 可选，{页面内容指纹: 上一版本文档中该页的结果字典}。
+
+    单页或打包分析抛出异常时，相关页面得到错误结果（同样会调用 on_result），不会中断整个文件；
+    等待该页结果的重复页随之完成。
+
+    返回:
+        list: 与产出顺序一致的结果字典列表。去重的页面 'dedup' 为 'blank' 或 'duplicate'，
+              后者的 'duplicate_of' 为被复用的页码；使用文本层的页面 'text_layer' 为 True；
+              复用上一版本结果的页面 'reused_from' 为上一版本中的页码。
+    """
+    workers = clamp_concurrency(max_workers)
+    max_pending = max(workers, int(max_pending or LLM_MAX_PENDING_PAGES or workers * 2))
+    pending_slots = threading.BoundedSemaphore(max_pending)
+    deduplicator = page_dedup.PageDeduplicator() if dedup and page_dedup.PAGE_DEDUP_ENABLED else None
+    entries = [] # 每页一项：Future，或 (类型, page, 原始页码)
+    entry_index_by_page_number = {}
+    finished = {} # 条目序号 -> 已就绪的结果
+    waiting_duplicates = {} # 原始页条目序号 -> [(重复页条目序号, page)]
+    finished_lock = threading.Lock()
+
+    def _finish(index, result):
+        # 记录一页结果，并一并完成等待该页结果的重复页
+        ready = [result]
+        with finished_lock:
+            finished[index] = result
+            for duplicate_index, duplicate_page in waiting_duplicates.pop(index, []):
+                finished[duplicate_index] = _skipped_page_result(duplicate_page, 'duplicate', result)
+                ready.append(finished[duplicate_index])
+        if on_result:
+            for ready_result in ready:
+                try:
+                    on_result(ready_result)
+                except Exception as e:
+                    logging.error(f"on_result callback failed for page {ready_result.get('page_number')}: {e}")
+
+    def _future_error(future):
+        if future.cancelled():
+            return "分析任务被取消"
+        return future.exception()
+
+    def _future_done(index, page, future):
+        pending_slots.release()
+        error = _future_error(future)
+        if error is not None:
+            logging.error(f"分析第 {getattr(page, 'page_number', page)} 页时出错: {error}")
+            _finish(index, _failed_page_result(page, error))
+        else:
+            _finish(index, future.result())
+
+    def _pack_done(indices, pages, future):
+        for _ in indices:
+            pending_slots.release()
+        error = _future_error(future)
+        if error is not None:
+            logging.error(f"打包分析第 {', '.join(str(page.page_number) for page in pages)} 页时出错: {error}")
+            results = [_failed_page_result(page, error) for page in pages]
+        else:
+            results = future.result()
+        for index, result in zip(indices, results):
+            _finish(index, result)
+
+    pack_size, pack_token_budget = _pack_limits(max_pending)
+    provider = llm_options.get('provider')
+    pack = [] # 待打包的 (条目序号, page)
+    pack_tokens = 0
+
+    def _flush_pack():
+        nonlocal pack_tokens
+        if len(pack) == 1:
+            index, page = pack[0]
+            entries[index] = executor.submit(analyze_page, page, llm_options, on_delta, should_stop)
+            entries[index].add_done_callback(functools.partial(_future_done, index, page))
+        elif pack:
+            indices = [index for index, _ in pack]
+            pages = [page for _, page in pack]
+            future = executor.submit(analyze_page_pack, pages, llm_options, should_stop)
+            for index in indices:
+                entries[index] = future
+            future.add_done_callback(functools.partial(_pack_done, indices, pages))
+        pack.clear()
+        pack_tokens = 0
+
+    if pack_size > 1:
+        logging.info(f"多页打包已启用: 每个请求最多 {pack_size} 页，图像 Token 预算 {pack_token_budget}")
+    logging.info(f"开始流水线页面分析，并发度: {workers}，最大待处理页面数: {max_pending}")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='llm-page') as executor:
+        page_iter = iter(page_iter)
+        while True:
+            # 先占用名额再取下一页，使渲染在分析积压时暂停
+            pending_slots.acquire()
+            page = None if should_stop and should_stop() else next(page_iter, None)
+            if page is None:
+                pending_slots.release()
+                _flush_pack()
+                break
+
+            kind, original_page_number = _classify_page(deduplicator, page, previous_results)
+            if kind == 'reused':
+                # 重复页可能以此页为原始页，需要登记条目序号
+                entry_index_by_page_number[page.page_number] = len(entries)
+            if kind != 'unique':
+                pending_slots.release()
+                index = len(entries)
+                entries.append((kind, page, original_page_number))
+                if kind != 'duplicate':
+                    original_result = previous_results[page.fingerprint] if kind == 'reused' else None
+                    _finish(index, _skipped_page_result(page, kind, original_result))
+                    continue
+                original_index = entry_index_by_page_number[original_page_number]
+                with finished_lock:
+                    original_result = finished.get(original_index)
+                    if original_result is None:
+                        waiting_duplicates.setdefault(original_index, []).append((index, page))
+                if original_result is not None:
+                    _finish(index, _skipped_page_result(page, kind, original_result))
+                continue
+
+            if not isinstance(page, str):
+                entry_index_by_page_number[page.page_number] = len(entries)
+            if pack_size > 1 and not isinstance(page, str):
+                page_tokens = estimate_image_tokens(provider, page.width, page.height)
+                if pack and pack_tokens + page_tokens > pack_token_budget:
+                    _flush_pack()
+                entries.append(None) # 提交打包请求时填入 Future
+                pack.append((len(entries) - 1, page))
+                pack_tokens += page_tokens
+                if len(pack) >= pack_size:
+                    _flush_pack()
+                continue
+            future = executor.submit(analyze_page, page, llm_options, on_delta, should_stop)
+            index = len(entries)
+            entries.append(future)
+            # 回调可能立即在当前线程执行，此时条目必须已登记
+            future.add_done_callback(functools.partial(_future_done, index, page))
+
+    # 线程池关闭时所有 Future 的回调都已执行：成功、失败的页面以及等待它们的重复页都已完成
+    results = [finished[index] for index in range(len(entries))]
+
+    deduplicated = sum(1 for res in results if res['dedup'])
+    text_layer_pages = sum(1 for res in results if res['text_layer'] and not res['dedup'] and not res['reused_from'])
+    reused_pages = sum(1 for res in results if res['reused_from'])
+    if deduplicated or text_layer_pages or reused_pages:
+        logging.info(f"共 {len(results)} 页，其中 {text_layer_pages} 页使用文本层、{deduplicated} 页为空白页或重复页、"
+                     f"{reused_pages} 页与上一版本相同，未调用 LLM。")
+    return results
+
+
+def analyze_pages(pages, llm_options, max_workers=None, dedup=True):
+    """
+    以有界并发分析一组已经就绪的页面图像。
+
+    参数:
+        pages (list): PageImage 或页面图像路径列表。
+        llm_options (dict): 见 analyze_page。
+        max_workers (int): 最大并发请求数，默认为 LLM_MAX_CONCURRENCY。
+        dedup (bool): 是否进行空白页/重复页检测。
+
+    返回:
+        list: 与 pages 顺序一致的结果字典列表。
+    """
+    if not pages:
+        return []
+    # 所有页面均已就绪，无需背压
+    return analyze_pages_streaming(pages, llm_options, max_workers=max_workers, max_pending=len(pages), dedup=dedup)
@@ -0,0 +1,116 @@
+import io
+import os
+import zlib
+import logging
+
+from PIL import Image, ImageChops
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 文档内空白页/重复页检测配置
+PAGE_DEDUP_ENABLED = os.getenv('PAGE_DEDUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# dHash 汉明距离不超过此值的页面才会进入逐像素比较
+PAGE_DEDUP_HASH_DISTANCE = int(os.getenv('PAGE_DEDUP_HASH_DISTANCE', 6))
+# 缩略图中允许“明显不同”的像素数。默认 0：只有缩略图完全一致的页面才视为重复，
+# 因为仅差一个数字的两页在 dHash 上通常相同，但 OCR 结果不同。扫描件可适当调大。
+PAGE_DEDUP_MAX_DIFF_PIXELS = int(os.getenv('PAGE_DEDUP_MAX_DIFF_PIXELS', 0))
+# 页面图像中深色像素占比不超过此值的页面视为空白页
+BLANK_PAGE_MAX_INK_RATIO = float(os.getenv('BLANK_PAGE_MAX_INK_RATIO', 0.00002))
+
+THUMBNAIL_EDGE = 256 # 比较用灰度缩略图的长边像素
+DIFF_LEVEL = 48 # 灰度差超过此值的像素计为“明显不同”
+INK_LEVEL = 128 # 灰度低于此值的像素计为深色（墨迹）
+DHASH_SIZE = 8 # 64 位 dHash
+
+
+class PageSignature:
+    """页面的感知哈希、压缩后的灰度缩略图和墨迹占比。"""
+    def __init__(self, dhash, thumbnail_size, thumbnail_data, ink_ratio):
+        self.dhash = dhash
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_data = thumbnail_data # zlib 压缩的 L 模式像素
+        self.ink_ratio = ink_ratio
+
+    def thumbnail(self):
+        return Image.frombytes('L', self.thumbnail_size, zlib.decompress(self.thumbnail_data))
+
+
+def _dhash(gray_image):
+    small = gray_image.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(DHASH_SIZE):
+        offset = row * (DHASH_SIZE + 1)
+        for col in range(DHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def compute_page_signature(image_bytes):
+    """解码已编码的页面图像，计算用于空白页/重复页判断的签名。"""
+    img = Image.open(io.BytesIO(image_bytes))
+    img.draft('L', (THUMBNAIL_EDGE * 2, THUMBNAIL_EDGE * 2)) # 仅对 JPEG 生效，可跳过全分辨率解码
+    gray = img.convert('L')
+    # 墨迹占比在原始分辨率上统计：缩略图会把小字号文字平均成浅灰，导致有字的页面被误判为空白
+    histogram = gray.histogram()
+    ink_ratio = sum(histogram[:INK_LEVEL]) / float(gray.width * gray.height)
+
+    gray.thumbnail((THUMBNAIL_EDGE, THUMBNAIL_EDGE), Image.BOX)
+    return PageSignature(_dhash(gray), gray.size, zlib.compress(gray.tobytes()), ink_ratio)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def count_diff_pixels(signature_a, signature_b):
+    """返回两页缩略图中灰度差超过 DIFF_LEVEL 的像素数；尺寸不同时返回 None。"""
+    if signature_a.thumbnail_size != signature_b.thumbnail_size:
+        return None
+    histogram = ImageChops.difference(signature_a.thumbnail(), signature_b.thumbnail()).histogram()
+    return sum(histogram[DIFF_LEVEL + 1:])
+
+
+class PageDeduplicator:
+    """
+    在单个文档内识别空白页和与前面某页几乎相同的页面。
+
+    先用 dHash 汉明距离筛选候选页，再逐像素比较缩略图确认，
+    以免把内容略有不同的页面误判为重复。
+    """
+    def __init__(self, hash_distance=PAGE_DEDUP_HASH_DISTANCE, max_diff_pixels=PAGE_DEDUP_MAX_DIFF_PIXELS,
+                 blank_ink_ratio=BLANK_PAGE_MAX_INK_RATIO):
+        self.hash_distance = hash_distance
+        self.max_diff_pixels = max_diff_pixels
+        self.blank_ink_ratio = blank_ink_ratio
+        self._unique_pages = [] # [(page_number, PageSignature)]
+
+    def classify(self, page_number, image_bytes):
+        """
+        判断页面类型。
+
+        返回:
+            tuple: ('blank', None)、('duplicate', 原始页码) 或 ('unique', None)。
+                   无法解码图像时按 'unique' 处理。
+        """
+        try:
+            signature = compute_page_signature(image_bytes)
+        except Exception as e:
+            logging.warning(f"Could not compute signature for page {page_number}, skipping dedup: {e}")
+            return 'unique', None
+
+        if signature.ink_ratio <= self.blank_ink_ratio:
+            logging.info(f"Page {page_number} detected as blank (ink ratio {signature.ink_ratio:.6f}).")
+            return 'blank', None
+
+        for original_page_number, original in self._unique_pages:
+            if hamming_distance(signature.dhash, original.dhash) > self.hash_distance:
+                continue
+            diff_pixels = count_diff_pixels(signature, original)
+            if diff_pixels is not None and diff_pixels <= self.max_diff_pixels:
+                logging.info(f"Page {page_number} is a near-duplicate of page {original_page_number} ({diff_pixels} differing thumbnail pixels).")
+                return 'duplicate', original_page_number
+
+        self._unique_pages.append((page_number, signature))
+        return 'unique', None
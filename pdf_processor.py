@@ -1,35 +1,114 @@
 import fitz  # PyMuPDF
 from PIL import Image
 import os
+import io
+import math
+import re
+import hashlib
 import logging
 import shutil # For cleaning up test directories
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def convert_pdf_to_images(pdf_path, base_output_folder="uploads/pdf_images", dpi=300, image_format="PNG"):
+# 页面渲染进程数：1 表示在当前进程内渲染，0 表示使用全部 CPU 核心
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', 1))
+
+# 文本层快速通道：off 表示所有页面都渲染为图像；auto 表示文本层足够可靠的页面直接使用
+# 内嵌文本，不渲染、不调用视觉 LLM
+PDF_TEXT_LAYER_MODE = os.getenv('PDF_TEXT_LAYER_MODE', 'off').lower()
+# 文本层至少包含多少个非空白字符才视为可用
+PDF_TEXT_LAYER_MIN_CHARS = int(os.getenv('PDF_TEXT_LAYER_MIN_CHARS', 50))
+# 页面中图像覆盖面积占比超过此值时（例如扫描件、截图、插图），仍需视觉分析
+PDF_TEXT_LAYER_MAX_IMAGE_RATIO = float(os.getenv('PDF_TEXT_LAYER_MAX_IMAGE_RATIO', 0.1))
+# 无法映射到 Unicode 的字符占比超过此值时，视为字体编码损坏的文本层
+TEXT_LAYER_MAX_UNMAPPED_RATIO = 0.02
+
+_MIME_TYPES = {
+    'PNG': 'image/png',
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif',
+    'BMP': 'image/bmp',
+    'TIFF': 'image/tiff',
+}
+
+_LOSSY_FORMATS = ('JPEG', 'WEBP') # 支持 quality 参数的格式
+
+_render_pool = None
+_render_pool_workers = 0
+_render_pool_lock = threading.Lock()
+
+class PDFProcessingError(Exception):
+    """PDF 无法打开或解析时抛出。"""
+    pass
+
+
+class PageImage:
     """
-    将 PDF 文件的每一页转换为图像，并保存到基于 PDF 文件名的子目录中。
+    内存中的单页渲染结果。
 
-    参数:
-        pdf_path (str): 输入 PDF 文件的路径。
-        base_output_folder (str): 保存转换后图像的根文件夹路径。
-                                 例如 "uploads/pdf_images"。
-        dpi (int): 输出图像的分辨率 (每英寸点数)。
-        image_format (str): 输出图像的格式 (例如 "PNG", "JPEG")。
+    data 是按 image_format 编码好的图像字节，可直接交给 LLM 客户端，
+    无需经过磁盘写入、读取和二次解码。image_path 仅在页面同时被写入磁盘
+    （例如供结果页面展示）时才会设置。
 
-    返回:
-        list: 成功转换的图像文件路径列表。
-              如果发生错误，则返回空列表。
+    走文本层快速通道的页面不会被渲染：此时 text 为页面内嵌文本，data 和 image_format 为 None。
+    fingerprint 为页面内容指纹（见 page_fingerprint），用于在文档的新版本中识别未修改的页面；未要求计算时为 None。
+    指纹与上一版本相同的页面也不会被渲染：此时只有 fingerprint，data 和 text 均为 None（见 unchanged）。
     """
-    image_paths = []
-    if not os.path.exists(pdf_path):
-        logging.error(f"PDF file not found at {pdf_path}")
-        return []
+    def __init__(self, page_number, data, image_format, width, height, image_path=None, text=None,
+                 dpi=None, requested_dpi=None, fingerprint=None):
+        self.page_number = page_number # 从 1 开始
+        self.data = data
+        self.image_format = image_format
+        self.width = width
+        self.height = height
+        self.image_path = image_path
+        self.text = text
+        self.dpi = dpi # 实际渲染 DPI（受分辨率预算限制时低于 requested_dpi）
+        self.requested_dpi = requested_dpi
+        self.fingerprint = fingerprint
+
+    @property
+    def estimated_bytes_saved(self):
+        """按像素数比例估算：若以 requested_dpi 渲染，编码后的图像会多出多少字节。"""
+        if not self.data or not self.dpi or not self.requested_dpi or self.dpi >= self.requested_dpi:
+            return 0
+        return int(len(self.data) * ((self.requested_dpi / float(self.dpi)) ** 2 - 1))
+
+    @property
+    def unchanged(self):
+        """页面与上一版本相同、未被渲染（只计算了指纹）。"""
+        return self.data is None and self.text is None and self.fingerprint is not None
+
+    @property
+    def mime_type(self):
+        if not self.image_format:
+            return None
+        return _MIME_TYPES.get(self.image_format.upper(), 'application/octet-stream')
 
-    # 从 PDF 文件名创建特定的输出子文件夹
+    def __repr__(self):
+        if self.unchanged:
+            return f"PageImage(page_number={self.page_number}, unchanged=True, fingerprint={self.fingerprint!r})"
+        if self.data is None:
+            return f"PageImage(page_number={self.page_number}, text_layer=True, chars={len(self.text or '')})"
+        return (f"PageImage(page_number={self.page_number}, format={self.image_format}, "
+                f"size={self.width}x{self.height}, bytes={len(self.data)}, image_path={self.image_path!r})")
+
+
+def page_image_folder(pdf_path, base_output_folder):
+    """返回 PDF 的页面图像保存目录（base_output_folder 下基于 PDF 文件名的子目录），不创建目录。"""
     pdf_filename_without_ext = os.path.splitext(os.path.basename(pdf_path))[0]
-    specific_output_folder = os.path.join(base_output_folder, f"{pdf_filename_without_ext}_images")
+    return os.path.join(base_output_folder, f"{pdf_filename_without_ext}_images")
+
+
+def _prepare_output_folder(pdf_path, base_output_folder):
+    """创建并返回基于 PDF 文件名的图像输出子目录，失败时返回 None。"""
+    specific_output_folder = page_image_folder(pdf_path, base_output_folder)
 
     if not os.path.exists(specific_output_folder):
         try:
@@ -37,63 +116,473 @@ def convert_pdf_to_images(pdf_path, base_output_folder="uploads/pdf_images", dpi
             logging.info(f"Created directory: {specific_output_folder}")
         except OSError as e:
             logging.error(f"Error creating directory {specific_output_folder}: {e}")
-            return []
+            return None
     else:
         logging.info(f"Output directory already exists: {specific_output_folder}")
+    return specific_output_folder
 
 
+def _render_page_pixmap(page, dpi):
     try:
-        doc = fitz.open(pdf_path)
-        
-        # 设置缩放矩阵以控制 DPI
+        # 使用指定的 DPI 获取 pixmap
+        return page.get_pixmap(dpi=dpi)
+    except (AttributeError, TypeError): # 兼容旧版 PyMuPDF，可能没有直接的 dpi 参数
         # PDF 单位是点 (1/72 英寸)。 matrix 定义了从 PDF 坐标到像素坐标的转换。
-        # zoom_x = dpi / 72.0
-        # zoom_y = dpi / 72.0
-        # matrix = fitz.Matrix(zoom_x, zoom_y)
-        # PyMuPDF 1.19.0 及更高版本可以直接在 get_pixmap 中使用 dpi 参数
-        
-        logging.info(f"Processing PDF: {pdf_path} with {len(doc)} pages.")
+        zoom = dpi / 72.0
+        return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
 
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            
-            try:
-                # 使用指定的 DPI 获取 pixmap
-                pix = page.get_pixmap(dpi=dpi)
-            except AttributeError: # 兼容旧版 PyMuPDF，可能没有直接的 dpi 参数
-                zoom_x = dpi / 72.0
-                zoom_y = dpi / 72.0
-                matrix = fitz.Matrix(zoom_x, zoom_y)
-                pix = page.get_pixmap(matrix=matrix)
-
-
-            image_filename = f"page_{page_num + 1}.{image_format.lower()}"
-            image_path = os.path.join(specific_output_folder, image_filename)
-            
-            try:
-                # 使用 Pillow 将 Pixmap 保存为指定格式
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                img.save(image_path, image_format.upper())
-                image_paths.append(image_path)
-                logging.info(f"Saved page {page_num + 1} to {image_path} (DPI: {dpi}, Format: {image_format.upper()})")
-            except Exception as e_save:
-                logging.error(f"Error saving image {image_path}: {e_save}")
-                # 如果单个页面保存失败，继续处理其他页面
 
+def budgeted_dpi(page, dpi, resolution_budget=None):
+    """
+    返回满足分辨率预算的渲染 DPI（不超过 dpi）。
+
+    参数:
+        page (fitz.Page): 待渲染页面，尺寸以点 (1/72 英寸) 计。
+        dpi (int): 期望的渲染 DPI。
+        resolution_budget (tuple): (最长边像素上限, 总像素数上限)，任一项为 0/None 表示不限制。
+    """
+    if not resolution_budget:
+        return dpi
+    max_long_edge, max_pixels = resolution_budget
+    width = page.rect.width * dpi / 72.0
+    height = page.rect.height * dpi / 72.0
+    if width <= 0 or height <= 0:
+        return dpi
+    scale = 1.0
+    if max_long_edge:
+        scale = min(scale, max_long_edge / max(width, height))
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    # 向下取整，保证渲染结果不超出预算
+    return max(1, int(math.floor(dpi * scale))) if scale < 1.0 else dpi
+
+
+def _normalize_image_format(image_format):
+    image_format = image_format.upper()
+    return 'JPEG' if image_format == 'JPG' else image_format
+
+
+def encode_image(img, image_format, quality=None):
+    """
+    将 PIL 图像编码为字节。
+
+    参数:
+        img (PIL.Image.Image): RGB 图像。
+        image_format (str): 编码格式 (例如 "PNG", "JPEG", "WEBP")。
+        quality (int): 有损格式 (JPEG / WebP) 的质量，1-95；无损格式忽略此参数。
+    """
+    pil_format = _normalize_image_format(image_format)
+    save_kwargs = {}
+    if quality and pil_format in _LOSSY_FORMATS:
+        save_kwargs['quality'] = int(quality)
+    buffer = io.BytesIO()
+    img.save(buffer, pil_format, **save_kwargs)
+    return buffer.getvalue()
+
+
+def _render_page(page, dpi, image_format, output_folder=None, resolution_budget=None,
+                 upload_format=None, upload_quality=None):
+    """
+    渲染已加载的页面（fitz.Page）并在内存中编码为 PageImage。
+
+    提供 resolution_budget 时直接以满足预算的较低 DPI 渲染，而不是先按 dpi 渲染再缩放。
+    PageImage.data 按 upload_format/upload_quality 编码（默认与 image_format 相同），用于发送给 LLM；
+    若提供 output_folder，则按 image_format 保存预览图像，格式相同时直接写入同一份字节（不重复编码）。
+    渲染或编码失败时记录日志并返回 None；仅写盘失败时仍返回内存中的页面。
+    """
+    preview_format = _normalize_image_format(image_format)
+    payload_format = _normalize_image_format(upload_format or image_format)
+    requested_dpi = dpi
+    page_num = page.number
+    try:
+        dpi = budgeted_dpi(page, requested_dpi, resolution_budget)
+        pix = _render_page_pixmap(page, dpi)
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        payload = encode_image(img, payload_format, upload_quality)
+    except Exception as e_render:
+        logging.error(f"Error rendering page {page_num + 1}: {e_render}")
+        return None
+
+    page_image = PageImage(page_num + 1, payload, payload_format, pix.width, pix.height,
+                           dpi=dpi, requested_dpi=requested_dpi)
+
+    if output_folder:
+        image_path = os.path.join(output_folder, f"page_{page_num + 1}.{image_format.lower()}")
+        try:
+            preview = payload if preview_format == payload_format else encode_image(img, preview_format)
+            with open(image_path, 'wb') as image_file:
+                image_file.write(preview)
+            page_image.image_path = image_path
+            logging.info(f"Saved page {page_num + 1} to {image_path} (DPI: {dpi}, Format: {preview_format}, "
+                         f"upload: {payload_format} {len(payload)} bytes)")
+        except (OSError, ValueError) as e_save:
+            logging.error(f"Error saving image {image_path}: {e_save}")
+    else:
+        logging.info(f"Rendered page {page_num + 1} in memory (DPI: {dpi}, Format: {payload_format}, {len(payload)} bytes)")
+    return page_image
+
+
+def _image_coverage_ratio(page):
+    """返回页面中图像（按显示位置裁剪到页面范围）覆盖面积占页面面积的比例，上限为 1。"""
+    page_rect = page.rect
+    page_area = abs(page_rect)
+    if not page_area:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        covered += abs(fitz.Rect(info['bbox']) & page_rect)
+    return min(1.0, covered / page_area)
+
+
+def extract_text_layer(page):
+    """
+    判断页面能否跳过视觉分析，能则返回内嵌文本，否则返回 None。
+
+    满足以下条件的页面才使用文本层：非空白字符数不少于 PDF_TEXT_LAYER_MIN_CHARS；
+    图像覆盖面积不超过 PDF_TEXT_LAYER_MAX_IMAGE_RATIO（扫描件、图表截图需要视觉模型）；
+    无法映射到 Unicode 的字符（U+FFFD）占比不超过 TEXT_LAYER_MAX_UNMAPPED_RATIO。
+    """
+    text = page.get_text("text", sort=True).strip()
+    visible_chars = sum(1 for ch in text if not ch.isspace())
+    if visible_chars < PDF_TEXT_LAYER_MIN_CHARS:
+        return None
+    if text.count('\ufffd') / float(visible_chars) > TEXT_LAYER_MAX_UNMAPPED_RATIO:
+        logging.info(f"Page {page.number + 1}: text layer has unmapped glyphs, using vision analysis.")
+        return None
+    image_ratio = _image_coverage_ratio(page)
+    if image_ratio > PDF_TEXT_LAYER_MAX_IMAGE_RATIO:
+        logging.info(f"Page {page.number + 1}: images cover {image_ratio:.0%} of the page, using vision analysis.")
+        return None
+    return text
+
+
+# 对象中的间接引用 "12 0 R"；/Parent 和 /P 指回页面树或页面本身，不属于页面内容
+_PDF_REFERENCE = re.compile(rb'(\d+)\s+(\d+)\s+R\b')
+_PDF_BACK_REFERENCE = re.compile(rb'/(Parent|P)\s+\d+\s+\d+\s+R\b')
+
+
+def _hash_pdf_value(doc, source, resource_hashes):
+    # 把对象文本中的间接引用替换为被引用对象的摘要，使指纹与对象编号无关
+    source = _PDF_BACK_REFERENCE.sub(rb'/\1', source)
+    return _PDF_REFERENCE.sub(lambda m: _hash_pdf_object(doc, int(m.group(1)), resource_hashes).hex().encode('ascii'), source)
+
+
+def _hash_pdf_object(doc, xref, resource_hashes):
+    """递归计算间接对象（字典、数组或流）的摘要，按 xref 缓存在 resource_hashes 中。"""
+    digest = resource_hashes.get(xref)
+    if digest is not None:
+        return digest
+    # 循环引用时使用占位摘要（与对象编号相关，只会导致指纹不同）
+    resource_hashes[xref] = hashlib.sha256(f"cycle|{xref}".encode('utf-8')).digest()
+    hasher = hashlib.sha256()
+    hasher.update(_hash_pdf_value(doc, doc.xref_object(xref, compressed=True).encode('utf-8'), resource_hashes))
+    if doc.xref_is_stream(xref):
+        hasher.update(hashlib.sha256(doc.xref_stream_raw(xref) or b'').digest())
+    digest = resource_hashes[xref] = hasher.digest()
+    return digest
+
+
+def _page_resources(doc, page):
+    # /Resources 可以从页面树的上级节点继承
+    xref = page.xref
+    while xref:
+        value_type, value = doc.xref_get_key(xref, "Resources")
+        if value_type != 'null':
+            return value_type, value
+        parent_type, parent = doc.xref_get_key(xref, "Parent")
+        xref = int(parent.split()[0]) if parent_type == 'xref' else 0
+    return 'null', 'null'
+
+
+def page_fingerprint(doc, page, resource_hashes=None):
+    """
+    计算页面内容指纹：页面尺寸/旋转、内容流、完整解析后的 /Resources 字典（字体、图像/表单 XObject、
+    ExtGState、着色、颜色空间等，包括资源名到对象的映射）和注释的 SHA-256。
+
+    只读取 PDF 对象，不渲染页面。内容相同的页面在文档的不同版本中得到相同的指纹，
+    因此可以复用上一版本的分析结果；无法确认未修改的情况只会导致指纹不同（重新分析），不会误判为相同。
+
+    参数:
+        doc: 已打开的 fitz.Document。
+        page: doc 中的页面。
+        resource_hashes (dict): 可选，xref -> 对象摘要。同一文档的多个页面共用一个 dict 时，
+                                共享的字体、图像等资源只读取和计算一次。
+
+    返回:
+        str | None: 十六进制摘要；读取失败时返回 None。
+    """
+    if resource_hashes is None:
+        resource_hashes = {}
+    try:
+        digest = hashlib.sha256()
+        digest.update(f"{tuple(page.rect)}|{page.rotation}\n".encode('utf-8'))
+        digest.update(page.read_contents())
+        for key, (value_type, value) in (('Resources', _page_resources(doc, page)), ('Annots', doc.xref_get_key(page.xref, "Annots"))):
+            digest.update(f"\n{key}|{value_type}|".encode('utf-8'))
+            digest.update(_hash_pdf_value(doc, value.encode('utf-8'), resource_hashes))
+        return digest.hexdigest()
+    except Exception as e_fingerprint:
+        logging.warning(f"Could not fingerprint page {page.number + 1}: {e_fingerprint}")
+        return None
+
+
+def page_fingerprints(pdf_path):
+    """
+    计算 PDF 全部页面的内容指纹（不渲染），用于在渲染时没有计算指纹的文档写入索引前补齐。
+
+    返回:
+        dict: {页码（从 1 开始）: 指纹或 None}；文件无法打开时返回空 dict。
+    """
+    try:
+        doc = fitz.open(pdf_path)
+    except RuntimeError as e:
+        logging.error(f"Could not open {pdf_path} to fingerprint its pages: {e}")
+        return {}
+    try:
+        resource_hashes = {}
+        return {page.number + 1: page_fingerprint(doc, page, resource_hashes) for page in doc}
+    finally:
         doc.close()
-    except fitz.fitz.FitzError as fe: # PyMuPDF 特定的错误
-        logging.error(f"PyMuPDF error processing {pdf_path}: {fe}")
-        return []
-    except FileNotFoundError: # 这个应该在函数开始时被捕获，但为了以防万一
-        logging.error(f"Error: PDF file not found at {pdf_path} (should have been caught earlier)")
+
+
+def _load_page(doc, page_num, dpi, image_format, output_folder=None, use_text_layer=False, resolution_budget=None,
+               upload_format=None, upload_quality=None, resource_hashes=None, known_fingerprints=None):
+    """
+    产出单页的 PageImage：启用文本层快速通道且文本层可用时直接返回文本，否则渲染为图像。
+    resource_hashes 不为 None 时计算页面内容指纹（见 page_fingerprint），该 dict 在同一文档的页面间共用；
+    指纹在 known_fingerprints 中的页面既不渲染也不提取文本层，只返回带指纹的 PageImage。
+    """
+    try:
+        page = doc.load_page(page_num)
+    except Exception as e_load:
+        logging.error(f"Error loading page {page_num + 1}: {e_load}")
+        return None
+    fingerprint = page_fingerprint(doc, page, resource_hashes) if resource_hashes is not None else None
+    if fingerprint is not None and known_fingerprints and fingerprint in known_fingerprints:
+        logging.info(f"Page {page_num + 1}: unchanged since the previous version, skipped rendering.")
+        return PageImage(page_num + 1, None, None, None, None, fingerprint=fingerprint)
+    if use_text_layer:
+        try:
+            text = extract_text_layer(page)
+        except Exception as e_text:
+            logging.warning(f"Error extracting text layer of page {page_num + 1}, rendering instead: {e_text}")
+            text = None
+        if text is not None:
+            logging.info(f"Page {page_num + 1}: using embedded text layer ({len(text)} chars), skipped rendering.")
+            return PageImage(page_num + 1, None, None, None, None, text=text, fingerprint=fingerprint)
+    page_image = _render_page(page, dpi, image_format, output_folder, resolution_budget, upload_format, upload_quality)
+    if page_image:
+        page_image.fingerprint = fingerprint
+    return page_image
+
+
+def _render_pages_worker(pdf_path, page_numbers, output_folder, dpi, image_format, use_text_layer=False, resolution_budget=None,
+                         upload_format=None, upload_quality=None, known_fingerprints=None):
+    """
+    进程池工作函数：在子进程中自行打开文档，处理给定的一段页码。
+
+    返回:
+        list: 与 page_numbers 顺序一致的 PageImage（失败的页面为 None）。
+    """
+    doc = fitz.open(pdf_path)
+    resource_hashes = {} if known_fingerprints is not None else None
+    try:
+        return [_load_page(doc, page_num, dpi, image_format, output_folder, use_text_layer, resolution_budget,
+                           upload_format, upload_quality, resource_hashes, known_fingerprints)
+                for page_num in page_numbers]
+    finally:
+        doc.close()
+
+
+def _resolve_render_workers(workers):
+    workers = PDF_RENDER_WORKERS if workers is None else int(workers)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def _get_render_pool(workers):
+    """返回共享的渲染进程池，进程数变化时重建。"""
+    global _render_pool, _render_pool_workers
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool_workers != workers:
+            if _render_pool is not None:
+                _render_pool.shutdown(wait=False)
+            # 使用 spawn 而非 fork：调用方（Flask、分析线程池）是多线程的，fork 可能复制持有中的锁
+            _render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _render_pool_workers = workers
+            logging.info(f"Started PDF render process pool with {workers} workers.")
+        return _render_pool
+
+
+def _iter_rendered_pages_parallel(pdf_path, page_count, output_folder, dpi, image_format, workers, use_text_layer=False,
+                                  resolution_budget=None, upload_format=None, upload_quality=None, known_fingerprints=None):
+    """
+    使用进程池渲染，按页码顺序产出 PageImage。
+
+    页码被切分为连续的小段（每个进程约 4 段），以便前面的页面尽早产出；
+    同时最多只提交 workers * 2 段，避免渲染远远领先于消费方。
+    """
+    active_workers = min(workers, page_count)
+    chunk_size = max(1, -(-page_count // (active_workers * 4)))
+    chunks = [list(range(start, min(start + chunk_size, page_count))) for start in range(0, page_count, chunk_size)]
+    pool = _get_render_pool(workers)
+    in_flight = deque()
+    next_chunk = 0
+
+    try:
+        while next_chunk < len(chunks) or in_flight:
+            while next_chunk < len(chunks) and len(in_flight) < active_workers * 2:
+                in_flight.append(pool.submit(_render_pages_worker, pdf_path, chunks[next_chunk], output_folder, dpi, image_format,
+                                             use_text_layer, resolution_budget, upload_format, upload_quality, known_fingerprints))
+                next_chunk += 1
+            try:
+                chunk_pages = in_flight.popleft().result()
+            except Exception as e:
+                # 子进程异常（例如进程意外退出）：放弃整个文档，而不是静默缺页
+                raise PDFProcessingError(f"Render worker failed for {pdf_path}: {e}") from e
+            for page_image in chunk_pages:
+                if page_image:
+                    yield page_image
+    finally:
+        # 消费方提前停止或出错时，取消尚未开始的渲染段
+        for future in in_flight:
+            future.cancel()
+
+
+def get_page_count(pdf_path):
+    """
+    返回 PDF 的页数（不渲染页面），用于在处理前报告进度总数。
+
+    异常:
+        PDFProcessingError: PDF 文件不存在或无法打开。
+    """
+    if not os.path.exists(pdf_path):
+        raise PDFProcessingError(f"PDF file not found at {pdf_path}")
+    try:
+        with fitz.open(pdf_path) as doc:
+            return len(doc)
+    except RuntimeError as fe:
+        raise PDFProcessingError(f"PyMuPDF error opening {pdf_path}: {fe}") from fe
+
+
+def iter_pdf_pages(pdf_path, base_output_folder=None, dpi=300, image_format="PNG", workers=None, use_text_layer=None,
+                   resolution_budget=None, upload_format=None, upload_quality=None, known_fingerprints=None):
+    """
+    逐页渲染 PDF，每渲染完一页就立即产出该页的 PageImage（内存中的已编码图像）。
+
+    调用方无需等待整个文档渲染完成，即可开始处理已经产出的页面（例如发送给 LLM 分析）。
+
+    参数:
+        pdf_path (str): 输入 PDF 文件的路径。
+        base_output_folder (str): 可选。提供时，页面图像会同时保存到该目录下基于 PDF
+                                  文件名的子目录中，并设置 PageImage.image_path。
+        dpi (int): 输出图像的分辨率 (每英寸点数)。
+        image_format (str): 磁盘预览图像的编码格式 (例如 "PNG", "JPEG")。
+        workers (int): 渲染进程数，默认为 PDF_RENDER_WORKERS。大于 1 时每个子进程
+                       自行打开文档并渲染一段页码，产出顺序仍按页码排列。
+        use_text_layer (bool): 是否启用文本层快速通道，默认由 PDF_TEXT_LAYER_MODE 决定。
+                               启用时文本层可用的页面不渲染，产出的 PageImage 只有 text。
+        resolution_budget (tuple): 可选。(最长边像素上限, 总像素数上限)；超出预算的页面以较低的
+                                   DPI 渲染（见 budgeted_dpi），PageImage.dpi 记录实际 DPI。
+        upload_format (str): 可选。PageImage.data（发送给 LLM 的图像）的编码格式，默认与 image_format 相同。
+        upload_quality (int): 可选。upload_format 为 JPEG / WebP 时的质量。
+        known_fingerprints (set): 可选，上一版本文档的页面内容指纹。提供时计算每页的指纹（PageImage.fingerprint），
+                                  指纹在其中的页面不渲染、不写入磁盘，产出的 PageImage 只有指纹（unchanged 为 True）。
+
+    产出:
+        PageImage: 按页码顺序。
+
+    异常:
+        PDFProcessingError: PDF 文件不存在、无法打开或输出目录无法创建。
+    """
+    if not os.path.exists(pdf_path):
+        raise PDFProcessingError(f"PDF file not found at {pdf_path}")
+
+    specific_output_folder = None
+    if base_output_folder:
+        specific_output_folder = _prepare_output_folder(pdf_path, base_output_folder)
+        if not specific_output_folder:
+            raise PDFProcessingError(f"Could not create image output folder for {pdf_path}")
+
+    try:
+        doc = fitz.open(pdf_path)
+    except RuntimeError as fe: # PyMuPDF 的错误类型 (FileDataError 等) 均继承自 RuntimeError
+        raise PDFProcessingError(f"PyMuPDF error opening {pdf_path}: {fe}") from fe
+
+    workers = _resolve_render_workers(workers)
+    if use_text_layer is None:
+        use_text_layer = PDF_TEXT_LAYER_MODE == 'auto'
+    if known_fingerprints is not None:
+        # 需要传给渲染子进程，统一为可序列化的集合（调用方可能传入 dict 的 keys 视图）
+        known_fingerprints = frozenset(known_fingerprints)
+    try:
+        page_count = len(doc)
+        logging.info(f"Processing PDF: {pdf_path} with {page_count} pages (render workers: {max(1, min(workers, page_count))}).")
+
+        if workers > 1 and page_count > 1:
+            # 子进程各自打开文档，主进程不再需要持有它
+            doc.close()
+            doc = None
+            yield from _iter_rendered_pages_parallel(pdf_path, page_count, specific_output_folder, dpi, image_format, workers,
+                                                     use_text_layer, resolution_budget, upload_format, upload_quality,
+                                                     known_fingerprints)
+            return
+
+        resource_hashes = {} if known_fingerprints is not None else None
+        for page_num in range(page_count):
+            page_image = _load_page(doc, page_num, dpi, image_format, specific_output_folder, use_text_layer, resolution_budget,
+                                    upload_format, upload_quality, resource_hashes, known_fingerprints)
+            # 如果单个页面渲染失败，继续处理其他页面
+            if page_image:
+                yield page_image
+    finally:
+        if doc is not None:
+            doc.close()
+
+
+def iter_pdf_images(pdf_path, base_output_folder="uploads/pdf_images", dpi=300, image_format="PNG", workers=None):
+    """
+    逐页渲染并保存 PDF，每保存完一页就立即产出该页的图像路径。
+
+    参数与 iter_pdf_pages 相同，但始终写入磁盘；写盘失败的页面会被跳过。
+
+    产出:
+        str: 已保存页面图像的路径，按页码顺序。
+    """
+    for page_image in iter_pdf_pages(pdf_path, base_output_folder, dpi=dpi, image_format=image_format, workers=workers, use_text_layer=False):
+        if page_image.image_path:
+            yield page_image.image_path
+
+
+def convert_pdf_to_images(pdf_path, base_output_folder="uploads/pdf_images", dpi=300, image_format="PNG", workers=None):
+    """
+    将 PDF 文件的每一页转换为图像，并保存到基于 PDF 文件名的子目录中。
+
+    参数:
+        pdf_path (str): 输入 PDF 文件的路径。
+        base_output_folder (str): 保存转换后图像的根文件夹路径。
+                                 例如 "uploads/pdf_images"。
+        dpi (int): 输出图像的分辨率 (每英寸点数)。
+        image_format (str): 输出图像的格式 (例如 "PNG", "JPEG")。
+        workers (int): 渲染进程数，默认为 PDF_RENDER_WORKERS。
+
+    返回:
+        list: 成功转换的图像文件路径列表，按页码顺序。
+              如果发生错误，则返回空列表。
+    """
+    try:
+        image_paths = list(iter_pdf_images(pdf_path, base_output_folder, dpi=dpi, image_format=image_format, workers=workers))
+    except PDFProcessingError as e:
+        logging.error(str(e))
         return []
     except Exception as e:
         logging.error(f"An unexpected error occurred during PDF to image conversion for {pdf_path}: {str(e)}")
         return []
-    
+
     if not image_paths:
         logging.warning(f"No images were converted from {pdf_path}.")
-        
+
     return image_paths
 
 if __name__ == '__main__':
@@ -1,6 +1,23 @@
+import os
 import time
+import hashlib
+import logging
 import threading
 import asyncio
+import collections
+
+# Buckets hold this many seconds worth of their per-minute budget, so a batch
+# can start with a short burst without front-loading a whole minute of calls
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "10"))
+
+# AIMD feedback: on a 429 / quota error the allowed request rate is multiplied by
+# RATE_LIMIT_AIMD_DECREASE; each success adds RATE_LIMIT_AIMD_INCREASE requests per
+# minute back, up to the configured RPM (or RATE_LIMIT_AIMD_MAX_RPM when unlimited)
+RATE_LIMIT_AIMD_ENABLED = os.getenv("RATE_LIMIT_AIMD_ENABLED", "true").lower() in ('1', 'true', 'yes')
+RATE_LIMIT_AIMD_DECREASE = float(os.getenv("RATE_LIMIT_AIMD_DECREASE", "0.5"))
+RATE_LIMIT_AIMD_INCREASE = float(os.getenv("RATE_LIMIT_AIMD_INCREASE", "1"))
+RATE_LIMIT_AIMD_MIN_RPM = float(os.getenv("RATE_LIMIT_AIMD_MIN_RPM", "1"))
+RATE_LIMIT_AIMD_MAX_RPM = float(os.getenv("RATE_LIMIT_AIMD_MAX_RPM", "10000"))
 
 class TokenBucketRateLimiter:
     """
@@ -27,20 +44,81 @@ class TokenBucketRateLimiter:
     async def consume_async(self, tokens=1):
         """
         Asynchronously consume tokens from the bucket. Waits if necessary.
+
+        Sleeps for exactly the time needed to refill the missing tokens instead of
+        polling. The lock is only held for the refill check, never across an await.
+        For limiters used only from a single event loop, prefer
+        AsyncTokenBucketRateLimiter, which also serves waiters in FIFO order.
         """
-        # This is a simplified async version. A real async rate limiter
-        # would use asyncio.sleep and potentially an async lock.
-        # For now, we'll just use the synchronous consume and a simple sleep.
-        # In a production async app, you'd use an async-compatible library.
+        if tokens > self.max_tokens:
+            raise ValueError(f"Cannot consume {tokens} tokens from a bucket of size {self.max_tokens}")
         while True:
             with self.lock:
                 self._refill()
                 if self.tokens >= tokens:
                     self.tokens -= tokens
                     return True
-            # If not enough tokens, wait a bit before retrying
-            await asyncio.sleep(1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.1)
+                missing = tokens - self.tokens
+            await asyncio.sleep(missing / self.tokens_per_second if self.tokens_per_second > 0 else 0.1)
+
+    def reserve(self, tokens=1):
+        """
+        Take `tokens` from the bucket immediately, going into debt if needed,
+        and return how many seconds the caller must wait before using them.
 
+        Reservations are served in call order: each caller's wait already
+        includes the debt left by earlier callers. Unlike consume(), a single
+        reservation may exceed max_tokens (e.g. a large token-per-minute charge).
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def acquire(self, tokens=1):
+        """
+        Blocking variant of reserve(): sleeps until the tokens are available.
+        Returns the number of seconds waited.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens=1):
+        """
+        Async variant of reserve(): awaits until the tokens are available
+        without blocking the event loop. Returns the number of seconds waited.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def set_rate(self, tokens_per_second, max_tokens):
+        """Changes the refill rate and bucket size; tokens already earned are kept (up to the new size)."""
+        with self.lock:
+            self._refill()
+            self.tokens_per_second = tokens_per_second
+            self.max_tokens = max_tokens
+            self.tokens = min(self.tokens, max_tokens)
+
+    def pause(self, seconds):
+        """Empties the bucket and adds enough debt that no reservation succeeds for `seconds`."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0) - seconds * self.tokens_per_second
+
+    def adjust(self, tokens):
+        """
+        Charge (positive) or refund (negative) tokens after the fact, e.g. when
+        the real usage of a request differs from what was reserved up front.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.max_tokens, self.tokens - tokens)
 
     def _refill(self):
         """
@@ -52,6 +130,263 @@ class TokenBucketRateLimiter:
         self.tokens = min(self.max_tokens, self.tokens + new_tokens)
         self.last_refill_time = now
 
+
+class AsyncTokenBucketRateLimiter:
+    """
+    An asyncio-native token bucket rate limiter.
+
+    Waiters are queued in FIFO order. A single timer is armed for the exact
+    moment the head of the queue can be served, so no waiter wakes up early
+    and nothing ever blocks the event loop. All methods must be called from
+    the event loop that owns the limiter; no locks are needed.
+    """
+    def __init__(self, tokens_per_second, max_tokens):
+        if tokens_per_second <= 0:
+            raise ValueError("tokens_per_second must be positive")
+        self.tokens_per_second = tokens_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.last_refill_time = None # set from loop.time() on first use
+        self._waiters = collections.deque() # (tokens, future)
+        self._timer = None
+
+    def _refill(self, now):
+        if self.last_refill_time is not None:
+            self.tokens = min(self.max_tokens, self.tokens + (now - self.last_refill_time) * self.tokens_per_second)
+        self.last_refill_time = now
+
+    async def acquire(self, tokens=1):
+        """
+        Wait until `tokens` tokens are available and consume them.
+
+        Requests are served strictly in arrival order: a small request never
+        overtakes a larger one that is already waiting.
+        """
+        if tokens > self.max_tokens:
+            raise ValueError(f"Cannot acquire {tokens} tokens from a bucket of size {self.max_tokens}")
+        loop = asyncio.get_running_loop()
+        self._refill(loop.time())
+        if not self._waiters and self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+
+        future = loop.create_future()
+        self._waiters.append((tokens, future))
+        if len(self._waiters) == 1:
+            self._schedule(loop)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just before the cancellation landed: give the tokens back
+                self.tokens = min(self.max_tokens, self.tokens + tokens)
+                self._schedule(loop)
+            elif self._waiters and self._waiters[0][1] is future:
+                # The next waiter may be servable sooner than the cancelled head was
+                self._waiters.popleft()
+                self._schedule(loop)
+            else:
+                self._waiters = collections.deque(w for w in self._waiters if w[1] is not future)
+            raise
+
+    def _schedule(self, loop):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._waiters:
+            return
+        self._refill(loop.time())
+        missing = self._waiters[0][0] - self.tokens
+        delay = max(0.0, missing / self.tokens_per_second)
+        self._timer = loop.call_later(delay, self._wake, loop)
+
+    def _wake(self, loop):
+        self._timer = None
+        self._refill(loop.time())
+        while self._waiters:
+            tokens, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            # Timers may fire up to one clock tick early; allow for that instead of re-arming
+            if self.tokens + 1e-9 < tokens:
+                break
+            self._waiters.popleft()
+            self.tokens = max(0.0, self.tokens - tokens)
+            future.set_result(True)
+        self._schedule(loop)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+def _per_minute_bucket(per_minute, min_burst=1):
+    """Builds a bucket for a per-minute budget, or None when the budget is 0 (unlimited)."""
+    if not per_minute or per_minute <= 0:
+        return None
+    rate = per_minute / 60.0
+    return TokenBucketRateLimiter(tokens_per_second=rate, max_tokens=max(float(min_burst), rate * RATE_LIMIT_BURST_SECONDS))
+
+
+class ProviderRateLimits:
+    """
+    Requests-per-minute and tokens-per-minute buckets for one provider
+    endpoint and API key.
+
+    The token bucket is charged an estimate before each call and corrected with
+    the real usage reported in the response (record_usage), so long answers
+    slow later requests down and short ones give budget back.
+
+    The request rate is adapted with AIMD: on_rate_limited() cuts it
+    multiplicatively (and honors Retry-After), on_success() raises it
+    additively back towards the configured RPM.
+    """
+    def __init__(self, name, rpm, tpm, request_tokens=0):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = _per_minute_bucket(rpm)
+        # The token bucket must hold at least one request's estimate, otherwise every call would wait
+        self.tokens = _per_minute_bucket(tpm, min_burst=max(1, request_tokens))
+        self.effective_rpm = float(rpm) if rpm and rpm > 0 else None # None: unlimited
+        self.successes = 0
+        self.rate_limited = 0
+        self.last_retry_after = None
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._recent_requests = collections.deque() # monotonic timestamps of the last minute's requests
+        self._aimd_lock = threading.Lock()
+
+    def _reserve(self, estimated_tokens):
+        now = time.monotonic()
+        with self._aimd_lock:
+            self._recent_requests.append(now)
+            while self._recent_requests and self._recent_requests[0] < now - 60:
+                self._recent_requests.popleft()
+        waits = [0.0]
+        if self.requests:
+            waits.append(self.requests.reserve(1))
+        if self.tokens and estimated_tokens:
+            waits.append(self.tokens.reserve(estimated_tokens))
+        return max(waits)
+
+    def acquire(self, estimated_tokens=0):
+        """Blocks until one request and `estimated_tokens` tokens fit the budget. Returns seconds waited."""
+        wait = self._reserve(estimated_tokens)
+        if wait > 0:
+            logging.info(f"Rate limit ({self.name}): waiting {wait:.2f}s before the next request.")
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, estimated_tokens=0):
+        """Async variant of acquire()."""
+        wait = self._reserve(estimated_tokens)
+        if wait > 0:
+            logging.info(f"Rate limit ({self.name}): waiting {wait:.2f}s before the next request.")
+            await asyncio.sleep(wait)
+        return wait
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Replaces the up-front estimate with the token count reported by the provider."""
+        if self.tokens and actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def _apply_rpm(self, rpm):
+        self.effective_rpm = rpm
+        rate = rpm / 60.0
+        max_tokens = max(1.0, rate * RATE_LIMIT_BURST_SECONDS)
+        if self.requests is None:
+            self.requests = TokenBucketRateLimiter(tokens_per_second=rate, max_tokens=max_tokens)
+        else:
+            self.requests.set_rate(rate, max_tokens)
+
+    def on_success(self):
+        """Additive increase: each successful call adds RATE_LIMIT_AIMD_INCREASE RPM, up to the ceiling."""
+        with self._aimd_lock:
+            self.successes += 1
+            if not RATE_LIMIT_AIMD_ENABLED or self.effective_rpm is None:
+                return
+            ceiling = float(self.rpm) if self.rpm and self.rpm > 0 else RATE_LIMIT_AIMD_MAX_RPM
+            if self.effective_rpm < ceiling:
+                self._apply_rpm(min(ceiling, self.effective_rpm + RATE_LIMIT_AIMD_INCREASE))
+
+    def on_rate_limited(self, retry_after=None):
+        """
+        Multiplicative decrease after a 429 / quota error, and a pause of
+        `retry_after` seconds when the provider sent one.
+
+        Requests already in flight when the limit was hit tend to fail together;
+        only the first failure within one request interval cuts the rate.
+        """
+        now = time.monotonic()
+        with self._aimd_lock:
+            self.rate_limited += 1
+            self.last_retry_after = retry_after
+            if RATE_LIMIT_AIMD_ENABLED:
+                # When unlimited so far, start from the rate actually observed over the last minute
+                current = self.effective_rpm or float(max(len(self._recent_requests), RATE_LIMIT_AIMD_MIN_RPM))
+                if now - self._last_decrease >= 60.0 / current:
+                    self._last_decrease = now
+                    self._apply_rpm(max(RATE_LIMIT_AIMD_MIN_RPM, current * RATE_LIMIT_AIMD_DECREASE))
+                    logging.warning(f"Rate limit ({self.name}): provider throttled us, request rate lowered to {self.effective_rpm:.1f} RPM.")
+            if retry_after and retry_after > 0:
+                if self.requests is None:
+                    self._apply_rpm(float(max(len(self._recent_requests), RATE_LIMIT_AIMD_MIN_RPM)))
+                self.requests.pause(retry_after)
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+                logging.warning(f"Rate limit ({self.name}): honoring Retry-After, pausing requests for {retry_after:.1f}s.")
+
+    def snapshot(self):
+        """Current state for monitoring (e.g. the /api/rate_limits endpoint)."""
+        with self._aimd_lock:
+            recent = sum(1 for t in self._recent_requests if t >= time.monotonic() - 60)
+            return {
+                'name': self.name,
+                'configured_rpm': self.rpm or None,
+                'configured_tpm': self.tpm or None,
+                'effective_rpm': round(self.effective_rpm, 2) if self.effective_rpm is not None else None,
+                'requests_last_minute': recent,
+                'successes': self.successes,
+                'rate_limited': self.rate_limited,
+                'last_retry_after': self.last_retry_after,
+                'paused_for': round(max(0.0, self.paused_until - time.time()), 2),
+            }
+
+
+_provider_limits = {}
+_provider_limits_lock = threading.Lock()
+
+
+def get_provider_limits(provider, base_url, api_key, rpm, tpm, request_tokens=0):
+    """
+    Returns the shared ProviderRateLimits for (provider, base URL, API key).
+
+    Different keys and endpoints have independent quotas, so each gets its own
+    buckets. The key is stored only as a hash. request_tokens is the per-request
+    estimate the caller will reserve; the token bucket is sized to hold at least that.
+    """
+    key_hash = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+    registry_key = (provider, base_url or '', key_hash, rpm, tpm)
+    with _provider_limits_lock:
+        limits = _provider_limits.get(registry_key)
+        if limits is None:
+            name = f"{provider}@{base_url}" if base_url else provider
+            limits = ProviderRateLimits(f"{name} key {key_hash[:6]}", rpm, tpm, request_tokens)
+            _provider_limits[registry_key] = limits
+            logging.info(f"Rate limits for {limits.name}: {rpm or 'unlimited'} RPM, {tpm or 'unlimited'} TPM.")
+        return limits
+
+
+def rate_limit_snapshot():
+    """Returns the state of every provider/key rate limiter created so far."""
+    with _provider_limits_lock:
+        limits = list(_provider_limits.values())
+    return [entry.snapshot() for entry in limits]
+
 # Example Usage (for testing the rate limiter itself)
 if __name__ == '__main__':
     # Create a rate limiter that allows 2 tokens per second, with a max of 5 tokens
@@ -0,0 +1,189 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# OCR 结果缓存配置
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH', 'uploads/cache/ocr_results.sqlite3')
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024)) # 默认 256 MB
+RESULT_CACHE_TTL_SECONDS = int(os.getenv('RESULT_CACHE_TTL_SECONDS', 30 * 24 * 3600)) # 默认 30 天，0 表示永不过期
+
+
+def make_cache_key(image_bytes, provider, model_name, system_prompt, user_prompt=None, endpoint=None):
+    """
+    计算内容寻址的缓存键：页面图像字节 + 提供商/端点 + 模型名 + 最终提示词的 SHA-256。
+
+    各字段带长度前缀后拼接，避免不同字段组合产生相同的输入。
+    """
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(image_bytes).digest())
+    for field in (provider, endpoint, model_name, system_prompt, user_prompt):
+        encoded = (field or '').encode('utf-8')
+        digest.update(len(encoded).to_bytes(8, 'big'))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    基于 SQLite 的持久化 OCR 结果缓存。
+
+    条目按最近访问时间做 LRU 淘汰，总大小不超过 max_bytes；
+    超过 ttl_seconds 的条目视为过期。数据库可被多个工作进程共享。
+    """
+    def __init__(self, db_path, max_bytes=RESULT_CACHE_MAX_BYTES, ttl_seconds=RESULT_CACHE_TTL_SECONDS):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_results ("
+                " cache_key TEXT PRIMARY KEY,"
+                " analysis TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_results_last_access ON ocr_results (last_access)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_results_created ON ocr_results (created_at)")
+            # 条目数和总大小由触发器在同一事务内维护，写入时无需扫描全表求和；
+            # 首次创建时按已有数据初始化（兼容升级前的数据库）
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_results_meta ("
+                " id INTEGER PRIMARY KEY CHECK (id = 0),"
+                " entries INTEGER NOT NULL,"
+                " total_bytes INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO ocr_results_meta (id, entries, total_bytes) "
+                "SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM ocr_results"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS ocr_results_meta_insert AFTER INSERT ON ocr_results BEGIN"
+                " UPDATE ocr_results_meta SET entries = entries + 1, total_bytes = total_bytes + NEW.size WHERE id = 0;"
+                " END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS ocr_results_meta_delete AFTER DELETE ON ocr_results BEGIN"
+                " UPDATE ocr_results_meta SET entries = entries - 1, total_bytes = total_bytes - OLD.size WHERE id = 0;"
+                " END"
+            )
+        logging.info(f"OCR result cache ready at {db_path} (max {max_bytes} bytes, TTL {ttl_seconds}s).")
+
+    def _connection(self):
+        # 每个线程使用独立连接；WAL 模式允许多进程并发读写
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # INSERT OR REPLACE 覆盖旧条目时也触发删除触发器，保证统计准确
+            conn.execute("PRAGMA recursive_triggers=ON")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, cache_key):
+        """返回缓存的分析文本；未命中或已过期时返回 None。"""
+        now = time.time()
+        try:
+            with self._connection() as conn:
+                row = conn.execute("SELECT analysis, created_at FROM ocr_results WHERE cache_key = ?", (cache_key,)).fetchone()
+                if row and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                    conn.execute("DELETE FROM ocr_results WHERE cache_key = ?", (cache_key,))
+                    row = None
+                if row:
+                    conn.execute("UPDATE ocr_results SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+        except sqlite3.Error as e:
+            logging.error(f"OCR result cache read failed: {e}")
+            row = None
+
+        self._count(row is not None)
+        return row[0] if row else None
+
+    def put(self, cache_key, analysis):
+        """写入一条分析结果，并在超出容量时淘汰最久未访问的条目。"""
+        now = time.time()
+        size = len(analysis.encode('utf-8')) + len(cache_key)
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO ocr_results (cache_key, analysis, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (cache_key, analysis, size, now, now)
+                )
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logging.error(f"OCR result cache write failed: {e}")
+
+    def _evict(self, conn, now):
+        if self.ttl_seconds:
+            conn.execute("DELETE FROM ocr_results WHERE created_at < ?", (now - self.ttl_seconds,))
+        count, total = conn.execute("SELECT entries, total_bytes FROM ocr_results_meta WHERE id = 0").fetchone()
+        while total > self.max_bytes and count:
+            # 每批淘汰最久未访问的 5% 条目（至少 1 条）
+            conn.execute(
+                "DELETE FROM ocr_results WHERE cache_key IN "
+                "(SELECT cache_key FROM ocr_results ORDER BY last_access LIMIT ?)",
+                (max(1, count // 20),)
+            )
+            count, total = conn.execute("SELECT entries, total_bytes FROM ocr_results_meta WHERE id = 0").fetchone()
+
+    def stats(self):
+        """返回本进程的命中/未命中次数以及缓存的条目数和总大小。"""
+        try:
+            # 由触发器维护的计数，不扫描整张表
+            entries, total_bytes = self._connection().execute("SELECT entries, total_bytes FROM ocr_results_meta WHERE id = 0").fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"OCR result cache stats failed: {e}")
+            entries, total_bytes = None, None
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'enabled': True,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'entries': entries,
+            'bytes': total_bytes,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl_seconds,
+        }
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """返回进程内共享的 ResultCache；缓存被禁用或无法初始化时返回 None。"""
+    global _result_cache
+    if not RESULT_CACHE_ENABLED:
+        return None
+    with _result_cache_lock:
+        if _result_cache is None:
+            try:
+                _result_cache = ResultCache(RESULT_CACHE_PATH)
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Could not initialize OCR result cache at {RESULT_CACHE_PATH}: {e}")
+                return None
+        return _result_cache
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 已处理文件结果的存储（供导出 Markdown 使用）：
+# 'sqlite' 为磁盘上的 SQLite 数据库，可被多个工作进程共享；'memory' 为进程内的 LRU 缓存
+RESULT_STORE_BACKEND = os.getenv('RESULT_STORE_BACKEND', 'sqlite').strip().lower()
+RESULT_STORE_PATH = os.getenv('RESULT_STORE_PATH', 'uploads/cache/processed_results.sqlite3')
+RESULT_STORE_MAX_BYTES = int(os.getenv('RESULT_STORE_MAX_BYTES', 64 * 1024 * 1024)) # 内存后端的容量，默认 64 MB
+RESULT_STORE_TTL_SECONDS = int(os.getenv('RESULT_STORE_TTL_SECONDS', 7 * 24 * 3600)) # SQLite 后端默认保留 7 天，0 表示永不过期
+
+
+class MemoryResultStore:
+    """
+    进程内的已处理文件结果存储。
+
+    按最近访问时间做 LRU 淘汰，所有条目序列化后的总大小不超过 max_bytes。
+    只对当前进程可见，适合单进程部署。
+    """
+    def __init__(self, max_bytes=RESULT_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # filename -> (file_data, size)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, filename, file_data):
+        """按键 (任务 ID/文件序号) 保存一个文件的结果（同键覆盖），超出容量时淘汰最久未访问的文件。"""
+        size = len(json.dumps(file_data, ensure_ascii=False).encode('utf-8'))
+        with self._lock:
+            previous = self._entries.pop(filename, None)
+            if previous:
+                self._total_bytes -= previous[1]
+            self._entries[filename] = (file_data, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                logging.info(f"Result store: evicted '{evicted}' ({evicted_size} bytes) to stay within {self.max_bytes} bytes.")
+
+    def get(self, filename):
+        """返回文件的结果；不存在时返回 None。"""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return None
+            self._entries.move_to_end(filename)
+            return entry[0]
+
+    def items(self):
+        """按保存顺序逐个产出 (filename, file_data)。"""
+        with self._lock:
+            snapshot = [(filename, entry[0]) for filename, entry in self._entries.items()]
+        return iter(snapshot)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'entries': len(self._entries), 'bytes': self._total_bytes, 'max_bytes': self.max_bytes}
+
+
+class SQLiteResultStore:
+    """
+    基于 SQLite 的已处理文件结果存储。
+
+    结果以 JSON 保存在磁盘上，可被多个工作进程共享：任一进程处理的文件都能由其他进程导出。
+    超过 ttl_seconds 未更新的条目视为过期，在读取和写入时清理。
+    """
+    def __init__(self, db_path, ttl_seconds=RESULT_STORE_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed_results ("
+                " filename TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_results_updated ON processed_results (updated_at)")
+        logging.info(f"Result store ready at {db_path} (TTL {ttl_seconds}s).")
+
+    def _connection(self):
+        # 每个线程使用独立连接；WAL 模式允许多进程并发读写
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _expiry_cutoff(self):
+        return time.time() - self.ttl_seconds if self.ttl_seconds else 0
+
+    def put(self, filename, file_data):
+        """按键 (任务 ID/文件序号) 保存一个文件的结果（同键覆盖），并清理过期条目。"""
+        data = json.dumps(file_data, ensure_ascii=False)
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO processed_results (filename, data, size, updated_at) VALUES (?, ?, ?, ?)",
+                    (filename, data, len(data.encode('utf-8')), time.time())
+                )
+                if self.ttl_seconds:
+                    conn.execute("DELETE FROM processed_results WHERE updated_at < ?", (self._expiry_cutoff(),))
+        except sqlite3.Error as e:
+            logging.error(f"Result store write failed for '{filename}': {e}")
+
+    def get(self, filename):
+        """返回文件的结果；不存在或已过期时返回 None。"""
+        try:
+            row = self._connection().execute(
+                "SELECT data FROM processed_results WHERE filename = ? AND updated_at >= ?", (filename, self._expiry_cutoff())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Result store read failed for '{filename}': {e}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def items(self):
+        """按保存顺序逐个产出未过期的 (filename, file_data)，逐行读取，不一次性载入全部结果。"""
+        cursor = self._connection().execute(
+            "SELECT filename, data FROM processed_results WHERE updated_at >= ? ORDER BY updated_at", (self._expiry_cutoff(),)
+        )
+        for filename, data in cursor:
+            yield filename, json.loads(data)
+
+    def stats(self):
+        try:
+            entries, total_bytes = self._connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM processed_results WHERE updated_at >= ?", (self._expiry_cutoff(),)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Result store stats failed: {e}")
+            entries, total_bytes = None, None
+        return {'backend': 'sqlite', 'entries': entries, 'bytes': total_bytes, 'ttl_seconds': self.ttl_seconds}
+
+
+_result_store = None
+_result_store_lock = threading.Lock()
+
+
+def get_result_store():
+    """
+    返回进程内共享的结果存储（由 RESULT_STORE_BACKEND 选择后端）。
+
+    SQLite 数据库无法初始化时退回内存后端，导出仍可在处理文件的进程内使用。
+    """
+    global _result_store
+    with _result_store_lock:
+        if _result_store is None:
+            if RESULT_STORE_BACKEND == 'memory':
+                _result_store = MemoryResultStore()
+            else:
+                if RESULT_STORE_BACKEND != 'sqlite':
+                    logging.warning(f"Unknown RESULT_STORE_BACKEND '{RESULT_STORE_BACKEND}', using 'sqlite'.")
+                try:
+                    _result_store = SQLiteResultStore(RESULT_STORE_PATH)
+                except (OSError, sqlite3.Error) as e:
+                    logging.error(f"Could not initialize result store at {RESULT_STORE_PATH}, falling back to memory: {e}")
+                    _result_store = MemoryResultStore()
+        return _result_store
@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Retry configuration for transient LLM failures (timeouts, 5xx, connection errors, 429)
+LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20.0"))
+
+# Circuit breaker: after this many consecutive transient failures an endpoint is
+# considered down and calls fail fast for CIRCUIT_BREAKER_RESET_SECONDS
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit breaker is open."""
+    pass
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.
+
+    The delay before retry n (1-based) is uniform in
+    [0, min(max_delay, base_delay * multiplier ** (n - 1))], which spreads out
+    retries from many concurrent pages instead of having them hit the provider
+    again in lockstep.
+    """
+    def __init__(self, max_attempts=LLM_RETRY_MAX_ATTEMPTS, base_delay=LLM_RETRY_BASE_DELAY,
+                 max_delay=LLM_RETRY_MAX_DELAY, multiplier=2.0, jitter=True):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def backoff(self, retry_number):
+        ceiling = min(self.max_delay, self.base_delay * (self.multiplier ** (retry_number - 1)))
+        return random.uniform(0, ceiling) if self.jitter else ceiling
+
+
+class CircuitBreaker:
+    """
+    A consecutive-failure circuit breaker for one endpoint.
+
+    closed: calls go through. After failure_threshold consecutive failures the
+    breaker opens and calls fail fast. After reset_timeout one probe call is let
+    through (half-open); its success closes the breaker, its failure reopens it.
+    A probe that ends without telling either way (e.g. a 400 or a 429) is released
+    with release_probe(), so the next call becomes the probe.
+    """
+    def __init__(self, name, failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a call may be made now."""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probe_in_flight = False
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                logging.info(f"Circuit breaker {self.name}: half-open, sending a probe request.")
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logging.info(f"Circuit breaker {self.name}: closed again after a successful call.")
+            self.state = 'closed'
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """Ends an in-flight probe without changing the state (the outcome says nothing about an outage)."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and 0 < self.failure_threshold <= self.consecutive_failures):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+                logging.warning(f"Circuit breaker {self.name}: open after {self.consecutive_failures} consecutive failures; "
+                                f"failing fast for {self.reset_timeout:.0f}s.")
+
+    def retry_in(self):
+        """Seconds until the next probe is allowed (0 when not open)."""
+        with self._lock:
+            if self.state != 'open':
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def snapshot(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'retry_in': round(self.retry_in(), 2),
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider, endpoint=None):
+    """Returns the shared CircuitBreaker for a provider endpoint (base URL)."""
+    key = (provider, endpoint or '')
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(f"{provider}@{endpoint}" if endpoint else provider)
+            _breakers[key] = breaker
+        return breaker
+
+
+def circuit_breaker_snapshot():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [breaker.snapshot() for breaker in breakers]
+
+
+def _check_breaker(breaker, label):
+    if breaker and not breaker.allow():
+        raise CircuitOpenError(f"{breaker.name} is unavailable (circuit open, next probe in {breaker.retry_in():.0f}s); "
+                               f"skipped call for {label}")
+
+
+def call_with_retry(func, policy, breaker, is_retryable, counts_as_outage=None, label="request"):
+    """
+    Calls func() with retries.
+
+    Args:
+        func: zero-argument callable performing one attempt (including any rate limiting).
+        policy: RetryPolicy.
+        breaker: CircuitBreaker for the endpoint, or None.
+        is_retryable: predicate(exception) -> bool; other exceptions are raised immediately.
+        counts_as_outage: predicate(exception) -> bool deciding whether a retryable
+                          failure counts towards opening the breaker (default: all do).
+                          Rate limiting, for example, means the endpoint is up.
+        label: used in log messages.
+
+    Raises:
+        CircuitOpenError if the breaker is open, otherwise the last exception.
+    """
+    for attempt in range(1, policy.max_attempts + 1):
+        _check_breaker(breaker, label)
+        try:
+            result = func()
+        except Exception as e:
+            retryable = is_retryable(e)
+            if breaker:
+                if retryable and (counts_as_outage is None or counts_as_outage(e)):
+                    breaker.record_failure()
+                else:
+                    # Never leave a half-open breaker waiting on a probe that has already returned
+                    breaker.release_probe()
+            if not retryable or attempt == policy.max_attempts:
+                raise
+            delay = policy.backoff(attempt)
+            logging.warning(f"Attempt {attempt}/{policy.max_attempts} for {label} failed ({type(e).__name__}: {e}); "
+                            f"retrying in {delay:.2f}s.")
+            time.sleep(delay)
+            continue
+        if breaker:
+            breaker.record_success()
+        return result
+
+
+async def call_with_retry_async(func, policy, breaker, is_retryable, counts_as_outage=None, label="request"):
+    """Async variant of call_with_retry; func is a zero-argument coroutine function."""
+    for attempt in range(1, policy.max_attempts + 1):
+        _check_breaker(breaker, label)
+        try:
+            result = await func()
+        except Exception as e:
+            retryable = is_retryable(e)
+            if breaker:
+                if retryable and (counts_as_outage is None or counts_as_outage(e)):
+                    breaker.record_failure()
+                else:
+                    # Never leave a half-open breaker waiting on a probe that has already returned
+                    breaker.release_probe()
+            if not retryable or attempt == policy.max_attempts:
+                raise
+            delay = policy.backoff(attempt)
+            logging.warning(f"Attempt {attempt}/{policy.max_attempts} for {label} failed ({type(e).__name__}: {e}); "
+                            f"retrying in {delay:.2f}s.")
+            await asyncio.sleep(delay)
+            continue
+        if breaker:
+            breaker.record_success()
+        return result
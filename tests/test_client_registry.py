@@ -0,0 +1,60 @@
+import asyncio
+import functools
+import gc
+
+from client_registry import ClientRegistry, close_on_loop
+
+
+class FakeClient:
+    def __init__(self, name):
+        self.name = name
+
+
+def _registry(released, **kwargs):
+    # release() must not reference the client, so it captures only its name
+    return ClientRegistry("test", release=lambda client: functools.partial(released.append, client.name), **kwargs)
+
+
+def test_reuses_clients_per_key():
+    registry = ClientRegistry("test")
+    first = registry.get('a', lambda: FakeClient('a'))
+    assert registry.get('a', lambda: FakeClient('other')) is first
+    assert registry.stats()['created'] == 1 and registry.stats()['reused'] == 1
+
+
+def test_evicted_client_is_released_once_unreferenced():
+    released = []
+    registry = _registry(released, max_size=1)
+    held = registry.get('a', lambda: FakeClient('a'))
+    registry.get('b', lambda: FakeClient('b'))  # evicts 'a' while a request still holds it
+    gc.collect()
+    assert released == []
+    del held
+    gc.collect()
+    assert released == ['a']
+
+
+def test_unreferenced_evicted_client_is_released_immediately():
+    released = []
+    registry = _registry(released, max_size=1)
+    registry.get('a', lambda: FakeClient('a'))
+    registry.get('b', lambda: FakeClient('b'))
+    gc.collect()
+    assert released == ['a']
+
+
+def test_close_on_loop_schedules_the_close_on_that_loop():
+    closed = []
+
+    async def close():
+        closed.append(True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        close_on_loop(loop, close)()
+        loop.run_until_complete(asyncio.sleep(0.01))
+    finally:
+        loop.close()
+    assert closed == [True]
+    # Nothing can be scheduled on a closed loop any more
+    close_on_loop(loop, close)()
@@ -0,0 +1,102 @@
+import json
+import time
+
+import job_queue
+
+
+def _open_queue(tmp_path, cleanup=None):
+    # Workers are never started, so jobs only change state through the methods under test
+    return job_queue.JobQueue(str(tmp_path / "jobs.sqlite3"), handler=None, workers=1, cleanup=cleanup)
+
+
+def _insert_job(queue, tmp_path, job_id, status, owner="other-process", lease_expires_at=None, needs_secrets=0,
+                finished_at=None, file_statuses=('queued',)):
+    now = time.time()
+    pdf_paths = []
+    with queue._connection() as conn:
+        conn.execute(
+            "INSERT INTO jobs (job_id, status, owner, needs_secrets, options, created_at, updated_at, finished_at, lease_expires_at) "
+            "VALUES (?, ?, ?, ?, '{}', ?, ?, ?, ?)",
+            (job_id, status, owner, needs_secrets, now, now, finished_at, lease_expires_at)
+        )
+        for index, file_status in enumerate(file_statuses):
+            pdf_path = tmp_path / f"{job_id}-{index}.pdf"
+            pdf_path.write_bytes(b"%PDF-1.4")
+            pdf_paths.append(pdf_path)
+            conn.execute(
+                "INSERT INTO job_files (job_id, file_index, filename, pdf_path, status) VALUES (?, ?, ?, ?, ?)",
+                (job_id, index, f"file-{index}.pdf", str(pdf_path), file_status)
+            )
+            conn.execute(
+                "INSERT INTO job_pages (job_id, file_index, page_number, result, finished_at) VALUES (?, ?, 1, ?, ?)",
+                (job_id, index, json.dumps({'page_number': 1}), now)
+            )
+    return pdf_paths
+
+
+def test_running_job_with_live_lease_is_not_recovered(tmp_path):
+    queue = _open_queue(tmp_path)
+    _insert_job(queue, tmp_path, "live", 'running', lease_expires_at=time.time() + 60)
+
+    queue._recover_stale_jobs()
+
+    assert queue.get_job("live")['status'] == 'running'
+
+
+def test_running_job_with_expired_lease_is_requeued_keeping_finished_files(tmp_path):
+    queue = _open_queue(tmp_path)
+    _insert_job(queue, tmp_path, "stale", 'running', lease_expires_at=time.time() - 1, file_statuses=('done', 'running'))
+
+    queue._recover_stale_jobs()
+
+    job = queue.get_job("stale")
+    assert job['status'] == 'queued'
+    assert [item['status'] for item in job['files']] == ['done', 'queued']
+    assert [item['pages_done'] for item in job['files']] == [1, 0]
+    assert queue._claim_next()[0] == "stale"
+
+
+def test_reopening_the_queue_recovers_jobs_of_a_dead_process(tmp_path):
+    queue = _open_queue(tmp_path)
+    _insert_job(queue, tmp_path, "orphan", 'running', lease_expires_at=None)
+
+    assert _open_queue(tmp_path).get_job("orphan")['status'] == 'queued'
+
+
+def test_job_needing_secrets_with_expired_lease_fails_and_drops_uploads(tmp_path):
+    queue = _open_queue(tmp_path)
+    pdf_paths = _insert_job(queue, tmp_path, "secret", 'queued', lease_expires_at=time.time() - 1, needs_secrets=1)
+
+    queue._recover_stale_jobs()
+
+    job = queue.get_job("secret")
+    assert job['status'] == 'failed' and job['error']
+    assert not any(path.exists() for path in pdf_paths)
+
+
+def test_renewing_leases_keeps_own_jobs_from_being_recovered(tmp_path):
+    queue = _open_queue(tmp_path)
+    _insert_job(queue, tmp_path, "mine", 'running', owner=queue.owner, lease_expires_at=time.time() - 1)
+    _insert_job(queue, tmp_path, "theirs", 'running', lease_expires_at=time.time() - 1)
+
+    queue._renew_leases()
+    queue._recover_stale_jobs()
+
+    assert queue.get_job("mine")['status'] == 'running'
+    assert queue.get_job("theirs")['status'] == 'queued'
+
+
+def test_sweep_removes_expired_jobs_and_their_outputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, 'JOB_RETENTION_SECONDS', 3600)
+    cleaned = []
+    queue = _open_queue(tmp_path, cleanup=cleaned.append)
+    old_paths = _insert_job(queue, tmp_path, "old", 'done', finished_at=time.time() - 7200)
+    recent_paths = _insert_job(queue, tmp_path, "recent", 'done', finished_at=time.time() - 60)
+
+    queue._sweep_expired_jobs()
+
+    assert queue.get_job("old") is None
+    assert not old_paths[0].exists()
+    assert cleaned == [str(old_paths[0])]
+    assert queue.get_job("recent")['status'] == 'done'
+    assert recent_paths[0].exists()
@@ -0,0 +1,105 @@
+import types
+
+import httpx
+import pytest
+from openai import BadRequestError
+
+import openai_client
+import retry_policy
+
+
+class FakeStream:
+    def __init__(self, chunks, fail_at=None):
+        self._chunks = chunks
+        self._fail_at = fail_at
+        self.closed = False
+
+    def __iter__(self):
+        for index, chunk in enumerate(self._chunks):
+            if index == self._fail_at:
+                raise httpx.RemoteProtocolError("peer closed connection")
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+def _text_chunk(text):
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text))], usage=None)
+
+
+def _usage_chunk(total_tokens):
+    return types.SimpleNamespace(choices=[], usage=types.SimpleNamespace(total_tokens=total_tokens))
+
+
+def _bad_request(message):
+    response = httpx.Response(400, request=httpx.Request("POST", "http://test/v1/chat/completions"))
+    return BadRequestError(message, response=response, body=None)
+
+
+class FakeClient:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = []
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _create(self, **request):
+        self.requests.append(request)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def client(monkeypatch, request):
+    fake = FakeClient()
+    monkeypatch.setattr(openai_client, 'get_openai_client', lambda api_key, base_url=None: fake)
+    monkeypatch.setattr(retry_policy.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(openai_client, '_stream_usage_unsupported', set())
+    return fake
+
+
+def _stream(base_url):
+    return list(openai_client.analyze_image_openai_stream(image_bytes=b'image', api_key_override='key',
+                                                          base_url_override=base_url))
+
+
+def test_streams_text_and_requests_usage(client):
+    client.outcomes = [FakeStream([_text_chunk("a"), _text_chunk("b"), _usage_chunk(42)])]
+    assert _stream("http://usage.test") == ["a", "b"]
+    assert client.requests[0]['stream_options'] == {"include_usage": True}
+
+
+def test_endpoint_rejecting_stream_options_is_streamed_without_it(client):
+    client.outcomes = [_bad_request("Unrecognized request argument: stream_options"),
+                       FakeStream([_text_chunk("a")]), FakeStream([_text_chunk("b")])]
+    assert _stream("http://old-server.test") == ["a"]
+    assert 'stream_options' not in client.requests[1]
+    # Remembered: the next stream to this endpoint goes out without it straight away
+    assert _stream("http://old-server.test") == ["b"]
+    assert len(client.requests) == 3 and 'stream_options' not in client.requests[2]
+
+
+def test_other_bad_requests_are_not_retried(client):
+    client.outcomes = [_bad_request("invalid image"), _bad_request("invalid image")]
+    chunks = _stream("http://bad-image.test")
+    assert len(chunks) == 1 and chunks[0].startswith("Error:")
+    assert len(client.requests) == 2  # the original request and the one without stream_options
+
+
+def test_stream_failing_before_first_chunk_is_retried(client):
+    client.outcomes = [FakeStream([_text_chunk("lost")], fail_at=0), FakeStream([_text_chunk("ok")])]
+    assert _stream("http://flaky.test") == ["ok"]
+    assert len(client.requests) == 2
+
+
+def test_stream_failing_after_text_is_raised_and_counted(client):
+    client.outcomes = [FakeStream([_text_chunk("partial"), _text_chunk("never")], fail_at=1)]
+    breaker = retry_policy.get_circuit_breaker("openai", "http://drops.test")
+    generator = openai_client.analyze_image_openai_stream(image_bytes=b'image', api_key_override='key',
+                                                          base_url_override="http://drops.test")
+    assert next(generator) == "partial"
+    with pytest.raises(httpx.RemoteProtocolError):
+        next(generator)
+    assert breaker.consecutive_failures == 1
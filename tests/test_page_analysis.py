@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+import page_analysis
+import page_dedup
+from pdf_processor import PageImage
+
+
+def _pages(count):
+    return [PageImage(number, b'page-%d' % number, 'PNG', 100, 100) for number in range(1, count + 1)]
+
+
+class _Recorder:
+    def __init__(self):
+        self.results = []
+        self._lock = threading.Lock()
+
+    def __call__(self, result):
+        with self._lock:
+            self.results.append(result)
+
+    def page_numbers(self):
+        return sorted(result['page_number'] for result in self.results)
+
+
+def _ok_result(page, analysis):
+    return {'page_number': page.page_number, 'image_path': None, 'analysis': analysis, 'cached': False,
+            'dedup': None, 'duplicate_of': None, 'text_layer': False, 'bytes_saved': 0, 'truncated': False,
+            'fingerprint': page.fingerprint, 'reused_from': None}
+
+
+@pytest.fixture(autouse=True)
+def single_page_requests(monkeypatch):
+    monkeypatch.setattr(page_analysis, 'LLM_PACK_PAGES', 1)
+
+
+def test_results_keep_page_order_when_pages_finish_out_of_order(monkeypatch):
+    def fake_analyze_page(page, llm_options, on_delta=None, should_stop=None):
+        time.sleep(0.01 * (6 - page.page_number))  # later pages finish first
+        return _ok_result(page, f"text {page.page_number}")
+
+    monkeypatch.setattr(page_analysis, 'analyze_page', fake_analyze_page)
+    recorder = _Recorder()
+    results = page_analysis.analyze_pages_streaming(_pages(5), {'provider': 'openai'}, max_workers=5, dedup=False,
+                                                    on_result=recorder)
+    assert [res['page_number'] for res in results] == [1, 2, 3, 4, 5]
+    assert [res['analysis'] for res in results] == [f"text {n}" for n in range(1, 6)]
+    assert recorder.page_numbers() == [1, 2, 3, 4, 5]
+
+
+def test_page_that_raises_gets_an_error_result(monkeypatch):
+    def fake_analyze_page(page, llm_options, on_delta=None, should_stop=None):
+        if page.page_number == 2:
+            raise RuntimeError("boom")
+        return _ok_result(page, "fine")
+
+    monkeypatch.setattr(page_analysis, 'analyze_page', fake_analyze_page)
+    recorder = _Recorder()
+    results = page_analysis.analyze_pages_streaming(_pages(3), {'provider': 'openai'}, max_workers=2, dedup=False,
+                                                    on_result=recorder)
+    assert [res['page_number'] for res in results] == [1, 2, 3]
+    assert page_analysis.is_error_analysis(results[1]['analysis'])
+    assert 'boom' in results[1]['analysis']
+    assert results[0]['analysis'] == results[2]['analysis'] == "fine"
+    assert recorder.page_numbers() == [1, 2, 3]
+
+
+class _DuplicateOfFirstPage:
+    """Treats page 3 as a duplicate of page 1, everything else as unique."""
+    def classify(self, page_number, image_bytes):
+        return ('duplicate', 1) if page_number == 3 else ('unique', None)
+
+
+@pytest.mark.parametrize('original_fails', [False, True])
+def test_duplicate_waiting_on_its_original_is_finished(monkeypatch, original_fails):
+    monkeypatch.setattr(page_dedup, 'PAGE_DEDUP_ENABLED', True)
+    monkeypatch.setattr(page_dedup, 'PageDeduplicator', _DuplicateOfFirstPage)
+    release_first_page = threading.Event()
+
+    def fake_analyze_page(page, llm_options, on_delta=None, should_stop=None):
+        if page.page_number == 1:
+            # Still running when page 3 is classified, so page 3 has to wait for it
+            assert release_first_page.wait(5)
+            if original_fails:
+                raise RuntimeError("original failed")
+        return _ok_result(page, f"text {page.page_number}")
+
+    def on_result(result):
+        recorder(result)
+        if result['page_number'] == 2:
+            release_first_page.set()
+
+    monkeypatch.setattr(page_analysis, 'analyze_page', fake_analyze_page)
+    recorder = _Recorder()
+    results = page_analysis.analyze_pages_streaming(_pages(3), {'provider': 'openai'}, max_workers=2, on_result=on_result)
+
+    assert [res['page_number'] for res in results] == [1, 2, 3]
+    assert results[2]['dedup'] == 'duplicate' and results[2]['duplicate_of'] == 1
+    assert results[2]['analysis'] == results[0]['analysis']
+    assert page_analysis.is_error_analysis(results[2]['analysis']) == original_fails
+    assert recorder.page_numbers() == [1, 2, 3]
+
+
+def test_failed_pack_gives_every_page_an_error_result(monkeypatch):
+    monkeypatch.setattr(page_analysis, 'LLM_PACK_PAGES', 2)
+    monkeypatch.setattr(page_analysis, 'LLM_PACK_TOKEN_BUDGET', 10 ** 9)
+
+    def fake_analyze_page_pack(pages, llm_options, should_stop=None):
+        raise RuntimeError("pack failed")
+
+    monkeypatch.setattr(page_analysis, 'analyze_page_pack', fake_analyze_page_pack)
+    recorder = _Recorder()
+    results = page_analysis.analyze_pages_streaming(_pages(2), {'provider': 'openai'}, max_workers=2, dedup=False,
+                                                    on_result=recorder)
+    assert [res['page_number'] for res in results] == [1, 2]
+    assert all(page_analysis.is_error_analysis(res['analysis']) for res in results)
+    assert recorder.page_numbers() == [1, 2]
+
+
+def test_previous_version_pages_are_reused_without_llm_calls(monkeypatch):
+    calls = []
+
+    def fake_analyze_page(page, llm_options, on_delta=None, should_stop=None):
+        calls.append(page.page_number)
+        return _ok_result(page, "new")
+
+    monkeypatch.setattr(page_analysis, 'analyze_page', fake_analyze_page)
+    pages = _pages(2)
+    pages[0].fingerprint, pages[1].fingerprint = 'same', 'changed'
+    previous = {'same': {'page_number': 7, 'analysis': "old", 'text_layer': False}}
+    results = page_analysis.analyze_pages_streaming(pages, {'provider': 'openai'}, dedup=False, previous_results=previous)
+    assert calls == [2]
+    assert results[0]['analysis'] == "old" and results[0]['reused_from'] == 7
+    assert results[1]['analysis'] == "new"
+
+
+def test_unrendered_unchanged_pages_are_reused_before_dedup(monkeypatch):
+    def fake_analyze_page(page, llm_options, on_delta=None, should_stop=None):
+        return _ok_result(page, "new")
+
+    monkeypatch.setattr(page_analysis, 'analyze_page', fake_analyze_page)
+    monkeypatch.setattr(page_dedup, 'PAGE_DEDUP_ENABLED', True)
+    # The renderer skips pages whose fingerprint is known, so they carry no image data
+    pages = [PageImage(1, None, None, None, None, fingerprint='same')] + _pages(2)[1:]
+    previous = {'same': {'page_number': 1, 'analysis': "old", 'text_layer': False}}
+    results = page_analysis.analyze_pages_streaming(pages, {'provider': 'openai'}, previous_results=previous)
+    assert results[0]['analysis'] == "old" and results[0]['image_path'] is None
+    assert results[1]['analysis'] == "new"
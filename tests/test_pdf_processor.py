@@ -0,0 +1,35 @@
+import fitz
+
+import pdf_processor
+
+
+def _write_pdf(path, texts):
+    doc = fitz.open()
+    for text in texts:
+        page = doc.new_page(width=200, height=200)
+        page.insert_text((20, 50), text)
+    doc.save(str(path))
+    doc.close()
+
+
+def test_pages_with_known_fingerprints_are_not_rendered(tmp_path):
+    pdf_path = tmp_path / "doc.pdf"
+    _write_pdf(pdf_path, ["unchanged", "edited"])
+    fingerprints = pdf_processor.page_fingerprints(str(pdf_path))
+
+    pages = list(pdf_processor.iter_pdf_pages(str(pdf_path), base_output_folder=str(tmp_path / "images"), dpi=36,
+                                              workers=1, use_text_layer=False, known_fingerprints={fingerprints[1]}))
+
+    assert [page.page_number for page in pages] == [1, 2]
+    assert pages[0].unchanged and pages[0].data is None and pages[0].image_path is None
+    assert pages[0].fingerprint == fingerprints[1]
+    assert not pages[1].unchanged and pages[1].data and pages[1].fingerprint == fingerprints[2]
+
+
+def test_fingerprints_are_only_computed_on_request(tmp_path):
+    pdf_path = tmp_path / "doc.pdf"
+    _write_pdf(pdf_path, ["only page"])
+
+    pages = list(pdf_processor.iter_pdf_pages(str(pdf_path), dpi=36, workers=1, use_text_layer=False))
+
+    assert pages[0].fingerprint is None and pages[0].data
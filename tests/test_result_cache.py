@@ -0,0 +1,27 @@
+import sqlite3
+
+from result_cache import ResultCache
+
+
+def _actual_totals(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return tuple(conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_results").fetchone())
+
+
+def test_stats_match_table_after_replacements_and_evictions(tmp_path):
+    db_path = str(tmp_path / 'cache.sqlite3')
+    cache = ResultCache(db_path, max_bytes=2000, ttl_seconds=0)
+    for index in range(50):
+        cache.put(f"key-{index % 30}", "x" * (index + 10))
+        stats = cache.stats()
+        assert (stats['entries'], stats['bytes']) == _actual_totals(db_path)
+    assert cache.stats()['bytes'] <= 2000
+
+
+def test_get_hits_and_misses(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache.sqlite3'), max_bytes=10 ** 6, ttl_seconds=0)
+    cache.put('a', 'text')
+    assert cache.get('a') == 'text'
+    assert cache.get('b') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
@@ -0,0 +1,157 @@
+import time
+
+import pytest
+
+import retry_policy
+from retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_retry
+
+
+class Outage(Exception):
+    pass
+
+
+class Throttled(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _is_retryable(error):
+    return isinstance(error, (Outage, Throttled))
+
+
+def _counts_as_outage(error):
+    return not isinstance(error, Throttled)
+
+
+def _raise(error):
+    def func():
+        raise error
+    return func
+
+
+NO_RETRY = RetryPolicy(max_attempts=1, base_delay=0, jitter=False)
+
+
+def _open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        with pytest.raises(Outage):
+            call_with_retry(_raise(Outage()), NO_RETRY, breaker, _is_retryable, _counts_as_outage)
+    assert breaker.state == 'open'
+
+
+def _half_open(breaker):
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+
+
+def test_backoff_without_jitter_is_capped_exponential():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0, jitter=False)
+    assert [policy.backoff(n) for n in range(1, 5)] == [1.0, 2.0, 4.0, 5.0]
+
+
+def test_retries_transient_errors_then_succeeds(monkeypatch):
+    monkeypatch.setattr(retry_policy.time, 'sleep', lambda seconds: None)
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Outage()
+        return 'ok'
+
+    breaker = CircuitBreaker('test', failure_threshold=5)
+    assert call_with_retry(func, RetryPolicy(max_attempts=3), breaker, _is_retryable) == 'ok'
+    assert len(attempts) == 3
+    assert breaker.state == 'closed' and breaker.consecutive_failures == 0
+
+
+def test_non_retryable_error_is_raised_immediately():
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        raise BadRequest()
+
+    with pytest.raises(BadRequest):
+        call_with_retry(func, RetryPolicy(max_attempts=3), None, _is_retryable)
+    assert len(attempts) == 1
+
+
+def test_breaker_opens_and_fails_fast():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+    _open_breaker(breaker)
+    called = []
+    with pytest.raises(CircuitOpenError):
+        call_with_retry(lambda: called.append(1), NO_RETRY, breaker, _is_retryable)
+    assert not called
+
+
+def test_rate_limiting_does_not_open_breaker():
+    breaker = CircuitBreaker('test', failure_threshold=2)
+    for _ in range(5):
+        with pytest.raises(Throttled):
+            call_with_retry(_raise(Throttled()), NO_RETRY, breaker, _is_retryable, _counts_as_outage)
+    assert breaker.state == 'closed'
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+    _open_breaker(breaker)
+    _half_open(breaker)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes_breaker():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+    _open_breaker(breaker)
+    _half_open(breaker)
+    assert call_with_retry(lambda: 'ok', NO_RETRY, breaker, _is_retryable) == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+    _open_breaker(breaker)
+    _half_open(breaker)
+    with pytest.raises(Outage):
+        call_with_retry(_raise(Outage()), NO_RETRY, breaker, _is_retryable, _counts_as_outage)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+@pytest.mark.parametrize('error', [Throttled(), BadRequest()])
+def test_inconclusive_probe_releases_half_open_breaker(error):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+    _open_breaker(breaker)
+    _half_open(breaker)
+    with pytest.raises(type(error)):
+        call_with_retry(_raise(error), NO_RETRY, breaker, _is_retryable, _counts_as_outage)
+    # The next call becomes the probe instead of being refused forever
+    assert call_with_retry(lambda: 'ok', NO_RETRY, breaker, _is_retryable, _counts_as_outage) == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_async_inconclusive_probe_releases_half_open_breaker():
+    import asyncio
+
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60)
+    _open_breaker(breaker)
+    _half_open(breaker)
+
+    async def throttled():
+        raise Throttled()
+
+    async def ok():
+        return 'ok'
+
+    async def run():
+        with pytest.raises(Throttled):
+            await retry_policy.call_with_retry_async(throttled, NO_RETRY, breaker, _is_retryable, _counts_as_outage)
+        return await retry_policy.call_with_retry_async(ok, NO_RETRY, breaker, _is_retryable, _counts_as_outage)
+
+    assert asyncio.run(run()) == 'ok'
+    assert breaker.state == 'closed'